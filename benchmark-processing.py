@@ -0,0 +1,130 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import pandas as pd
+import pyarrow as pa
+from synthetic_fundamentals import generate
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def load_process_xml():
+    # process-xml.py is a script, so it can't be imported by name
+    spec = importlib.util.spec_from_file_location('process_xml', os.path.join(here, 'process-xml.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def timed(f, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = f()
+        timings += [time.perf_counter() - start]
+    return result, {'best_s': min(timings), 'mean_s': statistics.mean(timings), 'repeats': repeats}
+
+def benchmark_methods(process_xml, fundamentals_dir, symbol, repeats):
+    """Time parsing and every processing method of every processor, on the reports of a single company."""
+    results = []
+    for reportType, processor in process_xml.functionmapping.items():
+        path = os.path.join(fundamentals_dir, symbol, f'{reportType}.xml')
+        size = os.path.getsize(path)
+
+        def parse():
+            # The processors parse their file the first time the tree is needed
+            proc_object = processor(path)
+            proc_object.tree
+            return proc_object
+
+        proc_object, timing = timed(parse, repeats)
+        results += [dict(name=f'{reportType}.parse', bytes=size, **timing)]
+
+        for subreport_type in proc_object.processing_methods:
+            table, timing = timed(lambda: proc_object.process_table(subreport_type), repeats)
+            results += [dict(name=f'{reportType}.{subreport_type}', rows=table.num_rows, columns=table.num_columns, **timing)]
+            print(f"{reportType}.{subreport_type}: {timing['best_s'] * 1000:.2f} ms, {table.num_rows} rows")
+    return results
+
+def benchmark_end_to_end(directory, workers, repeats):
+    """Time full and incremental (nothing changed) runs of process-xml.py on the generated fundamentals directory."""
+    results = []
+    for name, arguments in (('end_to_end.full', ['--full']), ('end_to_end.incremental', [])):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(here, 'process-xml.py'), '--workers', str(workers), '--export', 'export'] + arguments,
+                           cwd=directory, check=True, stdout=subprocess.DEVNULL)
+            timings += [time.perf_counter() - start]
+        results += [{'name': name, 'workers': workers, 'best_s': min(timings), 'mean_s': statistics.mean(timings), 'repeats': repeats}]
+        print(f'{name}: {min(timings):.2f} s')
+
+    export_dir = os.path.join(directory, 'export')
+    results[0]['bytes_written'] = sum(os.path.getsize(os.path.join(export_dir, f)) for f in os.listdir(export_dir) if f.endswith('.parquet'))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_file):
+    # Relative change of the best timings, compared to the results of an earlier benchmark run
+    with open(baseline_file, 'r') as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+    for r in results:
+        if r['name'] in baseline:
+            change = r['best_s'] / baseline[r['name']]['best_s'] - 1
+            print(f"{r['name']:60} {baseline[r['name']]['best_s'] * 1000:10.2f} ms -> {r['best_s'] * 1000:10.2f} ms ({change:+.1%})")
+
+def main(args):
+    process_xml = load_process_xml()
+    scale = {'companies': args.companies, 'years': args.years, 'coa_items': args.coa_items, 'estimates': args.estimates}
+
+    with tempfile.TemporaryDirectory() as directory:
+        fundamentals_dir = os.path.join(directory, 'fundamentals')
+        generate(fundamentals_dir, not_found=0, seed=args.seed, **scale)
+
+        results = benchmark_methods(process_xml, fundamentals_dir, 'S0000', args.repeats)
+        if not args.skip_end_to_end:
+            results += benchmark_end_to_end(directory, args.workers, args.end_to_end_repeats)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'pyarrow': pa.__version__,
+        'scale': scale,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the processing methods and the end-to-end run of process-xml.py on synthetic fundamentals.')
+    parser.add_argument('--companies', type=int, default=50, help='Number of companies for the end-to-end run (default: 50)')
+    parser.add_argument('--years', type=int, default=10, help='Number of fiscal years per company (default: 10)')
+    parser.add_argument('--coa-items', type=int, default=300, help='Number of COA items per company (default: 300)')
+    parser.add_argument('--estimates', type=int, default=15, help='Number of estimate types per company (default: 15)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated fundamentals (default: 0)')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of times every processing method is timed (default: 5)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes of the end-to-end run (default: 1)')
+    parser.add_argument('--end-to-end-repeats', type=int, default=1, help='Number of times the end-to-end run is timed (default: 1)')
+    parser.add_argument('--skip-end-to-end', action='store_true', help='Only benchmark the processing methods')
+    parser.add_argument('--output', default='benchmark-results.json', help='File to write the results to, as JSON (default: benchmark-results.json)')
+    parser.add_argument('--compare', metavar='RESULTS_FILE', help='Print the change of every timing compared to an earlier results file')
+    args = parser.parse_args()
+
+    main(args)
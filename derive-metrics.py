@@ -0,0 +1,170 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import instrumentation
+from export_tables import statement_columns
+from instrumentation import pipeline_metrics
+
+# The interim statements of process-xml.py the metrics are derived from
+statement_files = ['ReportsFinStatements_income_statement_interim', 'ReportsFinStatements_cash_flow_interim', 'ReportsFinStatements_balance_sheet_interim']
+
+# The columns of the statements that are not COA codes
+header_columns = statement_columns + ['symbol', 'reportType', '__index_level_0__']
+
+# Income and cash flow statements report flows over a period, which add up to TTM figures; balance sheets report
+# positions at the end of the period
+flow_statements = ['INC', 'CAS']
+
+# Ratios: name -> (numerator COA codes, denominator COA code). Flows are taken over the trailing twelve months,
+# positions at the end of the quarter. Codes of a numerator are added up, e.g. free cash flow is the cash from
+# operating activities plus the (negative) capital expenditures.
+ratio_definitions = {
+    'gross_margin': (['SGRP'], 'RTLR'),
+    'operating_margin': (['SOPI'], 'RTLR'),
+    'net_margin': (['NINC'], 'RTLR'),
+    'free_cash_flow_margin': (['OTLO', 'SCEX'], 'RTLR'),
+    'return_on_equity': (['NINC'], 'QTLE'),
+    'return_on_assets': (['NINC'], 'ATOT'),
+    'current_ratio': (['ATCA'], 'LTCL'),
+    'debt_to_equity': (['STLD'], 'QTLE'),
+}
+
+# Average length of a quarter in days, to number the quarters by their end date
+quarter_days = 365.25 / 4
+
+def latest_statements(df):
+    """
+    Keep one statement per symbol, statement type and fiscal period: the one with the latest source date. Restated
+    statements appear next to the original one; on the same source date a restatement (RES) wins.
+    """
+    restated = (df['UpdateTypeCode'].astype('string') == 'RES').fillna(False) if 'UpdateTypeCode' in df.columns else False
+    df = df.assign(_restated=restated)
+    df = df.sort_values(['SourceDate', '_restated'], na_position='first', kind='stable')
+    df = df.drop_duplicates(['symbol', 'StatementType', 'FiscalPeriodEndDate'], keep='last')
+    return df.drop(columns='_restated')
+
+def to_long(df):
+    """One row per symbol, statement, fiscal period and COA code, with the reported value."""
+    coa_columns = [col for col in df.columns if col not in header_columns]
+    ids = ['symbol', 'StatementType', 'FiscalPeriodEndDate', 'FiscalPeriodYear', 'FiscalPeriodNumber', 'PeriodLength', 'periodTypeCode', 'UpdateTypeCode', 'SourceDate']
+    ids = [col for col in ids if col in df.columns]
+    long = df[ids + coa_columns].melt(id_vars=ids, var_name='COA', value_name='value').dropna(subset=['value'])
+    for col in ('symbol', 'StatementType', 'periodTypeCode', 'UpdateTypeCode', 'COA'):
+        if col in long.columns:
+            long[col] = long[col].astype('string')
+    return long
+
+def quarter_index(end_dates):
+    # Consecutive quarters get consecutive numbers, also for fiscal years of 52/53 weeks that end on another day
+    days = pd.to_datetime(end_dates).to_numpy(dtype='datetime64[D]').astype(np.int64)
+    return np.round(days / quarter_days).astype(np.int64)
+
+def shifted(series, keys, quarters, k):
+    """The value of series k quarters earlier for every row, by key; NaN where that quarter is missing."""
+    index = pd.MultiIndex.from_arrays([keys[c] for c in keys.columns] + [quarters])
+    lookup = pd.Series(series.to_numpy(), index=index)
+    lookup = lookup[~lookup.index.duplicated(keep='last')]
+    wanted = pd.MultiIndex.from_arrays([keys[c] for c in keys.columns] + [quarters - k])
+    return pd.Series(lookup.reindex(wanted).to_numpy(), index=series.index)
+
+def growth(current, previous):
+    # Relative to the size of the previous value, so a loss that shrinks is positive growth
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ((current - previous) / previous.abs()).where(previous != 0)
+
+def derive_metrics(df):
+    """
+    TTM sums, QoQ and YoY growth per symbol and COA code, from the interim statements.
+    Year-to-date figures (e.g. cash flow statements of 6 or 9 months) are turned into the figures of a single quarter
+    first. Sums and growth rates are only computed when all quarters they need are there: a missing quarter makes
+    them NaN, instead of shifting the values of other quarters into its place.
+    """
+    long = to_long(latest_statements(df))
+    long['quarter'] = quarter_index(long['FiscalPeriodEndDate'])
+    keys = long[['symbol', 'StatementType', 'COA']]
+
+    # The number of quarters the figure covers; weeks are converted to months first
+    months = long['PeriodLength'].astype('float64').where(long['periodTypeCode'] != 'W', long['PeriodLength'].astype('float64') * 12 / 52)
+    long['quarters'] = np.round(months.fillna(3) / 3).clip(lower=1)
+
+    is_flow = long['StatementType'].isin(flow_statements).fillna(False)
+    previous_value = shifted(long['value'], keys, long['quarter'], 1)
+    previous_quarters = shifted(long['quarters'], keys, long['quarter'], 1)
+    previous_year = shifted(long['FiscalPeriodYear'].astype('float64'), keys, long['quarter'], 1)
+    year_to_date = is_flow & (long['quarters'] > 1)
+    decumulated = (long['value'] - previous_value).where((previous_quarters == long['quarters'] - 1) & (previous_year == long['FiscalPeriodYear'].astype('float64')))
+    long['quarter_value'] = long['value'].where(~year_to_date, decumulated)
+
+    # TTM: the sum of the last four quarters, if all four are there
+    ttm = long['quarter_value'].copy()
+    for k in (1, 2, 3):
+        ttm = ttm + shifted(long['quarter_value'], keys, long['quarter'], k)
+    long['ttm'] = ttm.where(is_flow)
+
+    long['qoq_growth'] = growth(long['quarter_value'], shifted(long['quarter_value'], keys, long['quarter'], 1))
+    long['yoy_growth'] = growth(long['quarter_value'], shifted(long['quarter_value'], keys, long['quarter'], 4))
+    long['ttm_yoy_growth'] = growth(long['ttm'], shifted(long['ttm'], keys, long['quarter'], 4))
+
+    columns = ['symbol', 'StatementType', 'COA', 'FiscalPeriodEndDate', 'FiscalPeriodYear', 'FiscalPeriodNumber', 'UpdateTypeCode', 'SourceDate',
+               'value', 'quarter_value', 'ttm', 'qoq_growth', 'yoy_growth', 'ttm_yoy_growth']
+    return long.sort_values(['symbol', 'StatementType', 'COA', 'quarter'], kind='stable')[[col for col in columns if col in long.columns]].reset_index(drop=True)
+
+def derive_ratios(metrics):
+    """The ratios of ratio_definitions per symbol and fiscal quarter, from the derived metrics."""
+    codes = {code for numerator, denominator in ratio_definitions.values() for code in numerator + [denominator]}
+    selected = metrics[metrics['COA'].isin(codes).fillna(False)]
+    periods = ['symbol', 'FiscalPeriodEndDate', 'FiscalPeriodYear', 'FiscalPeriodNumber']
+    # Flows over the trailing twelve months, positions at the end of the quarter
+    selected = selected.assign(figure=selected['ttm'].where(selected['StatementType'].isin(flow_statements).fillna(False), selected['value']))
+    # Only the periods that have figures; a pivot table would make rows for every combination of the period columns
+    wide = selected.groupby(periods + ['COA'], observed=True, dropna=False)['figure'].last().unstack('COA')
+    wide = wide.dropna(how='all')
+
+    ratios = pd.DataFrame(index=wide.index)
+    for name, (numerator, denominator) in ratio_definitions.items():
+        if denominator not in wide.columns or any(code not in wide.columns for code in numerator):
+            ratios[name] = np.nan
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios[name] = (wide[numerator].sum(axis=1, min_count=len(numerator)) / wide[denominator]).where(wide[denominator] != 0)
+    return ratios.reset_index()
+
+def write(df, path):
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+def main(export_dir: str = 'export', metrics: pipeline_metrics = None):
+    metrics = pipeline_metrics() if metrics is None else metrics
+    start = time.monotonic()
+
+    with metrics.stage('read') as m:
+        paths = [f'{export_dir}/{name}.parquet' for name in statement_files]
+        frames = [pd.read_parquet(path) for path in paths if os.path.exists(path)]
+        if not frames:
+            print(f'No interim statements in {export_dir}; run process-xml.py first')
+            return
+        df = pd.concat(frames, ignore_index=True)
+        m['rows'] = len(df)
+        m['bytes_read'] = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    with metrics.stage('derive', output='ReportsFinStatements_derived_metrics') as m:
+        derived = derive_metrics(df)
+        write(derived, f'{export_dir}/ReportsFinStatements_derived_metrics.parquet')
+        m['rows'] = len(derived)
+
+    with metrics.stage('derive', output='ReportsFinStatements_derived_ratios') as m:
+        ratios = derive_ratios(derived)
+        write(ratios, f'{export_dir}/ReportsFinStatements_derived_ratios.parquet')
+        m['rows'] = len(ratios)
+
+    print(f'Derived {len(derived)} metrics and {len(ratios)} rows of ratios in {time.monotonic() - start:.1f}s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Derive TTM figures, growth rates and ratios from the interim statements exported by process-xml.py.')
+    parser.add_argument('--export', default='export', help='Export directory of process-xml.py; the results are written there as well (default: export)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    main(export_dir=args.export, metrics=instrumentation.from_arguments(args, 'derive-metrics'))
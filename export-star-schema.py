@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import instrumentation
+from export_tables import statement_columns
+from instrumentation import pipeline_metrics
+
+# The financial statement sub-reports of process-xml.py that make up the facts
+statement_subreports = ['balance_sheet_annual', 'balance_sheet_interim', 'income_statement_annual', 'income_statement_interim', 'cash_flow_annual', 'cash_flow_interim']
+
+# The columns of the statements that are not COA codes
+header_columns = statement_columns + ['symbol', 'reportType', '__index_level_0__']
+
+period_columns = ['FiscalPeriodType', 'FiscalPeriodYear', 'FiscalPeriodNumber', 'FiscalPeriodEndDate']
+
+class surrogate_keys():
+    """
+    Integer keys for the members of the dimensions, numbered from 1 in the order in which they were first seen.
+    The keys are kept in the star schema directory, so a member keeps its key from run to run, and the facts of
+    an earlier export still point at the right rows.
+    """
+    def __init__(self, star_dir: str):
+        self.path = f'{star_dir}/keys.json'
+        self.members = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.members = json.load(f)
+        self.index = {dimension: {member: key for key, member in enumerate(members, 1)} for dimension, members in self.members.items()}
+
+    def keys(self, dimension: str, natural_keys: pd.Series):
+        """The keys of natural_keys (text) in a dimension; new members are added, in sorted order."""
+        index = self.index.setdefault(dimension, {})
+        members = self.members.setdefault(dimension, [])
+        for member in sorted(set(natural_keys.unique()) - index.keys()):
+            members += [member]
+            index[member] = len(members)
+        return natural_keys.map(index).astype('int32')
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.members, f)
+        os.replace(self.path + '.tmp', self.path)
+
+def natural_key(df, columns):
+    # The values of the columns as a single text, with empty fields for missing values
+    parts = [df[col].astype('string').fillna('') for col in columns]
+    key = parts[0]
+    for part in parts[1:]:
+        key = key + '|' + part
+    return key
+
+def read_export(export_dir, subreport_type, report_types=('ReportSnapshot', 'RESC', 'ReportsFinStatements')):
+    """
+    A sub-report from the export directory, without the row numbers. Sub-reports are exported again under every later
+    report type, so the file of the last report type that has it has the rows of all of them.
+    """
+    for report_type in report_types:
+        path = f'{export_dir}/{report_type}_{subreport_type}.parquet'
+        if os.path.exists(path):
+            return pd.read_parquet(path).reset_index(drop=True)
+    return None
+
+def latest_first(df):
+    # The rows of the last report types first, so they win when rows of several report types are deduplicated
+    order = {'ReportSnapshot': 0, 'RESC': 1, 'ReportsFinStatements': 2}
+    return df.assign(_order=df['reportType'].astype('string').map(order).fillna(3)).sort_values('_order', kind='stable').drop(columns='_order')
+
+def statements(export_dir):
+    """All financial statements, one row per statement with its COA codes as columns."""
+    frames = []
+    for subreport_type in statement_subreports:
+        df = read_export(export_dir, subreport_type, report_types=('ReportsFinStatements',))
+        if df is not None:
+            frames += [df]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=header_columns)
+
+def build(export_dir: str, star_dir: str, metrics: pipeline_metrics):
+    keys = surrogate_keys(star_dir)
+    tables = {}
+
+    with metrics.stage('read') as m:
+        df = statements(export_dir)
+        profile = read_export(export_dir, 'company_profile')
+        toplevel = read_export(export_dir, 'toplevel_info', report_types=('ReportsFinStatements',))
+        issues = read_export(export_dir, 'issues')
+        mapping = read_export(export_dir, 'financial_statement_column_mapping')
+        m['rows'] = len(df)
+
+    # Statements: every version of a statement, restated ones included. The latest one of a period is the one with the
+    # latest source date; on the same date a restatement (RES) wins.
+    with metrics.stage('star', table='dim_statement') as m:
+        for col in period_columns:
+            if col not in df.columns:
+                df[col] = pd.NA
+        df = df.drop(columns=[col for col in ['__index_level_0__'] if col in df.columns])
+        df['symbol'] = df['symbol'].astype('string')
+        df['company_key'] = keys.keys('company', df['symbol'])
+        df['period_key'] = keys.keys('period', natural_key(df, period_columns))
+        header = ['StatementType', 'UpdateTypeCode', 'SourceDate', 'StatementDate', 'Source']
+        header = [col for col in header if col in df.columns]
+        df['statement_key'] = keys.keys('statement', natural_key(df, ['symbol'] + period_columns + header))
+
+        restated = (df['UpdateTypeCode'].astype('string') == 'RES').fillna(False) if 'UpdateTypeCode' in df.columns else False
+        ordered = df.assign(_restated=restated).sort_values(['SourceDate', '_restated'] if 'SourceDate' in df.columns else ['_restated'], na_position='first', kind='stable')
+        latest = ~ordered.duplicated(['symbol', 'StatementType', 'period_key'], keep='last')
+        df['latest'] = latest.reindex(df.index)
+
+        described = [col for col in statement_columns if col in df.columns and col not in period_columns]
+        tables['dim_statement'] = df[['statement_key', 'company_key', 'period_key'] + described + ['latest']].drop_duplicates('statement_key', keep='last').sort_values('statement_key').reset_index(drop=True)
+        m['rows'] = len(tables['dim_statement'])
+
+    # Facts: one row per statement and COA code that has a value
+    with metrics.stage('star', table='fact_financials') as m:
+        coa_columns = [col for col in df.columns if col not in header_columns + ['company_key', 'period_key', 'statement_key', 'latest']]
+        values = df[coa_columns].to_numpy(dtype='float64')
+        rows, cols = np.nonzero(~np.isnan(values))
+        facts = pd.DataFrame({
+            'company_key': df['company_key'].to_numpy()[rows],
+            'period_key': df['period_key'].to_numpy()[rows],
+            'statement_key': df['statement_key'].to_numpy()[rows],
+            'StatementType': df['StatementType'].astype('string').to_numpy()[rows],
+            'COA': np.array(coa_columns, dtype=object)[cols],
+            'value': values[rows, cols],
+        })
+        facts['coa_key'] = keys.keys('coa', natural_key(facts, ['StatementType', 'COA']))
+        tables['fact_financials'] = facts[['company_key', 'period_key', 'coa_key', 'statement_key', 'value']].drop_duplicates(['statement_key', 'coa_key'], keep='last')
+        m['rows'] = len(tables['fact_financials'])
+
+    with metrics.stage('star', table='dim_period') as m:
+        periods = df[['period_key'] + period_columns].drop_duplicates('period_key')
+        tables['dim_period'] = periods.sort_values('period_key').reset_index(drop=True)
+        m['rows'] = len(periods)
+
+    # COA line items: the codes of the facts, described by the column mapping of the statements. Companies can
+    # describe the same code differently; the most common description is used.
+    with metrics.stage('star', table='dim_coa') as m:
+        coa = facts[['coa_key', 'StatementType', 'COA']].drop_duplicates('coa_key')
+        if mapping is not None and len(mapping):
+            descriptions = (mapping.rename(columns={'ColumnCode': 'COA'}).astype({'StatementType': 'string', 'COA': 'string'})
+                            .groupby(['StatementType', 'COA'])['ColumnDesc'].agg(lambda s: s.value_counts().index[0] if s.notna().any() else None).reset_index())
+            coa = coa.astype({'StatementType': 'string', 'COA': 'string'}).merge(descriptions, on=['StatementType', 'COA'], how='left')
+        tables['dim_coa'] = coa.sort_values('coa_key').reset_index(drop=True)
+        m['rows'] = len(coa)
+
+    # Companies: the company profile of the estimates and the top-level information of the statements
+    with metrics.stage('star', table='dim_company') as m:
+        symbols = set(df['symbol'].dropna()) | (set(issues['symbol'].dropna()) if issues is not None else set())
+        company = None
+        for source in (profile, toplevel):
+            if source is None or not len(source):
+                continue
+            source = latest_first(source).astype({'symbol': 'string'}).drop_duplicates('symbol').drop(columns=['reportType'])
+            symbols |= set(source['symbol'].dropna())
+            company = source if company is None else company.merge(source[['symbol'] + [col for col in source.columns if col not in company.columns]], on='symbol', how='outer')
+        company = pd.DataFrame({'symbol': pd.Series(sorted(symbols), dtype='string')}).merge(company, on='symbol', how='left') if company is not None else pd.DataFrame({'symbol': pd.Series(sorted(symbols), dtype='string')})
+        company.insert(0, 'company_key', keys.keys('company', company['symbol']))
+        tables['dim_company'] = company.sort_values('company_key').reset_index(drop=True)
+        m['rows'] = len(company)
+
+    # Securities: the issues of the companies
+    if issues is not None and len(issues):
+        with metrics.stage('star', table='dim_security') as m:
+            security = latest_first(issues).astype({'symbol': 'string'}).drop_duplicates(['symbol', 'IssueID']).drop(columns=['reportType'])
+            security.insert(0, 'security_key', keys.keys('security', natural_key(security, ['symbol', 'IssueID'])))
+            security.insert(1, 'company_key', keys.keys('company', security['symbol']))
+            tables['dim_security'] = security.drop(columns=['symbol']).sort_values('security_key').reset_index(drop=True)
+            m['rows'] = len(security)
+
+    return tables, keys
+
+def main(export_dir: str = 'export', star_dir: str = None, metrics: pipeline_metrics = None):
+    metrics = pipeline_metrics() if metrics is None else metrics
+    star_dir = f'{export_dir}/star' if star_dir is None else star_dir
+    os.makedirs(star_dir, exist_ok=True)
+    start = time.monotonic()
+
+    tables, keys = build(export_dir, star_dir, metrics)
+    for name, table in tables.items():
+        with metrics.stage('export', output=name) as m:
+            path = f'{star_dir}/{name}.parquet'
+            table.to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+            m['rows'] = len(table)
+            m['bytes_written'] = os.path.getsize(path)
+        print(f'{name}: {len(table)} rows, {len(table.columns)} columns')
+    # The keys are saved last, so an interrupted run doesn't leave keys behind that no table refers to
+    keys.save()
+    print(f'Wrote the star schema to {star_dir} in {time.monotonic() - start:.1f}s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the financial statements of process-xml.py as a star schema: dimension tables with integer keys, and a long fact table.')
+    parser.add_argument('--export', default='export', help='Export directory of process-xml.py (default: export)')
+    parser.add_argument('--output', help='Directory to write the star schema to (default: <export>/star)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    main(export_dir=args.export, star_dir=args.output, metrics=instrumentation.from_arguments(args, 'export-star-schema'))
@@ -0,0 +1,76 @@
+import hashlib
+import os
+
+# The export files that are loaded into the SQL database, and their display names: export file name -> display name
+files_needed = {
+    "ReportsFinStatements_balance_sheet_annual": "Balance Sheet (Annual)",
+    "ReportsFinStatements_balance_sheet_interim": "Balance Sheet (Interim)",
+    "ReportsFinStatements_cash_flow_annual": "Cash Flow (Annual)",
+    "ReportsFinStatements_cash_flow_interim": "Cash Flow (Interim)",
+    "ReportsFinStatements_derived_metrics": "Derived Metrics (Interim)",
+    "ReportsFinStatements_derived_ratios": "Derived Ratios (Interim)",
+    "ReportsFinStatements_financial_statement_column_mapping": "Column Mapping",
+    "ReportsFinStatements_income_statement_annual": "Income Statement (Annual)",
+    "ReportsFinStatements_income_statement_interim": "Income Statement (Interim)",
+    "ReportsFinStatements_issues": "Stock Issues Financial Statements",
+    "ReportsFinStatements_toplevel_info": "Toplevel Information",
+    "ReportSnapshot_actuals_annual": "Actuals (Annual)",
+    "ReportSnapshot_actuals_interim": "Actuals (Interim)",
+    "ReportSnapshot_company_profile": "Company Profile",
+    "ReportSnapshot_fiscal_year_estimates_annual": "Fiscal Year Estimates (Annual)",
+    "ReportSnapshot_fiscal_year_estimates_interim": "Fiscal Year Estimates (Interim)",
+    "ReportSnapshot_forecast_data": "Forecast Data",
+    "ReportSnapshot_issues": "Stock Issues Snapshot",
+    "ReportSnapshot_net_profit_estimates": "Net Profit Estimates",
+    "ReportSnapshot_periods_annual": "Periods (Annual)",
+    "ReportSnapshot_periods_interim": "Periods (Interim)",
+    "ReportSnapshot_security_info": "Security Information",
+    "Prices_history": "Price History",
+}
+
+# The columns of the financial statements that describe the statement; all other columns of the statements (but
+# symbol and reportType) are COA codes
+statement_columns = ['PeriodLength', 'periodType', 'UpdateType', 'StatementDate', 'Source', 'periodTypeCode', 'UpdateTypeCode', 'SourceDate', 'StatementType',
+                     'FiscalPeriodType', 'FiscalPeriodEndDate', 'FiscalPeriodYear', 'FiscalPeriodNumber']
+
+# The natural key of the rows of every table, by sub-report. All tables are also keyed by symbol and reportType.
+statement_keys = ['FiscalPeriodYear', 'FiscalPeriodNumber', 'FiscalPeriodEndDate', 'StatementType']
+natural_keys = {
+    'balance_sheet_annual': statement_keys,
+    'balance_sheet_interim': statement_keys,
+    'cash_flow_annual': statement_keys,
+    'cash_flow_interim': statement_keys,
+    'derived_metrics': ['StatementType', 'COA', 'FiscalPeriodEndDate'],
+    'derived_ratios': ['FiscalPeriodEndDate'],
+    'income_statement_annual': statement_keys,
+    'income_statement_interim': statement_keys,
+    'financial_statement_column_mapping': ['StatementType', 'ColumnCode'],
+    'issues': ['IssueID'],
+    'toplevel_info': [],
+    'actuals_annual': ['actualType', 'fYear', 'endMonth', 'endCalYear'],
+    'actuals_interim': ['actualType', 'fYear', 'endMonth', 'endCalYear'],
+    'company_profile': [],
+    'fiscal_year_estimates_annual': ['type', 'fYear', 'endMonth', 'endCalYear'],
+    'fiscal_year_estimates_interim': ['type', 'fYear', 'endMonth', 'endCalYear'],
+    'forecast_data': [],
+    'net_profit_estimates': ['type'],
+    'periods_annual': ['fYear'],
+    'periods_interim': ['fYear', 'periodNum', 'endCalYear', 'endMonth'],
+    'security_info': ['code'],
+    'history': ['Date'],
+}
+
+def table_keys(table, columns):
+    subreport_type = table.split('_', 1)[1]
+    return [key for key in ['symbol', 'reportType'] + natural_keys.get(subreport_type, []) if key in columns]
+
+def export_version(path):
+    """The version of an export file or dataset: a hash of its contents, which changes whenever it is written with other rows."""
+    digest = hashlib.sha256()
+    files = [path] if os.path.isfile(path) else sorted(os.path.join(root, file) for root, _, names in os.walk(path) for file in names)
+    for file in files:
+        digest.update(os.path.relpath(file, path).encode())
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
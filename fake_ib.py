@@ -0,0 +1,83 @@
+import asyncio
+import os
+import random
+from ib_insync import RequestError
+
+
+class fake_ib():
+    """
+    Local stand-in for the ib_insync IB client, so the fetcher can be run and benchmarked without TWS or a gateway.
+
+    Fundamental data is served from a fixture directory with the same layout as the fundamentals directory
+    (<fixture_dir>/<symbol>/<report>.xml), after a simulated latency of `latency` +/- `jitter` seconds.
+    Like IB, an unknown ticker or report is an error 430. Like ib_insync, errors are raised as a RequestError if
+    RaiseRequestErrors is set, and otherwise result in an empty list.
+    If disconnect_after is given, the connection drops after that many requests: the request that is answered last
+    and all later ones fail with a ConnectionError.
+    If pacing_every is given, every pacing_every-th request is refused with a pacing violation (IB error 100). If
+    empty_every is given, every empty_every-th request gets an empty response instead of its report.
+    """
+    def __init__(self, fixture_dir: str = 'fundamentals', latency: float = 0.5, jitter: float = 0.0, seed: int = None, disconnect_after: int = None,
+                 pacing_every: int = None, empty_every: int = None):
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.disconnect_after = disconnect_after
+        self.pacing_every = pacing_every
+        self.empty_every = empty_every
+        self.connected = False
+        self.RaiseRequestErrors = False
+
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def connect(self, host: str = '127.0.0.1', port: int = 7496, clientId: int = 1, **kwargs):
+        self.connected = True
+        return self
+
+    async def connectAsync(self, host: str = '127.0.0.1', port: int = 7496, clientId: int = 1, **kwargs):
+        return self.connect(host, port, clientId)
+
+    def disconnect(self):
+        self.connected = False
+
+    def isConnected(self):
+        return self.connected
+
+    async def reqFundamentalDataAsync(self, contract, reportType: str, fundamentalDataOptions: list = []):
+        if not self.connected:
+            raise ConnectionError('Not connected')
+
+        self.requests += 1
+        request = self.requests
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(max(0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        finally:
+            self.in_flight -= 1
+
+        if self.disconnect_after is not None and self.requests >= self.disconnect_after:
+            self.connected = False
+        if not self.connected:
+            raise ConnectionError('Connection lost')
+        if self.pacing_every is not None and request % self.pacing_every == 0:
+            return self._error(request, 100, 'Max rate of messages per second has been exceeded')
+        if self.empty_every is not None and request % self.empty_every == 0:
+            return ''
+
+        path = os.path.join(self.fixture_dir, contract.symbol, f'{reportType}.xml')
+        if not os.path.exists(path):
+            return self._error(request, 430, 'We are sorry, but fundamentals data for the security specified is not available')
+        with open(path, 'r') as f:
+            return f.read()
+
+    def _error(self, request, code, message):
+        if self.RaiseRequestErrors:
+            raise RequestError(request, code, message)
+        return []
+
+    def reqFundamentalData(self, contract, reportType: str, fundamentalDataOptions: list = []):
+        return asyncio.get_event_loop().run_until_complete(self.reqFundamentalDataAsync(contract, reportType, fundamentalDataOptions))
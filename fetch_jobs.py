@@ -0,0 +1,83 @@
+import sqlite3
+import time
+
+
+class fetch_job_queue():
+    """
+    Persistent state of the fundamentals retrieval, one job per (symbol, report), stored in SQLite.
+
+    Every result is committed as soon as it comes in, so an interrupted run can be resumed without requesting
+    anything twice. Failed requests are retried with exponential backoff. Tickers for which IB has no data are
+    remembered as 'not_found' and only requested again after not_found_ttl seconds.
+    """
+    def __init__(self, path: str = 'fetch_jobs.sqlite', backoff: float = 60, max_backoff: float = 24 * 3600, not_found_ttl: float = 30 * 24 * 3600):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.not_found_ttl = not_found_ttl
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS fetch_jobs (
+                symbol TEXT NOT NULL,
+                report TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                next_eligible REAL NOT NULL DEFAULT 0,
+                updated REAL,
+                PRIMARY KEY (symbol, report)
+            )''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, symbol: str, report: str, status: str = 'pending', next_eligible: float = 0):
+        # Existing jobs keep their state
+        self.connection.execute(
+            'INSERT OR IGNORE INTO fetch_jobs (symbol, report, status, next_eligible, updated) VALUES (?, ?, ?, ?, ?)',
+            (symbol, report, status, next_eligible, time.time()))
+        self.connection.commit()
+
+    def get(self, symbol: str, report: str):
+        row = self.connection.execute(
+            'SELECT status, attempts, last_error, next_eligible FROM fetch_jobs WHERE symbol = ? AND report = ?',
+            (symbol, report)).fetchone()
+        return None if row is None else dict(zip(('status', 'attempts', 'last_error', 'next_eligible'), row))
+
+    def reset(self, symbol: str, report: str):
+        """Request the report again on the next run, regardless of its current state."""
+        self._update(symbol, report, 'pending', 0, None, 0)
+
+    def eligible(self, now: float = None):
+        """All jobs that should be requested now: pending jobs, and failed or not found jobs whose wait is over."""
+        now = time.time() if now is None else now
+        return self.connection.execute(
+            "SELECT symbol, report FROM fetch_jobs WHERE status != 'done' AND next_eligible <= ? ORDER BY next_eligible, symbol, report",
+            (now,)).fetchall()
+
+    def done(self, symbol: str, report: str):
+        self._update(symbol, report, 'done', 0, None, 0)
+
+    def not_found(self, symbol: str, report: str, now: float = None):
+        now = time.time() if now is None else now
+        self._update(symbol, report, 'not_found', 0, 'No data available', now + self.not_found_ttl)
+
+    def failed(self, symbol: str, report: str, error: str, now: float = None):
+        now = time.time() if now is None else now
+        job = self.get(symbol, report)
+        attempts = (job['attempts'] if job is not None else 0) + 1
+        wait = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        self._update(symbol, report, 'failed', attempts, error, now + wait)
+
+    def counts(self):
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM fetch_jobs GROUP BY status').fetchall())
+
+    def _update(self, symbol, report, status, attempts, last_error, next_eligible):
+        self.connection.execute('''
+            INSERT INTO fetch_jobs (symbol, report, status, attempts, last_error, next_eligible, updated) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (symbol, report) DO UPDATE SET
+                status = excluded.status, attempts = excluded.attempts, last_error = excluded.last_error,
+                next_eligible = excluded.next_eligible, updated = excluded.updated''',
+            (symbol, report, status, attempts, last_error, next_eligible, time.time()))
+        self.connection.commit()
@@ -0,0 +1,167 @@
+import argparse
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import duckdb
+import pandas as pd
+import pyarrow.parquet as pq
+from export_tables import files_needed
+
+# The columns that identify the period of a row, in the order the rows of a company are sorted by
+period_columns = ['FiscalPeriodEndDate', 'FiscalPeriodYear', 'FiscalPeriodNumber', 'fYear', 'periodNum', 'endCalYear', 'endMonth']
+
+def quote(identifier: str):
+    return '"' + identifier.replace('"', '""') + '"'
+
+class fundamentals_db():
+    """
+    Embedded DuckDB over the Parquet files in the export directory, for analysis without the SQL database.
+
+    Every export file is a view named after the file (e.g. ReportSnapshot_ratios); the tables that are loaded into
+    the SQL database are also available under their display name (e.g. "Balance Sheet (Annual)"). The views read the
+    files when they are queried, so nothing is loaded up front. Call refresh() after process-xml.py added files.
+
+    Query results are cached, keyed by the query, its parameters and the content hashes of the export files it reads,
+    so a result is reused until one of those files changes. Up to cache_size results are kept in memory, and, if
+    cache_dir is given, also on disk for later sessions.
+    """
+    def __init__(self, export_dir: str = 'export', cache_size: int = 128, cache_dir: str = None):
+        self.export_dir = export_dir
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.connection = duckdb.connect()
+        self.files = {}
+        self._hashes = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.refresh()
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(self):
+        """(Re)create the views for the export files that are there now."""
+        for name in self.files:
+            self.connection.execute(f'DROP VIEW IF EXISTS {quote(name)}')
+            if name in files_needed:
+                self.connection.execute(f'DROP VIEW IF EXISTS {quote(files_needed[name])}')
+
+        self.files = {}
+        for file in sorted(os.listdir(self.export_dir)):
+            if not file.endswith('.parquet'):
+                continue
+            name, path = file[:-len('.parquet')], os.path.join(self.export_dir, file)
+            # The row numbers pandas stored along with the rows are left out
+            exclude = ' EXCLUDE (__index_level_0__)' if '__index_level_0__' in pq.read_schema(path).names else ''
+            select = f"SELECT *{exclude} FROM read_parquet('{path.replace(chr(39), chr(39) * 2)}')"
+            self.connection.execute(f'CREATE VIEW {quote(name)} AS {select}')
+            if name in files_needed:
+                self.connection.execute(f'CREATE VIEW {quote(files_needed[name])} AS {select}')
+            self.files[name] = path
+
+    def tables(self):
+        """The export files that can be queried, with their display names (None if they have none)."""
+        return {name: files_needed.get(name) for name in self.files}
+
+    def columns(self, table: str):
+        """The columns of a table (file or display name), and their DuckDB types."""
+        return {name: type for name, type, *_ in self.connection.execute(f'DESCRIBE {quote(table)}').fetchall()}
+
+    def query(self, sql: str, params: list = None, tables: list = None) -> pd.DataFrame:
+        """
+        Run a query and return the result as a DataFrame.
+        tables are the tables (file or display names) the query reads, for the cache; by default all of them.
+        """
+        names = self.files.keys() if tables is None else [self._file_name(table) for table in tables]
+        key = hashlib.sha256(json.dumps([sql, params, sorted((name, self._hash(name)) for name in names)], default=str).encode()).hexdigest()
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key].copy()
+
+        path = os.path.join(self.cache_dir, f'{key}.parquet') if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            self.hits += 1
+            result = pd.read_parquet(path)
+        else:
+            self.misses += 1
+            result = self.connection.execute(sql, params).df()
+            if path is not None:
+                result.to_parquet(path + '.tmp')
+                os.replace(path + '.tmp', path)
+
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result.copy()
+
+    def metric(self, table: str, column: str, latest: bool = False) -> pd.DataFrame:
+        """
+        One column of a table across all symbols, e.g. metric('ReportSnapshot_ratios', 'PEEXCLXOR'), with the
+        columns that identify the period of every value. With latest, only the value of the latest period of every
+        symbol is returned.
+        """
+        columns = self._check(table, [column])
+        periods = [c for c in period_columns if c in columns]
+        select = ', '.join(quote(c) for c in ['symbol'] + periods + [column])
+        sql = f'SELECT {select} FROM {quote(table)} WHERE {quote(column)} IS NOT NULL'
+        if latest and periods:
+            sql += f' QUALIFY row_number() OVER (PARTITION BY symbol ORDER BY {", ".join(quote(c) + " DESC NULLS LAST" for c in periods)}) = 1'
+        sql += ' ORDER BY ' + ', '.join(quote(c) for c in ['symbol'] + periods)
+        return self.query(sql, tables=[table])
+
+    def symbol(self, table: str, symbol: str, columns: list = None) -> pd.DataFrame:
+        """All rows of a table for one symbol, oldest period first, e.g. symbol('Balance Sheet (Annual)', 'AAPL')."""
+        all_columns = self._check(table, columns or [])
+        periods = [c for c in period_columns if c in all_columns]
+        select = '*' if columns is None else ', '.join(quote(c) for c in dict.fromkeys(['symbol'] + periods + list(columns)))
+        order = ' ORDER BY ' + ', '.join(quote(c) for c in periods) if periods else ''
+        return self.query(f'SELECT {select} FROM {quote(table)} WHERE symbol = ?{order}', [symbol], tables=[table])
+
+    def _check(self, table, columns):
+        # Unknown tables and columns are reported by name, instead of as a DuckDB error
+        if self._file_name(table) not in self.files:
+            raise KeyError(f'No table {table} in {self.export_dir}')
+        available = self.columns(table)
+        for column in columns:
+            if column not in available:
+                raise KeyError(f'Table {table} has no column {column}')
+        return available
+
+    def _file_name(self, table):
+        display_names = {display: name for name, display in files_needed.items()}
+        return display_names.get(table, table)
+
+    def _hash(self, name):
+        # The content hash of an export file, computed again only when the file was replaced
+        path = self.files.get(name)
+        if path is None or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        if self._hashes.get(path, (None,))[0] != (stat.st_mtime_ns, stat.st_size):
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha256.update(block)
+            self._hashes[path] = ((stat.st_mtime_ns, stat.st_size), sha256.hexdigest())
+        return self._hashes[path][1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the Parquet files in the export directory with DuckDB.')
+    parser.add_argument('sql', nargs='?', help='Query to run; the export files are views, e.g. SELECT * FROM ReportSnapshot_ratios (default: list the tables)')
+    parser.add_argument('--export', default='export', help='Directory with the Parquet files (default: export)')
+    args = parser.parse_args()
+
+    db = fundamentals_db(args.export)
+    if args.sql is None:
+        for name, display_name in db.tables().items():
+            print(name if display_name is None else f'{name} ("{display_name}")')
+    else:
+        with pd.option_context('display.max_rows', 100, 'display.width', 200):
+            print(db.query(args.sql))
+    db.close()
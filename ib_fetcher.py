@@ -0,0 +1,186 @@
+import asyncio
+import collections
+import hashlib
+import inspect
+import time
+from ib_insync import RequestError
+from instrumentation import pipeline_metrics
+
+# The errors with which IB answers when it has no data for a contract or report: no security definition found (200),
+# and no fundamentals data available (430). All other errors, e.g. pacing violations (100), are worth retrying.
+not_found_codes = {200, 430}
+
+
+class token_bucket():
+    """
+    Paces requests: on average at most `rate` requests per second, with bursts of up to `capacity` requests.
+    """
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def deliver(on_result, contract, report, data, error):
+    # on_result can be a coroutine function, to hand a result off without blocking the event loop
+    result = on_result(contract, report, data, error)
+    if inspect.isawaitable(result):
+        await result
+
+
+class fundamentals_fetcher():
+    """
+    Retrieves fundamental data concurrently, using the asynchronous API of ib_insync.
+
+    At most `max_in_flight` requests are outstanding at any time, and new requests are paced by a token bucket.
+    IB doesn't publish a separate limit for fundamental data; the defaults stay far below the API-wide limit of 50
+    messages per second. Requests that don't get an answer within `timeout` seconds are reported as failed.
+    The IB client should have RaiseRequestErrors set: otherwise every error, a pacing violation too, comes back as an
+    empty answer and can't be told apart from a report that doesn't exist.
+    Every request is recorded in metrics, with its latency and the size of the response, and labelled with the name
+    of the client if it has one.
+    """
+    def __init__(self, ib, max_in_flight: int = 5, rate: float = 2.0, burst: int = 5, timeout: float = 60, metrics: pipeline_metrics = None, client: str = None):
+        self.ib = ib
+        self.client = client
+        self.metrics = pipeline_metrics() if metrics is None else metrics
+        self.max_in_flight = max_in_flight
+        self.pacer = token_bucket(rate, burst)
+        self.timeout = timeout
+
+        self.requests = 0
+        self.failures = 0
+        self.latencies = []
+
+    async def fetch(self, contract, report):
+        """
+        Request a single report. Returns a tuple (data, error); error is None if the request succeeded.
+        data is an empty list if IB has no data for it (see not_found_codes).
+        """
+        await self.pacer.acquire()
+
+        start = time.monotonic()
+        try:
+            data = await asyncio.wait_for(self.ib.reqFundamentalDataAsync(contract, report), self.timeout)
+            error = None
+        except asyncio.TimeoutError:
+            data, error = None, f'No response within {self.timeout} seconds'
+        except RequestError as e:
+            data, error = ([], None) if e.code in not_found_codes else (None, str(e))
+        except Exception as e:
+            data, error = None, str(e)
+
+        self.requests += 1
+        self.latencies += [time.monotonic() - start]
+        if error is not None:
+            self.failures += 1
+        self.metrics.record('fetch', symbol=contract.symbol, report=report, client=self.client, wall_s=self.latencies[-1],
+                            bytes_read=len(data) if isinstance(data, str) else 0, error=error)
+        return data, error
+
+    async def fetch_all(self, requests, on_result):
+        """
+        Request all (contract, report) tuples in requests.
+        on_result(contract, report, data, error) is called for every request as soon as it completes; if it is a
+        coroutine function, the worker waits for it before it sends its next request.
+        """
+        requests = iter(requests)
+
+        async def worker():
+            # All workers take their next request from the same iterator
+            for contract, report in requests:
+                data, error = await self.fetch(contract, report)
+                await deliver(on_result, contract, report, data, error)
+
+        await asyncio.gather(*[worker() for _ in range(self.max_in_flight)])
+
+    def summary(self, elapsed: float):
+        mean_latency = sum(self.latencies) / len(self.latencies) if self.latencies else 0
+        return (f'{self.requests} requests ({self.failures} failed) in {elapsed:.1f} s: '
+                f'{self.requests / elapsed if elapsed > 0 else 0:.2f} requests/s, mean latency {mean_latency:.2f} s')
+
+
+def client_for(symbol: str, clients: list):
+    """
+    The client that retrieves a symbol: rendezvous hashing, so a symbol goes to the same client on every run, and
+    only the symbols of a client that is gone move to other clients.
+    """
+    return max(clients, key=lambda client: hashlib.sha256(f'{client}/{symbol}'.encode()).digest())
+
+class sharded_fetcher():
+    """
+    Spreads the requests over several IB connections, e.g. a number of clientIds on one or more gateways, each with
+    its own pacing. clients maps the name of every client (e.g. host:port:clientId) to its fundamentals_fetcher.
+
+    Every symbol is assigned to a client with client_for(). When a connection drops, the requests that were waiting
+    for it, and the ones that failed because of it, are assigned again among the clients that are still connected.
+    """
+    def __init__(self, clients: dict):
+        self.fetchers = clients
+        self.live = []
+
+    async def fetch_all(self, requests, on_result):
+        """Like fundamentals_fetcher.fetch_all: on_result(contract, report, data, error) is called for every request."""
+        self.live = [name for name, fetcher in self.fetchers.items() if fetcher.ib.isConnected()]
+        queues = {name: collections.deque() for name in self.fetchers}
+        workers = {name: 0 for name in self.fetchers}
+        tasks = set()
+
+        def assign(contract, report):
+            if not self.live:
+                tasks.add(asyncio.ensure_future(deliver(on_result, contract, report, None, 'No connection left')))
+                return
+            name = client_for(contract.symbol, self.live)
+            queues[name].append((contract, report))
+            # Clients whose workers are done get new ones when requests are moved to them
+            while workers[name] < self.fetchers[name].max_in_flight:
+                workers[name] += 1
+                tasks.add(asyncio.ensure_future(worker(name)))
+
+        def drop(name):
+            if name in self.live:
+                print(f'Lost the connection of client {name}, {len(queues[name])} requests are moved to other clients')
+                self.live.remove(name)
+            moved, queues[name] = queues[name], collections.deque()
+            for contract, report in moved:
+                assign(contract, report)
+
+        async def worker(name):
+            fetcher = self.fetchers[name]
+            try:
+                while name in self.live and queues[name]:
+                    contract, report = queues[name].popleft()
+                    data, error = await fetcher.fetch(contract, report)
+                    if error is not None and not fetcher.ib.isConnected():
+                        drop(name)
+                        assign(contract, report)
+                        return
+                    await deliver(on_result, contract, report, data, error)
+            finally:
+                workers[name] -= 1
+
+        for contract, report in requests:
+            assign(contract, report)
+        while tasks:
+            done, _ = await asyncio.wait(tasks)
+            tasks -= done
+            for task in done:
+                task.result()
+
+    def summary(self, elapsed: float):
+        lines = [f'{name}: ' + fetcher.summary(elapsed) + ('' if name in self.live else ' (disconnected)') for name, fetcher in self.fetchers.items()]
+        requests = sum(fetcher.requests for fetcher in self.fetchers.values())
+        return '\n'.join(lines + [f'Total: {requests} requests in {elapsed:.1f} s: {requests / elapsed if elapsed > 0 else 0:.2f} requests/s'])
@@ -0,0 +1,117 @@
+import contextlib
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None if it can't be determined."""
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        # Only Windows reports the peak; elsewhere the current RSS is a lower bound
+        if hasattr(memory, 'peak_wset'):
+            return memory.peak_wset / 2**20
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if os.uname().sysname == 'Darwin' else maxrss / 2**10
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    return None
+
+class pipeline_metrics():
+    """
+    Records wall time, rows, rows per second, bytes read and written and peak RSS of the stages of the pipeline, as
+    JSON lines in `path`. Every line is labelled with the script, the stage, and whatever labels the stage was given,
+    e.g. symbol, report and subreport.
+
+    The object is small and picklable, so it can be handed to worker processes: every record is appended to the file
+    on its own. Without a path nothing is written.
+
+    If profile_symbol is given, profile() runs cProfile or tracemalloc around the work for that symbol only, and
+    writes the result next to the metrics file.
+    """
+    def __init__(self, path: str = None, script: str = None, profile_symbol: str = None, profiler: str = 'cprofile'):
+        self.path = path
+        self.script = script
+        self.profile_symbol = profile_symbol
+        self.profiler = profiler
+
+    def record(self, stage: str, **fields):
+        if self.path is None:
+            return
+        record = {'time': datetime.now().isoformat(), 'script': self.script, 'stage': stage, 'pid': os.getpid()}
+        record.update(fields)
+        if record.get('rows') is not None and record.get('wall_s'):
+            record['rows_per_s'] = record['rows'] / record['wall_s']
+        record['peak_rss_mb'] = peak_rss_mb()
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, **labels):
+        """
+        Time the body as a stage. The body can add fields such as rows, bytes_read and bytes_written to the yielded dict:
+            with metrics.stage('parse', symbol=comp) as m:
+                m['bytes_read'] = ...
+        """
+        fields = dict(labels)
+        start = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields['error'] = repr(e)
+            raise
+        finally:
+            self.record(stage, wall_s=time.perf_counter() - start, **fields)
+
+    @contextlib.contextmanager
+    def profile(self, symbol: str, name: str):
+        if self.profile_symbol is None or symbol != self.profile_symbol:
+            yield
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.path)) if self.path is not None else os.getcwd()
+        if self.profiler == 'tracemalloc':
+            tracemalloc.start()
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                with open(os.path.join(directory, f'profile-{name}.txt'), 'w') as f:
+                    f.write(f'Peak traced memory: {peak / 2**20:.1f} MB\n')
+                    for statistic in snapshot.statistics('lineno')[:25]:
+                        f.write(f'{statistic}\n')
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(directory, f'profile-{name}.prof'))
+
+def add_arguments(parser):
+    """Add the --metrics, --profile-symbol and --profiler options to the argument parser of a script."""
+    parser.add_argument('--metrics', help='Append per-stage timings, row counts, bytes and peak memory to this file, as JSON lines')
+    parser.add_argument('--profile-symbol', help='Profile the work for this symbol only; the profile is written next to the --metrics file')
+    parser.add_argument('--profiler', choices=['cprofile', 'tracemalloc'], default='cprofile', help='Profiler used for --profile-symbol (default: cprofile)')
+
+def from_arguments(args, script: str):
+    return pipeline_metrics(args.metrics, script, args.profile_symbol, args.profiler)
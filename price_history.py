@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from datetime import date, timedelta
+import pandas as pd
+from instrumentation import pipeline_metrics
+
+# The columns of a day of price history; Close is adjusted for splits, Adj Close for dividends as well
+price_columns = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume', 'Dividends', 'Stock Splits']
+
+def yahoo_symbol(symbol: str):
+    # Yahoo writes share classes and units with a dash: IIAC.U -> IIAC-U
+    return symbol.replace('.', '-')
+
+def yahoo_download(symbols: list, start: date, end: date):
+    """
+    Download the daily price history of symbols from start up to (not including) end from Yahoo Finance, in a single
+    multi-ticker request. Returns a dict symbol -> DataFrame with price_columns, indexed by date; symbols Yahoo has no
+    prices for are left out.
+    """
+    import yfinance as yf
+
+    tickers = {yahoo_symbol(symbol): symbol for symbol in symbols}
+    df = yf.download(list(tickers), start=start.isoformat(), end=end.isoformat(), actions=True, auto_adjust=False, group_by='ticker', progress=False, threads=True)
+    if df is None or df.empty:
+        return {}
+
+    result = {}
+    for ticker, symbol in tickers.items():
+        if isinstance(df.columns, pd.MultiIndex):
+            if ticker not in df.columns.get_level_values(0):
+                continue
+            prices = df[ticker]
+        else:
+            prices = df
+        prices = prices.reindex(columns=price_columns).dropna(subset=['Open', 'High', 'Low', 'Close'], how='all')
+        if not prices.empty:
+            prices.index = pd.to_datetime(prices.index).tz_localize(None).normalize()
+            result[symbol] = prices
+    return result
+
+class recorded_prices():
+    """
+    Stand-in for yahoo_download that serves recorded responses instead of going to the network, for testing and
+    benchmarking: the history of every symbol is read from <fixture_dir>/<symbol>.csv and cut to the requested range.
+    Like Yahoo, a symbol without a fixture gets no prices. The requests are counted, per call and per symbol.
+    """
+    def __init__(self, fixture_dir: str = 'price_fixtures'):
+        self.fixture_dir = fixture_dir
+        self.calls = 0
+        self.requests = []
+
+    def __call__(self, symbols: list, start: date, end: date):
+        self.calls += 1
+        result = {}
+        for symbol in symbols:
+            self.requests += [(symbol, start, end)]
+            path = os.path.join(self.fixture_dir, f'{symbol}.csv')
+            if not os.path.exists(path):
+                continue
+            prices = pd.read_csv(path, index_col=0, parse_dates=True).reindex(columns=price_columns)
+            prices = prices[(prices.index >= pd.Timestamp(start)) & (prices.index < pd.Timestamp(end))]
+            if not prices.empty:
+                result[symbol] = prices
+        return result
+
+def recording(download, fixture_dir: str):
+    """Wrap a download function so the responses are also written to fixture_dir, in the format of recorded_prices."""
+    os.makedirs(fixture_dir, exist_ok=True)
+
+    def download_and_record(symbols, start, end):
+        result = download(symbols, start, end)
+        for symbol, prices in result.items():
+            path = os.path.join(fixture_dir, f'{symbol}.csv')
+            if os.path.exists(path):
+                prices = pd.concat([pd.read_csv(path, index_col=0, parse_dates=True), prices])
+                prices = prices[~prices.index.duplicated(keep='last')].sort_index()
+            prices.to_csv(path, index_label='Date')
+        return result
+    return download_and_record
+
+class price_cache():
+    """
+    Append-only, per-symbol cache of daily price history in Parquet.
+
+    Every download adds a part file to the directory of the symbol (<cache_dir>/<symbol>/<first>_<last>.parquet); parts
+    are never changed afterwards, and the last cached day can be read from the file names. update() only downloads the
+    days after that, and only completed days: the prices of today can still change. Symbols that are missing the same
+    range are downloaded together, batch_size symbols per request.
+
+    A dividend lowers the adjusted closing prices (Adj Close) of all earlier days by the dividend relative to the close
+    of the day before. The parts are kept as they were downloaded, and history() applies the dividends of every later
+    part to the Adj Close of the earlier ones. A stock split changes the split-adjusted prices of all earlier days as
+    well; when a download contains a split for a symbol that was cached already, the history of that symbol is dropped
+    and downloaded again in full, together with the other symbols that had a split.
+
+    Symbols that Yahoo has no prices for at all are kept in <cache_dir>/no_prices.json, with the day they were last
+    requested, and aren't requested again until retry_days later.
+    """
+    def __init__(self, cache_dir: str = 'prices', download=yahoo_download, batch_size: int = 50, start: date = date(2000, 1, 1), retry_days: int = 7,
+                 metrics: pipeline_metrics = None):
+        self.cache_dir = cache_dir
+        self.download = download
+        self.batch_size = batch_size
+        self.start = start
+        self.retry_days = retry_days
+        self.metrics = pipeline_metrics() if metrics is None else metrics
+        os.makedirs(cache_dir, exist_ok=True)
+        self.no_prices_path = os.path.join(cache_dir, 'no_prices.json')
+        self.no_prices = {}
+        if os.path.exists(self.no_prices_path):
+            with open(self.no_prices_path, 'r') as f:
+                self.no_prices = json.load(f)
+
+    def _parts(self, symbol):
+        directory = os.path.join(self.cache_dir, symbol)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, file) for file in os.listdir(directory) if file.endswith('.parquet'))
+
+    def last_date(self, symbol: str):
+        """The last day in the cache for a symbol, or None if there is none."""
+        parts = self._parts(symbol)
+        return max(date.fromisoformat(os.path.basename(part)[:-len('.parquet')].split('_')[1]) for part in parts) if parts else None
+
+    def missing(self, symbols: list, today: date = None):
+        """The first day that has to be downloaded for each symbol that isn't up to date: symbol -> date."""
+        today = date.today() if today is None else today
+        result = {}
+        for symbol in symbols:
+            last = self.last_date(symbol)
+            if last is None and symbol in self.no_prices and date.fromisoformat(self.no_prices[symbol]) + timedelta(days=self.retry_days) > today:
+                continue
+            start = self.start if last is None else last + timedelta(days=1)
+            if start < today:
+                result[symbol] = start
+        return result
+
+    def _append(self, symbol, prices):
+        directory = os.path.join(self.cache_dir, symbol)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{prices.index.min():%Y-%m-%d}_{prices.index.max():%Y-%m-%d}.parquet')
+        prices.rename_axis('Date').to_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def update(self, symbols: list, today: date = None):
+        """Download what is missing for symbols; returns the number of days added per symbol."""
+        today = date.today() if today is None else today
+        added = {symbol: 0 for symbol in symbols}
+        pending = self.missing(symbols, today)
+
+        while pending:
+            # Symbols that are missing the same range are requested together
+            by_start = {}
+            for symbol, start in pending.items():
+                by_start.setdefault(start, []).append(symbol)
+            pending = {}
+
+            for start, group in sorted(by_start.items()):
+                for i in range(0, len(group), self.batch_size):
+                    batch = group[i:i + self.batch_size]
+                    with self.metrics.stage('prices', symbols=len(batch), start=start, end=today) as m:
+                        try:
+                            result = self.download(batch, start, today)
+                        except Exception as e:
+                            print(f'Failed to download prices for {", ".join(batch)}: {e}')
+                            continue
+                        m['rows'] = 0
+                        for symbol in batch:
+                            if symbol not in result and self.last_date(symbol) is None:
+                                self.no_prices[symbol] = today.isoformat()
+                        for symbol, prices in result.items():
+                            self.no_prices.pop(symbol, None)
+                            last = self.last_date(symbol)
+                            prices = prices[prices.index < pd.Timestamp(today)]
+                            if last is not None:
+                                prices = prices[prices.index > pd.Timestamp(last)]
+                                if (prices['Stock Splits'].fillna(0) != 0).any():
+                                    print(f'{symbol} had a stock split, its price history is downloaded again')
+                                    shutil.rmtree(os.path.join(self.cache_dir, symbol))
+                                    added[symbol] = 0
+                                    pending[symbol] = self.start
+                                    continue
+                            if prices.empty:
+                                continue
+                            self._append(symbol, prices)
+                            added[symbol] += len(prices)
+                            m['rows'] += len(prices)
+        self._save_no_prices()
+        return added
+
+    def _save_no_prices(self):
+        with open(self.no_prices_path + '.tmp', 'w') as f:
+            json.dump(self.no_prices, f, sort_keys=True)
+        os.replace(self.no_prices_path + '.tmp', self.no_prices_path)
+
+    def history(self, symbol: str):
+        """The cached price history of a symbol, oldest day first."""
+        parts = self._parts(symbol)
+        if not parts:
+            return pd.DataFrame(columns=price_columns, index=pd.DatetimeIndex([], name='Date'))
+        frames = [pd.read_parquet(part) for part in parts]
+        prices = pd.concat([df.assign(_part=n) for n, df in enumerate(frames)]).sort_index()
+        prices = prices[~prices.index.duplicated(keep='last')]
+
+        # The Adj Close of a part includes the dividends up to its download; the dividends of the later parts are
+        # applied here, the way Yahoo adjusts for them: by 1 - dividend / close of the day before
+        dividends = prices['Dividends'].fillna(0)
+        factors = (1 - dividends / prices['Close'].shift(1)).where((dividends != 0) & prices['Close'].shift(1).notna(), 1.0)
+        part_factors = factors.groupby(prices['_part']).prod().reindex(range(len(frames)), fill_value=1.0)
+        later = part_factors[::-1].cumprod()[::-1].shift(-1, fill_value=1.0)
+        prices['Adj Close'] = prices['Adj Close'] * prices['_part'].map(later).to_numpy()
+        return prices.drop(columns='_part')
+
+    def export(self, path: str, symbols: list = None):
+        """
+        Write the cached history of symbols (by default all of them) to a single Parquet file, with a symbol column, to
+        be joined with the fundamentals in the export directory. Returns the number of rows.
+        """
+        symbols = sorted(entry for entry in os.listdir(self.cache_dir) if os.path.isdir(os.path.join(self.cache_dir, entry))) if symbols is None else symbols
+        frames = [self.history(symbol).reset_index().assign(symbol=symbol) for symbol in symbols]
+        frames = [df for df in frames if not df.empty]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['Date'] + price_columns + ['symbol'])
+        df = df[['symbol', 'Date'] + price_columns]
+        df.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        return len(df)
+
+def update_prices(symbols: list, cache_dir: str = 'prices', export_dir: str = 'export', download=yahoo_download, batch_size: int = 50, retry_days: int = 7,
+                  metrics: pipeline_metrics = None):
+    """Bring the price cache of symbols up to date, and write it to Prices_history.parquet in export_dir."""
+    start = time.monotonic()
+    cache = price_cache(cache_dir, download=download, batch_size=batch_size, retry_days=retry_days, metrics=metrics)
+    added = cache.update(symbols)
+    os.makedirs(export_dir, exist_ok=True)
+    rows = cache.export(os.path.join(export_dir, 'Prices_history.parquet'), symbols)
+    print(f'Prices: {sum(added.values())} days added for {sum(1 for n in added.values() if n)} of {len(symbols)} symbols, '
+          f'{rows} rows exported in {time.monotonic() - start:.1f} s')
+    return added
+
+if __name__ == '__main__':
+    import instrumentation
+
+    parser = argparse.ArgumentParser(description='Download daily price history from Yahoo Finance into a local per-symbol cache.')
+    parser.add_argument('symbols', nargs='+', help='Symbols to bring up to date')
+    parser.add_argument('--cache', default='prices', help='Directory of the price cache (default: prices)')
+    parser.add_argument('--export', default='export', help='Directory to write Prices_history.parquet to (default: export)')
+    parser.add_argument('--batch-size', type=int, default=50, help='Number of symbols per download request (default: 50)')
+    parser.add_argument('--retry-days', type=int, default=7, help='Days before symbols without prices are requested again (default: 7)')
+    parser.add_argument('--fake-prices', metavar='FIXTURE_DIR', help='Don\'t download, but serve the recorded responses in FIXTURE_DIR instead (for testing and benchmarking)')
+    parser.add_argument('--record', metavar='FIXTURE_DIR', help='Also write the downloaded responses to FIXTURE_DIR, for --fake-prices')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    download = recorded_prices(args.fake_prices) if args.fake_prices is not None else yahoo_download
+    if args.record is not None:
+        download = recording(download, args.record)
+    update_prices(args.symbols, args.cache, args.export, download, args.batch_size, args.retry_days, instrumentation.from_arguments(args, 'price_history'))
@@ -1,56 +1,287 @@
-import xml.etree.ElementTree as ET
+import argparse
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-import pyodbc
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Float, Integer, String, Text, create_engine, inspect, text
 import urllib
+import instrumentation
+from export_tables import export_version, files_needed, table_keys
+from instrumentation import pipeline_metrics
 
 load_dotenv()
 
-server = os.getenv('FUNDAMENTAL_SQL_SERVER')
-database= os.getenv('FUNDAMENTAL_SQL_DATABASE')
-username = os.getenv('FUNDAMENTAL_SQL_LOGIN')
-password = os.getenv('FUNDAMENTAL_SQL_PASSWORD')
-driver= '{ODBC Driver 17 for SQL Server}'
-
-params = urllib.parse.quote_plus(f'DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE={database};UID={username};PWD={password}')
-engine = create_engine(f'mssql+pyodbc:///?odbc_connect={params}')
-
-# List all files in the 'export' directory
-files = os.listdir('export')
-
-files_needed = [
-    {
-        "ReportsFinStatements_balance_sheet_annual": "Balance Sheet (Annual)",
-        "ReportsFinStatements_balance_sheet_interim": "Balance Sheet (Interim)",
-        "ReportsFinStatements_cash_flow_annual": "Cash Flow (Annual)",
-        "ReportsFinStatements_cash_flow_interim": "Cash Flow (Interim)",
-        "ReportsFinStatements_financial_statement_column_mapping": "Column Mapping",
-        "ReportsFinStatements_income_statement_annual": "Income Statement (Annual)",
-        "ReportsFinStatements_income_statement_interim": "Income Statement (Interim)",
-        "ReportsFinStatements_issues": "Stock Issues Financial Statements",
-        "ReportsFinStatements_toplevel_info": "Toplevel Information",
-        "ReportSnapshot_actuals_annual": "Actuals (Annual)",
-        "ReportSnapshot_actuals_interim": "Actuals (Interim)",
-        "ReportSnapshot_company_profile": "Company Profile",
-        "ReportSnapshot_fiscal_year_estimates_annual": "Fiscal Year Estimates (Annual)",
-        "ReportSnapshot_fiscal_year_estimates_interim": "Fiscal Year Estimates (Interim)",
-        "ReportSnapshot_forecast_data": "Forecast Data",
-        "ReportSnapshot_issues": "Stock Issues Snapshot",
-        "ReportSnapshot_net_profit_estimates": "Net Profit Estimates",
-        "ReportSnapshot_periods_annual": "Periods (Annual)",
-        "ReportSnapshot_periods_interim": "Periods (Interim)",
-        "ReportSnapshot_security_info": "Security Information",
-    }
-]
-    
-# Loop through all files
-for file in files:
-    if file.endswith('.parquet') and file.replace('.parquet', '') in files_needed[0].keys():
-        
-        # Read the parquet file
-        df = pd.read_parquet(f'export/{file}')
-        # Save the dataframe to the SQL database
-        df.to_sql(file.replace('.parquet', ''), con=engine, if_exists='replace', index=False)
+def mssql_url():
+    server = os.getenv('FUNDAMENTAL_SQL_SERVER')
+    database= os.getenv('FUNDAMENTAL_SQL_DATABASE')
+    username = os.getenv('FUNDAMENTAL_SQL_LOGIN')
+    password = os.getenv('FUNDAMENTAL_SQL_PASSWORD')
 
+    params = urllib.parse.quote_plus(f'DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE={database};UID={username};PWD={password}')
+    return f'mssql+pyodbc:///?odbc_connect={params}'
+
+# Length of the text columns of the natural keys; SQL Server can't index unbounded text
+key_length = 100
+
+def sql_types(schema: pa.Schema, keys: list):
+    """
+    The SQL types of the columns of an Arrow schema. Tables are created from an empty DataFrame, which has lost the
+    types of the dates and the texts; the key columns get a bounded length, so they can be indexed.
+    """
+    types = {}
+    for field in schema:
+        t = pa.types
+        value_type = field.type.value_type if t.is_dictionary(field.type) else field.type
+        if t.is_date(value_type):
+            types[field.name] = Date()
+        elif t.is_timestamp(value_type):
+            types[field.name] = DateTime()
+        elif t.is_boolean(value_type):
+            types[field.name] = Boolean()
+        elif t.is_integer(value_type):
+            types[field.name] = BigInteger() if value_type.bit_width > 32 else Integer()
+        elif t.is_floating(value_type):
+            types[field.name] = Float(53)
+        elif t.is_string(value_type) or t.is_large_string(value_type):
+            types[field.name] = String(key_length) if field.name in keys else Text()
+    return types
+
+# Every row gets a hash of its values, so a merge can tell the rows that changed from the ones that didn't. The row
+# numbers are left out, as they shift when rows of another company are added or removed; so are the columns of the
+# delta files.
+unhashed_columns = ['__index_level_0__', 'change', 'run_id']
+
+def row_hashes(df: pd.DataFrame):
+    """The hash of every row, from the columns that have a value: a column without values doesn't change it."""
+    total = np.zeros(len(df), dtype='uint64')
+    for col in df.columns:
+        if col in unhashed_columns:
+            continue
+        values = df[col].astype('string')
+        hashes = pd.util.hash_pandas_object(col + '=' + values.fillna(''), index=False).to_numpy()
+        # A sum doesn't depend on the order of the columns; it wraps around
+        total += np.where(values.notna().to_numpy(), hashes, 0).astype('uint64')
+    return total.view('int64')
+
+def frames(parquet_file, batch_size):
+    # The contents of the Parquet file in batches, with the hash of every row
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        df = batch.to_pandas()
+        df['row_hash'] = row_hashes(df)
+        yield df
+
+def create_table(connection, schema: pa.Schema, name: str, keys: list, if_exists: str = 'fail'):
+    # The table of an export file, with the row_hash of frames(), indexed to look up rows by their hash
+    schema = schema.append(pa.field('row_hash', pa.int64()))
+    schema.empty_table().to_pandas().to_sql(name, con=connection, if_exists=if_exists, index=False, dtype=sql_types(schema, keys))
+    create_hash_index(connection, name)
+
+def create_hash_index(connection, name):
+    quote = connection.dialect.identifier_preparer.quote
+    columns = [column['name'] for column in inspect(connection).get_columns(name)]
+    connection.execute(text(f'CREATE INDEX {quote("ix_" + name + "_row_hash")} ON {quote(name)} ({", ".join(quote(c) for c in ["symbol", "row_hash"] if c in columns)})'))
+
+def load_replace(engine, path, table, batch_size):
+    """Replace the table with the contents of the Parquet file, inserting it in batches."""
+    parquet_file = pq.ParquetFile(path)
+    with engine.begin() as connection:
+        create_table(connection, parquet_file.schema_arrow, table, table_keys(table, parquet_file.schema_arrow.names), if_exists='replace')
+        for df in frames(parquet_file, batch_size):
+            df.to_sql(table, con=connection, if_exists='append', index=False, chunksize=batch_size)
+    return parquet_file.metadata.num_rows
+
+def stage(connection, parquet_file, staging, table, batch_size):
+    # Bulk insert the contents of the Parquet file into a new staging table for the table
+    create_table(connection, parquet_file.schema_arrow, staging, table_keys(table, parquet_file.schema_arrow.names), if_exists='replace')
+    for df in frames(parquet_file, batch_size):
+        df.to_sql(staging, con=connection, if_exists='append', index=False, chunksize=batch_size)
+
+def replace_rows(connection, dialect, parquet_file, staging, table, skip_columns: list = [], condition: str = '', by_key: bool = True):
+    """
+    Bring the rows of the table to the staged rows, and drop the staging table. skip_columns are staged columns that
+    aren't part of the table.
+    By key, the rows with the same natural key as a staged row are replaced by the staged rows (the ones that match
+    condition, if given). Otherwise the staged rows are all rows of the symbols in it, and are upserted: rows whose
+    natural key and values are both staged are kept as they are, the other rows of the staged symbols (changed rows,
+    and keys that have gone away) are deleted, and the staged rows that aren't in the table yet are inserted. The rows
+    of symbols that aren't staged are kept.
+    Returns the number of rows that were deleted and inserted.
+    """
+    quote = dialect.identifier_preparer.quote
+    inspector = inspect(connection)
+    staged_columns = [column for column in inspector.get_columns(staging) if column['name'] not in skip_columns]
+
+    # Create the table on the first load, and add the columns that are new in the export
+    if not inspector.has_table(table):
+        schema = parquet_file.schema_arrow
+        schema = pa.schema([field for field in schema if field.name not in skip_columns])
+        create_table(connection, schema, table, table_keys(table, schema.names))
+    existing = {column['name'] for column in inspector.get_columns(table)}
+    for column in staged_columns:
+        if column['name'] not in existing:
+            connection.execute(text(f'ALTER TABLE {quote(table)} ADD {quote(column["name"])} {column["type"].compile(dialect=dialect)}'))
+    if 'row_hash' not in existing:
+        create_hash_index(connection, table)
+
+    columns = ', '.join(quote(column['name']) for column in staged_columns)
+    t, s = quote(table), quote(staging)
+    if by_key:
+        # Replace the rows by natural key. Keys can be NULL, e.g. the FiscalPeriodNumber of annual statements.
+        keys = table_keys(table, [column['name'] for column in staged_columns])
+        if keys:
+            connection.execute(text(f'CREATE INDEX {quote("ix_" + staging)} ON {s} ({", ".join(quote(k) for k in keys)})'))
+        match = ' AND '.join(f'(s.{quote(k)} = {t}.{quote(k)} OR (s.{quote(k)} IS NULL AND {t}.{quote(k)} IS NULL))' for k in keys) or '1 = 1'
+        deleted = connection.execute(text(f'DELETE FROM {t} WHERE EXISTS (SELECT 1 FROM {s} s WHERE {match})')).rowcount
+        inserted = connection.execute(text(f'INSERT INTO {t} ({columns}) SELECT {columns} FROM {s}' + (f' WHERE {condition}' if condition else ''))).rowcount
+    else:
+        # The hash covers the natural key and all values, so a row with a staged hash is up to date
+        same = f's.{quote("symbol")} = {t}.{quote("symbol")} AND s.{quote("row_hash")} = {t}.{quote("row_hash")}'
+        deleted = connection.execute(text(f'DELETE FROM {t} WHERE {quote("symbol")} IN (SELECT {quote("symbol")} FROM {s}) '
+                                          f'AND NOT EXISTS (SELECT 1 FROM {s} s WHERE {same})')).rowcount
+        inserted = connection.execute(text(f'INSERT INTO {t} ({columns}) SELECT {columns} FROM {s} s WHERE NOT EXISTS (SELECT 1 FROM {t} WHERE {same})')).rowcount
+    connection.execute(text(f'DROP TABLE {s}'))
+    return deleted + inserted
+
+def load_merge(engine, path, table, batch_size):
+    """
+    Bring the table to the contents of the Parquet file, without taking it offline.
+    The rows are bulk inserted into a staging table first. Then, in a single transaction, the staged rows are upserted
+    into the table: only the rows that changed are touched, and the rows of symbols that aren't in the export are kept.
+    Unlike replace, the table itself is kept, with its indexes and permissions; columns that are new in the export
+    are added to it. Returns the number of rows that were deleted and inserted.
+    """
+    parquet_file = pq.ParquetFile(path)
+    with engine.begin() as connection:
+        stage(connection, parquet_file, f'{table}_staging', table, batch_size)
+        return replace_rows(connection, engine.dialect, parquet_file, f'{table}_staging', table, by_key=False)
+
+def applied_run(connection, dialect, table):
+    # The run id of the last delta file that was applied to the table (None if none was), and the export_version of
+    # the export file the table was last brought to; (None, None) if the table was never loaded by delta
+    column = dialect.identifier_preparer.quote('table')
+    if inspect(connection).has_table('change_runs') and 'version' not in {col['name'] for col in inspect(connection).get_columns('change_runs')}:
+        # Kept by a version that didn't record the export versions; the tables are merged in full once
+        connection.execute(text('DROP TABLE change_runs'))
+    if not inspect(connection).has_table('change_runs'):
+        connection.execute(text(f'CREATE TABLE change_runs ({column} VARCHAR(255) PRIMARY KEY, run_id VARCHAR(64) NULL, version VARCHAR(64) NOT NULL)'))
+        return None, None
+    row = connection.execute(text(f'SELECT run_id, version FROM change_runs WHERE {column} = :table'), {'table': table}).first()
+    return (row.run_id, row.version) if row else (None, None)
+
+def record_run(connection, dialect, table, run_id, version):
+    column = dialect.identifier_preparer.quote('table')
+    connection.execute(text(f'DELETE FROM change_runs WHERE {column} = :table'), {'table': table})
+    connection.execute(text(f'INSERT INTO change_runs ({column}, run_id, version) VALUES (:table, :run_id, :version)'),
+                       {'table': table, 'run_id': run_id, 'version': version})
+
+def load_delta(engine, path, table, batch_size):
+    """
+    Apply the delta files that process-xml.py --changes wrote for the table since the last one that was applied, one
+    run at a time, each in its own transaction: the rows with the keys in the delta are removed, and the inserted and
+    updated rows are added. The run id of the last applied delta and the export_version of the export file the table
+    was brought to are kept in the table change_runs; a table whose export file didn't change is skipped.
+    Every delta file records the version it was computed against, and is only applied on top of that version. When
+    the deltas can't bring the table to the version of the export file, it is merged from the export file in full
+    instead: when it wasn't loaded by delta before, or when a run without --changes wrote the export file (e.g. the
+    derived tables).
+    """
+    changes_dir = os.path.join(os.path.dirname(path), 'changes', table)
+    runs = sorted(file[:-len('.parquet')] for file in os.listdir(changes_dir) if file.endswith('.parquet')) if os.path.isdir(changes_dir) else []
+    version = export_version(path)
+
+    with engine.begin() as connection:
+        last_run, last_version = applied_run(connection, engine.dialect, table)
+    exists = inspect(engine).has_table(table)
+    if exists and last_version == version:
+        return 0
+
+    # The deltas since the last applied one, as long as each follows on the version before it
+    chain = []
+    current = last_version if exists else None
+    for run_id in [run for run in runs if last_run is None or run > last_run]:
+        parquet_file = pq.ParquetFile(os.path.join(changes_dir, f'{run_id}.parquet'))
+        metadata = parquet_file.schema_arrow.metadata or {}
+        if current is None or metadata.get(b'base_version', b'').decode() != current:
+            break
+        current = metadata.get(b'version', b'').decode()
+        chain += [(run_id, parquet_file)]
+
+    if current != version:
+        rows = load_merge(engine, path, table, batch_size)
+        with engine.begin() as connection:
+            record_run(connection, engine.dialect, table, runs[-1] if runs else None, version)
+        return rows
+
+    rows = 0
+    for run_id, parquet_file in chain:
+        metadata = parquet_file.schema_arrow.metadata
+        with engine.begin() as connection:
+            if parquet_file.metadata.num_rows > 0:
+                stage(connection, parquet_file, f'{table}_staging', table, batch_size)
+                replace_rows(connection, engine.dialect, parquet_file, f'{table}_staging', table, skip_columns=['change', 'run_id'],
+                             condition=f"{engine.dialect.identifier_preparer.quote('change')} <> 'delete'")
+            record_run(connection, engine.dialect, table, run_id, metadata[b'version'].decode())
+        rows += parquet_file.metadata.num_rows
+    return rows
+
+def load_table(engine, load, export_dir, table, batch_size, metrics: pipeline_metrics):
+    # Every table is loaded in its own transaction: a table that fails keeps its previous contents
+    path = f'{export_dir}/{table}.parquet'
+    if not os.path.exists(path):
+        return {'status': 'missing', 'rows': 0, 'seconds': 0.0}
+
+    start = time.monotonic()
+    try:
+        with metrics.stage('load', table=table) as m:
+            m['bytes_read'] = os.path.getsize(path)
+            rows = m['rows'] = load(engine, path, table, batch_size)
+    except Exception as e:
+        return {'status': 'failed', 'rows': 0, 'seconds': time.monotonic() - start, 'error': str(e).splitlines()[0]}
+    return {'status': 'loaded', 'rows': rows, 'seconds': time.monotonic() - start}
+
+def main(export_dir: str = 'export', database_url: str = None, mode: str = 'merge', batch_size: int = 10000, workers: int = 4, metrics: pipeline_metrics = None):
+    database_url = mssql_url() if database_url is None else database_url
+    # pyodbc sends every row in its own round trip, unless fast_executemany is on
+    options = {'fast_executemany': True} if database_url.startswith('mssql+pyodbc') else {}
+    # One connection per worker; connections that were dropped by the server are replaced before use
+    engine = create_engine(database_url, pool_size=workers, max_overflow=0, pool_pre_ping=True, **options)
+    load = {'merge': load_merge, 'replace': load_replace, 'delta': load_delta}[mode]
+    metrics = pipeline_metrics() if metrics is None else metrics
+
+    # The tables are loaded concurrently, most of the time is spent waiting on the database
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {table: executor.submit(load_table, engine, load, export_dir, table, batch_size, metrics) for table in files_needed}
+        results = {}
+        for table, future in futures.items():
+            results[table] = future.result()
+            result = results[table]
+            message = f"{files_needed[table]} ({table}): {result['status']}, {result['rows']} rows in {result['seconds']:.1f}s"
+            print(message + (f": {result['error']}" if 'error' in result else ''))
+
+    engine.dispose()
+    loaded = [result for result in results.values() if result['status'] == 'loaded']
+    metrics.record('run', wall_s=time.monotonic() - start, rows=sum(result['rows'] for result in loaded), tables=len(loaded),
+                   failed=[table for table, result in results.items() if result['status'] == 'failed'])
+    print(f"Loaded {sum(result['rows'] for result in loaded)} rows into {len(loaded)} of {len(files_needed)} tables in {time.monotonic() - start:.1f}s")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the Parquet files in the export directory into the SQL database.')
+    parser.add_argument('--export', default='export', help='Directory with the Parquet files (default: export)')
+    parser.add_argument('--database-url', help='SQLAlchemy URL of the database (default: the SQL Server in the FUNDAMENTAL_SQL_* environment variables)')
+    parser.add_argument('--mode', choices=['merge', 'replace', 'delta'], default='merge',
+                        help='Replace the rows through a staging table in a single transaction, keeping the table (merge), drop and recreate the tables (replace), or apply the delta files of process-xml.py --changes since the previous load, skipping the tables whose export file is unchanged (delta) (default: merge)')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Number of rows read and inserted at a time (default: 10000)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of tables loaded at the same time, and size of the connection pool (default: 4)')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    results = main(export_dir=args.export, database_url=args.database_url, mode=args.mode, batch_size=args.batch_size, workers=args.workers,
+                   metrics=instrumentation.from_arguments(args, 'process-parquet-save-to-sqldb'))
+    sys.exit(1 if any(result['status'] == 'failed' for result in results.values()) else 0)
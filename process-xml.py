@@ -1,64 +1,312 @@
 import xml.etree.ElementTree as ET
+import argparse
+import contextlib
+import hashlib
+import io
+import json
 import os
+import re
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import instrumentation
+from export_tables import export_version, statement_columns, table_keys
+from instrumentation import pipeline_metrics
+from xml_store import open_blob, xml_store
 
 
-# list all subdirectories in the "fundamentals" directory
-companies = [ name for name in os.listdir('fundamentals') if os.path.isdir(os.path.join('fundamentals', name)) ]
+# A single location step of the XPath subset used in the mappings, e.g. Ratio[@FieldName="NPRICE"]
+step_pattern = re.compile(r'([^/\[\]]+)((?:\[[^\]]*\])*)')
+predicate_pattern = re.compile(r'''\[\s*@([\w:.-]+)\s*=\s*(["'])(.*?)\2\s*\]''')
+
+def compile_path(path: str):
+    """
+    Split a mapping path into a list of (tag, predicates) steps.
+    Returns None for paths outside the supported subset (wildcards, '.', '//', positional predicates, ...);
+    those are still evaluated with findall.
+    """
+    steps = []
+    pos = 0
+    while pos < len(path):
+        match = step_pattern.match(path, pos)
+        if match is None:
+            return None
+        tag, predicate_string = match.group(1).strip(), match.group(2)
+        predicates = predicate_pattern.findall(predicate_string)
+        if tag in ('.', '..', '*') or ''.join(predicate_pattern.sub('', predicate_string).split()) != '':
+            return None
+        steps += [(tag, tuple((attribute, value) for attribute, _, value in predicates))]
+        pos = match.end()
+        if pos < len(path):
+            if path[pos] != '/':
+                return None
+            pos += 1
+            if pos == len(path) or path[pos] == '/':
+                return None
+    return steps if steps else None
+
+class extraction_node():
+    """
+    One location step of the compiled mappings.
+    Child elements are routed through a lookup keyed by (tag, attribute predicate), so each child is visited once,
+    regardless of the number of columns that are mapped below this step.
+    """
+    def __init__(self):
+        self.targets = []
+        self.children = {}
+        self.predicate_attributes = {}
+
+    def child(self, tag, predicates):
+        attribute, value = predicates[0] if predicates else (None, None)
+        if (tag, attribute) not in self.children:
+            self.children[(tag, attribute)] = {}
+            self.predicate_attributes.setdefault(tag, []).append(attribute)
+
+        candidates = self.children[(tag, attribute)].setdefault(value, [])
+        for remaining_predicates, node in candidates:
+            if remaining_predicates == predicates[1:]:
+                return node
+
+        node = extraction_node()
+        candidates += [(predicates[1:], node)]
+        return node
+
+    def matches(self, element):
+        for attribute in self.predicate_attributes.get(element.tag, ()):
+            value = None if attribute is None else element.get(attribute)
+            if attribute is not None and value is None:
+                continue
+            for remaining_predicates, node in self.children[(element.tag, attribute)].get(value, ()):
+                if all(element.get(a) == v for a, v in remaining_predicates):
+                    yield node
+
+# The column types used in the output schemas of the sub-reports
+number = pa.float64()
+integer = pa.int64()
+text = pa.string()
+date = pa.date32()
+timestamp = pa.timestamp('s')
+category = pa.dictionary(pa.int32(), pa.string())
+column_types = {str(t): t for t in (number, integer, text, date, timestamp, category)}
+
+class output_schema():
+    """
+    The declared column types of a sub-report. Columns that are not listed get the default type, e.g. the COA codes
+    of the financial statements. Every sub-report also gets the symbol and reportType columns.
+    """
+    def __init__(self, types: dict, default: pa.DataType = text):
+        self.types = dict(types, symbol=text, reportType=category)
+        self.default = default
+
+    def type(self, column):
+        return self.types.get(column, self.default)
+
+def _cast(array, type):
+    if type == text:
+        return array
+    if type == category:
+        return array.dictionary_encode()
+    if type == date:
+        # Dates come with and without a time part
+        return pc.cast(pc.cast(array, timestamp), date, safe=False)
+    return pc.cast(array, type)
+
+def convert_column(values: list, type, column: str = None):
+    """
+    Convert the extracted strings of a column to its declared type, in one vectorized cast.
+    Only if some value can't be converted, the column is converted value by value and those values become null.
+    """
+    array = pa.array(values, type=text)
+    try:
+        return _cast(array, type)
+    except pa.ArrowInvalid:
+        converted = []
+        for value in array.to_pylist():
+            try:
+                converted += [_cast(pa.array([value], type=text), type)[0].as_py()]
+            except pa.ArrowInvalid:
+                converted += [None]
+        print(f'Could not convert {sum(v is None for v in converted) - array.null_count} values of column {column} to {type}')
+        return pa.array(converted, type=type)
+
+class column_builder():
+    """
+    Collects the rows of _xml_processor column by column.
+    All columns are brought to the same length after every collection element, so the row count is tracked once
+    and padding a column is a single list extension.
+    """
+    def __init__(self, columns: list):
+        self.columns = columns
+        self.column_data = {c: [] for c in columns}
+        self.rows = 0
+
+    def close_element(self, rowno: int, toplevelattributes: dict = {}, fixed_columns: dict = {}):
+        # An element adds as many rows as its longest column, but at least enough to get to one row per element so far
+        rows = max(self.rows, rowno)
+        for values in self.column_data.values():
+            if len(values) > rows:
+                rows = len(values)
+
+        for key, value in toplevelattributes.items():
+            self.column_data[key] += [ value ] * (rows - len(self.column_data[key]))
+
+        for key, value in fixed_columns.items():
+            self.column_data[key] += [ value ] * (rows - len(self.column_data[key]))
+
+        # Insert empty column values for columns that are not filled in this iteration:
+        for values in self.column_data.values():
+            if len(values) < rows:
+                values += [None] * (rows - len(values))
+
+        self.rows = rows
+
+    def to_table(self, schema: output_schema = None):
+        # Without a schema all columns are text
+        if schema is None:
+            return pa.table({c: pa.array(self.column_data[c], type=text) for c in self.columns})
+        return pa.table({c: convert_column(self.column_data[c], schema.type(c), c) for c in self.columns})
+
+def to_dataframe(table: pa.Table):
+    # Integers stay integers when they have missing values
+    return table.to_pandas(types_mapper={integer: pd.Int64Dtype()}.get)
 
 class ib_xml_processor():
-    def __init__(self, xml_file):
-        self.tree = ET.parse(xml_file)
+    """
+    Base class of the processors. The XML is only parsed when a processing method first needs the tree, so a
+    processor can be created just to look at its processing methods.
+    xml_file is a path or a file object; if opener is given, the tree is parsed from opener(xml_file).
+    coa_codes are the known COA codes per statement type (see coa_registry), the first columns of the statements.
+    """
+    def __init__(self, xml_file, opener = None, coa_codes: dict = None):
+        self.xml_file = xml_file
+        self.opener = opener
+        self.coa_codes = {} if coa_codes is None else coa_codes
+        self._tree = None
 
+        # {subreport_type: (processing method, output_schema)}
         self.processing_methods = {}
+        self.schema = None
 
-    def _xml_processor(self, tree, rootelementpath: str, mappings: dict = {'values': {}, 'attributes': {}}, toplevelattributes: dict = {}, fixed_columns: dict = {}):
-        collection = tree.findall(rootelementpath)
+    @classmethod
+    def from_string(cls, xml, coa_codes: dict = None):
+        """A processor for XML that is already in memory, as a string or bytes."""
+        return cls(io.BytesIO(xml.encode('utf-8') if isinstance(xml, str) else xml), coa_codes=coa_codes)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            if self.opener is not None:
+                with self.opener(self.xml_file) as f:
+                    self._tree = ET.parse(f)
+            else:
+                self._tree = ET.parse(self.xml_file)
+        return self._tree
 
+    def process_table(self, subreport_type: str):
+        """Run the processing method of a sub-report; the values are converted to its output schema while they are extracted."""
+        method, self.schema = self.processing_methods[subreport_type]
+        try:
+            return method()
+        finally:
+            self.schema = None
+
+    def process(self, subreport_type: str):
+        """Like process_table, as a DataFrame."""
+        return to_dataframe(self.process_table(subreport_type))
+
+    def _xml_processor(self, tree, rootelementpath: str, mappings: dict = {'values': {}, 'attributes': {}}, toplevelattributes: dict = {}, fixed_columns: dict = {}):
         columns = list(mappings['values'].keys()) + list(mappings['attributes'].keys()) + list(toplevelattributes.keys()) + list(fixed_columns.keys())
-        column_data = {c: [] for c in columns}
-
-        rowno = 1
-        for el in collection:
-            for key, value in mappings['values'].items():
-                column_data[key] += [ e.text for e in el.findall(value)]
-                
-            for key, (value, attribute) in mappings['attributes'].items():
-                column_data[key] += [ e.attrib[attribute] for e in el.findall(value)]
-
-            # Fill top level attributes for every row that is added:
-            for key, value in toplevelattributes.items():
-                column_data[key] += [ el.attrib[value] ] * (max([len(a) for a in column_data.values()] + [rowno]) - len(column_data[key]))
-            
-            # Fill fixed column values for every row that is added:
-            for key, value in fixed_columns.items():
-                column_data[key] += [ value ] * (max([len(a) for a in column_data.values()] + [rowno]) - len(column_data[key]))
-            
-            # Insert empty column values for columns that are not filled in this iteration:
-            for key in column_data:
-                column_data[key] += [None] * (max([len(a) for a in column_data.values()] + [rowno]) - len(column_data[key]))
+        builder = column_builder(columns)
+        self._collect(builder, tree, rootelementpath, self._compile_mappings(mappings), toplevelattributes, fixed_columns)
+        return builder.to_table(self.schema)
+
+    def _collect(self, builder: column_builder, tree, rootelementpath: str, compiled: tuple, toplevelattributes: dict = {}, fixed_columns: dict = {}):
+        # Add a row (or more) to builder for every element at rootelementpath, using the compiled mappings
+        plan, fallback = compiled
+
+        rowno = builder.rows + 1
+        for el in tree.findall(rootelementpath):
+            # Walk the children of the element once, routing every match to its column(s):
+            self._extract(el, plan, builder.column_data)
+
+            for key, value, attribute in fallback:
+                builder.column_data[key] += [ e.text if attribute is None else e.attrib[attribute] for e in el.findall(value)]
+
+            # Fill top level attributes and fixed column values for every row that is added, and pad the other columns:
+            builder.close_element(rowno, {key: el.attrib[value] for key, value in toplevelattributes.items()}, fixed_columns)
             rowno += 1
 
-        # Fill dataframe:
-        df = pd.DataFrame(columns=columns)
+    def _compile_mappings(self, mappings: dict):
+        # Build the lookup tree for all mapped values and attributes. Paths that can't be compiled fall back to findall.
+        plan = extraction_node()
+        fallback = []
+
+        targets = [(key, value, None) for key, value in mappings['values'].items()]
+        targets += [(key, value, attribute) for key, (value, attribute) in mappings['attributes'].items()]
 
-        for c in columns:
-            df[c] = column_data[c]
-        return df
+        for key, value, attribute in targets:
+            steps = compile_path(value)
+            if steps is None:
+                fallback += [(key, value, attribute)]
+                continue
+
+            node = plan
+            for tag, predicates in steps:
+                node = node.child(tag, predicates)
+            node.targets += [(key, attribute)]
+
+        return plan, fallback
+
+    def _extract(self, element, node: extraction_node, column_data: dict):
+        # Depth-first, in document order: this yields the same order per column as findall.
+        for child in element:
+            for match in node.matches(child):
+                for key, attribute in match.targets:
+                    column_data[key].append(child.text if attribute is None else child.attrib[attribute])
+                if match.children:
+                    self._extract(child, match, column_data)
+
+# Output schemas of the sub-reports. Identifiers and codes are kept as text, so leading zeros and dashes survive.
+toplevel_info_types = {
+    'RepNo': text, 'CompanyName': text, 'IRSNo': text, 'CIKNo': text, 'OrganizationPermID': text,
+    'CashFlowMethod': text, 'BalanceSheetDisplay': text, 'COAType': text,
+    'CashFlowMethodCode': category, 'BlanceSheetDisplayCode': category, 'COATypeCode': category,
+}
+issues_schema = output_schema({
+    'Issue Name': text, 'Issue Ticker': text, 'Issue RIC': text, 'Issue DisplayRIC': text,
+    'Issue InstrumentPI': text, 'Issue QuotePI': text, 'Issue InstrumentPermID': text, 'Issue QuotePermID': text,
+    'Issue Exchange': text, 'Issue MostRecentSplit': number,
+    'ExchangeCode': category, 'ExchangeCountry': category, 'MostRecentSplit Date': date,
+    'IssueID': integer, 'IssueType': category, 'IssueDesc': text, 'IssueOrder': integer,
+})
+# All columns of the statements that are not statement_columns are COA codes; the statement columns are categories,
+# unless listed
+statement_schema = output_schema(dict(
+    {col: category for col in statement_columns},
+    PeriodLength=integer, StatementDate=date, Source=text, SourceDate=date, FiscalPeriodEndDate=date, FiscalPeriodYear=integer, FiscalPeriodNumber=integer,
+), default=number)
 
 class ReportsFinStatements_Processor(ib_xml_processor):
-    def __init__(self, xml_file):
-        super().__init__(xml_file)
+    def __init__(self, xml_file, opener = None, coa_codes: dict = None):
+        super().__init__(xml_file, opener, coa_codes)
+        self._statement_mapping_cache = {}
         self.processing_methods = {
-            'toplevel_info': self.process_toplevel_info,
-            'issues': self.process_issues,
-            'financial_statement_column_mapping': self.process_financial_statement_column_mapping,
-            'balance_sheet_annual': self.process_balance_sheet_annual,
-            'income_statement_annual': self.process_income_statement_annual,
-            'cash_flow_annual': self.process_cash_flow_annual,
-            'balance_sheet_interim': self.process_balance_sheet_interim,
-            'income_statement_interim': self.process_income_statement_interim,
-            'cash_flow_interim': self.process_cash_flow_interim
+            'toplevel_info': (self.process_toplevel_info, output_schema(toplevel_info_types)),
+            'issues': (self.process_issues, issues_schema),
+            'financial_statement_column_mapping': (self.process_financial_statement_column_mapping, output_schema({'ColumnDesc': text, 'ColumnCode': text, 'StatementType': category, 'lineID': integer, 'precision': integer})),
+            'balance_sheet_annual': (self.process_balance_sheet_annual, statement_schema),
+            'income_statement_annual': (self.process_income_statement_annual, statement_schema),
+            'cash_flow_annual': (self.process_cash_flow_annual, statement_schema),
+            'balance_sheet_interim': (self.process_balance_sheet_interim, statement_schema),
+            'income_statement_interim': (self.process_income_statement_interim, statement_schema),
+            'cash_flow_interim': (self.process_cash_flow_interim, statement_schema)
         }
     
 
@@ -118,36 +366,42 @@ class ReportsFinStatements_Processor(ib_xml_processor):
         }
         return self._xml_processor(self.tree, 'FinancialStatements/COAMap', fs_mappings)
     
+    def _statement_mappings(self, statementType):
+        # The mappings of a statement type, and their compiled form, are shared by the annual and interim statements.
+        # The columns are the known COA codes first, in the order of the registry, and then the codes only this company has.
+        if statementType not in self._statement_mapping_cache:
+            known = self.coa_codes.get(statementType, [])
+            coaitems = list(known)
+            for map in self.tree.findall(f"FinancialStatements/COAMap/mapItem[@statementType='{statementType}']"):
+                coaitems += [map.attrib['coaItem']]
+            coaitems = list(dict.fromkeys(coaitems))
+
+            itemlevel_mappings = {
+                'values': {
+                    f"{coacode}": f"lineItem[@coaCode='{coacode}']" for coacode in coaitems
+                },
+                'attributes': {
+                    'periodTypeCode': ('FPHeader/periodType', 'Code'),
+                    'UpdateTypeCode': ('FPHeader/UpdateType', 'Code'),
+                    'SourceDate': ('FPHeader/Source', 'Date'),
+                }
+            }
+            itemlevel_mappings['values'].update({
+                    'PeriodLength': 'FPHeader/PeriodLength',
+                    'periodType': 'FPHeader/periodType',
+                    'UpdateType': 'FPHeader/UpdateType',
+                    'StatementDate': 'FPHeader/StatementDate',
+                    'Source': 'FPHeader/Source',
+            })
+            self._statement_mapping_cache[statementType] = (itemlevel_mappings, self._compile_mappings(itemlevel_mappings))
+        return self._statement_mapping_cache[statementType]
+
     def _process_financial_statements_helper(self, periodType = 'Annual', statementType = 'INC'):
         # The financial statements are too deeply nested to be processed by the xml processor.
-        # Therefor, we will traverse the statements and hand over to the xml processor for the final step.
+        # Therefor, we will traverse the statements and collect the rows of every fiscal period in a single table.
         
         # First, let's get the possible columns for all types of financial statements:
-        mapitems = self.tree.findall(f"FinancialStatements/COAMap/mapItem[@statementType='{statementType}']")
-        coaitems = []
-
-        for map in mapitems:
-            coaitems += [map.attrib['coaItem']]
-
-        dfs = []
-        
-        itemlevel_mappings = {
-            'values': {
-                f"{coacode}": f"lineItem[@coaCode='{coacode}']" for coacode in coaitems
-            },
-            'attributes': {
-                'periodTypeCode': ('FPHeader/periodType', 'Code'),
-                'UpdateTypeCode': ('FPHeader/UpdateType', 'Code'),
-                'SourceDate': ('FPHeader/Source', 'Date'),
-            }
-        }
-        itemlevel_mappings['values'].update({
-                'PeriodLength': 'FPHeader/PeriodLength',
-                'periodType': 'FPHeader/periodType',
-                'UpdateType': 'FPHeader/UpdateType',
-                'StatementDate': 'FPHeader/StatementDate',
-                'Source': 'FPHeader/Source',
-        })
+        itemlevel_mappings, compiled = self._statement_mappings(statementType)
         itemlevel_attribs = {
                     'StatementType': 'Type'
         }
@@ -159,23 +413,18 @@ class ReportsFinStatements_Processor(ib_xml_processor):
         if periodType == 'Interim':
             list_fixed_columns_map['FiscalPeriodNumber'] = 'FiscalPeriodNumber'
         
-        
-        # Second, let's get the actual fiscal periods. We need to iterate those, because there are some attributes we want to add to this dataset:
+        builder = column_builder(list(itemlevel_mappings['values'].keys()) + list(itemlevel_mappings['attributes'].keys()) + list(itemlevel_attribs.keys()) + list(list_fixed_columns_map.keys()))
+
+        # Second, let's get the actual fiscal periods. We need to iterate those, because there are some attributes we want to add to this dataset.
+        # If there are no fiscal periods, the table is empty but still has all columns.
         fiscalperiods = self.tree.findall(f'FinancialStatements/{periodType}Periods/FiscalPeriod[@Type="{periodType}"]')
         for f in fiscalperiods:
             fixed_columns = {k: f.attrib[v] for k, v in list_fixed_columns_map.items()}
             
-            dfs += [ self._xml_processor(f, f"Statement[@Type='{statementType}']", itemlevel_mappings, itemlevel_attribs, fixed_columns) ]
-        
-        if len(fiscalperiods) == 0:
-            # If there are no fiscal periods, we need to return an empty dataframe with the correct columns.
-
-            # This is kinda ugly: the columns to be returned are calculated on two places.
-            return pd.DataFrame(columns= list(itemlevel_mappings['values'].keys()) + list(itemlevel_mappings['attributes'].keys()) + list(itemlevel_attribs.keys()) + list(list_fixed_columns_map.keys()))
-
+            self._collect(builder, f, f"Statement[@Type='{statementType}']", compiled, itemlevel_attribs, fixed_columns)
 
-        # Concatenate all dataframes
-        return pd.concat(dfs)
+        # All fiscal periods have the same columns, so they are converted to their types at once
+        return builder.to_table(self.schema)
 
     def process_balance_sheet_annual(self):
         return self._process_financial_statements_helper('Annual', 'BAL')
@@ -194,20 +443,44 @@ class ReportsFinStatements_Processor(ib_xml_processor):
 
     def process_cash_flow_interim(self):
         return self._process_financial_statements_helper('Interim', 'CAS')
+
+security_info_schema = output_schema({
+    'ISIN': text, 'RIC': text, 'TICKER': text, 'InstrumentPI': text,
+    'CLPRICE': number, 'MARKETCAP': number, '52WKHIGH': number, '52WKLOW': number,
+    'CLPRICE_Unit': category, 'CLPRICE_CurrCode': category, 'MARKETCAP_Unit': category, 'MARKETCAP_CurrCode': category,
+    '52WKHIGH_Unit': category, '52WKHIGH_CurrCode': category, '52WKLOW_Unit': category, '52WKLOW_CurrCode': category,
+    'code': integer,
+})
+company_profile_schema = output_schema({
+    'name': text, 'RepNo': text, 'IssueID': integer, 'IsPrimaryIssue': integer, 'sectorName': text,
+    'primaryConsensus': text, 'primaryEstimate': text, 'Currency': category, 'sectorCode': text, 'sectorSet': category,
+    'curFiscalPeriod_fyear': integer, 'curFiscalPeriod_fyem': integer, 'curFiscalPeriod_periodType': category,
+})
+periods_schema = output_schema({
+    'type': category, 'fYear': integer, 'periodNum': integer, 'periodLength': integer, 'periodUnit': category,
+    'endMonth': integer, 'endCalYear': integer, 'fyNum': integer,
+})
+actuals_schema = output_schema({
+    'ActValue': number, 'fYear': integer, 'endMonth': integer, 'endCalYear': integer, 'updated': timestamp,
+    'actualType': category, 'actualUnit': category,
+})
+# All columns of the estimates that are not listed are estimated values
+estimates_schema = output_schema({'fYear': integer, 'endMonth': integer, 'endCalYear': integer, 'type': category, 'unit': category}, default=number)
+
 class RESC_Processor(ib_xml_processor):
-    def __init__(self, xml_file):
-        super().__init__(xml_file)
+    def __init__(self, xml_file, opener = None, coa_codes: dict = None):
+        super().__init__(xml_file, opener, coa_codes)
     
         self.processing_methods = {
-            'security_info': self.process_security_info,
-            'company_profile': self.process_company_profile,
-            'periods_annual': self.process_periods_annual,
-            'periods_interim': self.process_periods_interim,
-            'actuals_annual': self.process_actuals_annual,
-            'actuals_interim': self.process_actuals_interim,
-            'fiscal_year_estimates_annual': self.process_fiscal_year_estimates_annual,
-            'fiscal_year_estimates_interim': self.process_fiscal_year_estimates_interim,
-            'net_profit_estimates': self.process_net_profit_estimates,
+            'security_info': (self.process_security_info, security_info_schema),
+            'company_profile': (self.process_company_profile, company_profile_schema),
+            'periods_annual': (self.process_periods_annual, periods_schema),
+            'periods_interim': (self.process_periods_interim, periods_schema),
+            'actuals_annual': (self.process_actuals_annual, actuals_schema),
+            'actuals_interim': (self.process_actuals_interim, actuals_schema),
+            'fiscal_year_estimates_annual': (self.process_fiscal_year_estimates_annual, estimates_schema),
+            'fiscal_year_estimates_interim': (self.process_fiscal_year_estimates_interim, estimates_schema),
+            'net_profit_estimates': (self.process_net_profit_estimates, estimates_schema),
         }
 
     """
@@ -222,9 +495,9 @@ class RESC_Processor(ib_xml_processor):
                 'TICKER': f"SecIds/SecId[@type='TICKER']",
                 'InstrumentPI': f"SecIds/SecId[@type='InstrumentPI']",
                 'CLPRICE': f"MarketData/MarketDataItem[@type='CLPRICE']",
-                'MARKETCAP': f"MarketData/MarketDataItem[@type='CLPRICE']",
-                '52WKHIGH': f"MarketData/MarketDataItem[@type='CLPRICE']",
-                '52WKLOW': f"MarketData/MarketDataItem[@type='CLPRICE']", 
+                'MARKETCAP': f"MarketData/MarketDataItem[@type='MARKETCAP']",
+                '52WKHIGH': f"MarketData/MarketDataItem[@type='52WKHIGH']",
+                '52WKLOW': f"MarketData/MarketDataItem[@type='52WKLOW']", 
             }, 
             'attributes': {
                 'CLPRICE_Unit': (f"MarketData/MarketDataItem[@type='CLPRICE']", 'unit'),
@@ -335,18 +608,16 @@ class RESC_Processor(ib_xml_processor):
         # Voor de helper stapt deze een niveau te hoog in. De FYEstimate heeft namelijk per FYPeriod verschillende aantallen waarden.
         # Daarom halen we eerst de algemene attributen van FYEstimate op. Daarna gaan we een niveau dieper.
         fyestimates = self.tree.findall(f"ConsEstimates/FYEstimates/FYEstimate")
-        
-        dfs = []
 
+        # All estimates are collected in a single table; without estimates, the table is empty but still has all columns
+        builder = column_builder(list(fy_itemlevel_mappings['values'].keys()) + list(fy_itemlevel_attribs.keys()) + ['type', 'unit'])
+        compiled = self._compile_mappings(fy_itemlevel_mappings)
         for f in fyestimates:
             extra_fixed_columns = {'type': f.attrib['type'], 'unit': f.attrib['unit']}
 
-            dfs += [ self._xml_processor(f, f"FYPeriod[@periodType='{periodType}']", fy_itemlevel_mappings, fy_itemlevel_attribs, extra_fixed_columns) ]
+            self._collect(builder, f, f"FYPeriod[@periodType='{periodType}']", compiled, fy_itemlevel_attribs, extra_fixed_columns)
 
-        # Concatenate all dataframes
-        return pd.concat(dfs)
-    
-        
+        return builder.to_table(self.schema)
 
     def process_fiscal_year_estimates_annual(self):
         return self._process_fiscal_year_estimates_helper('A')
@@ -371,15 +642,28 @@ class RESC_Processor(ib_xml_processor):
         return self._xml_processor(self.tree, 'ConsEstimates/NPEstimates/NPEstimate', estimate_mappings, toplevelattributes={'type': 'type', 'unit': 'unit'})
 
 
+snapshot_toplevel_info_schema = output_schema(dict(toplevel_info_types, **{
+    'LatestAvailableAnnual': date, 'LatestAvailableInterim': date, 'ReportingCurrency': category, 'SharesOutstanding': number,
+    'Business Summary': text, 'Financial Summary': text, 'website': text, 'email': text, 'IndustryInfo_lastUpdated': timestamp,
+}))
+# All columns of the ratios and forecasts that are not listed are numbers
+ratios_schema = output_schema({
+    'PDATE': date, 'PriceCurrency': category, 'ReportingCurrency': category, 'LatestAvailableDate': date,
+}, default=number)
+forecast_data_schema = output_schema({
+    'ConsensusType': category, 'CurFiscalYear': integer, 'CurFiscalYearEndMonth': integer, 'CurInterimEndCalYear': integer,
+    'CurInterimEndMonth': integer, 'EarningsBasis': category,
+}, default=number)
+
 class ReportSnapshot_Processor(ib_xml_processor):
-    def __init__(self, xml_file):
-        super().__init__(xml_file)
+    def __init__(self, xml_file, opener = None, coa_codes: dict = None):
+        super().__init__(xml_file, opener, coa_codes)
     
         self.processing_methods = {
-            'toplevel_info': self.process_toplevel_info, 
-            'issues': self.process_issues, 
-            'ratios': self.process_ratios, 
-            'forecast_data': self.process_forecast_data,
+            'toplevel_info': (self.process_toplevel_info, snapshot_toplevel_info_schema),
+            'issues': (self.process_issues, issues_schema),
+            'ratios': (self.process_ratios, ratios_schema),
+            'forecast_data': (self.process_forecast_data, forecast_data_schema),
         }
 
     def process_toplevel_info(self):
@@ -510,46 +794,693 @@ functionmapping = {
     'ReportSnapshot': ReportSnapshot_Processor
 }
 
-if not os.path.exists(f'./export'):
-    os.makedirs(f'./export')
+def export_report_types(reportType):
+    """
+    The report types under which the sub-reports of reportType are exported.
+    Sub-reports are exported again under the name of every later report type: the SQL loader and the Power BI model
+    read the RESC sub-reports from the ReportSnapshot_ files.
+    """
+    report_types = list(functionmapping.keys())
+    return report_types[report_types.index(reportType):]
+
+# Version of the processed frames; entries of a manifest with another version are processed again
+frames_version = 7
+
+def subreport_types(reportType):
+    # The processors only parse their file when a processing method needs it, so this doesn't read anything
+    return list(functionmapping[reportType](None).processing_methods.keys())
+
+def frames_files(entry: dict):
+    # The frames files a manifest entry refers to; every sub-report knows the file its frame is in
+    return {info['frames'] for info in entry['subreports'].values()}
 
-results = {}
+def column_statistics(table: pa.Table, schema: output_schema):
+    # The declared type of every column, and whether it has any values (columns without values are left out of the export)
+    return {col: {'non_null': table.num_rows - table.column(col).null_count, 'type': str(schema.type(col))} for col in table.column_names}
 
-for reportType, function in functionmapping.items():
-    for comp in companies:
+def with_column(table: pa.Table, name: str, array):
+    # Add a column, or replace it if the table already has one by that name
+    if name in table.column_names:
+        return table.set_column(table.column_names.index(name), name, array)
+    return table.append_column(name, array)
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def process_company(reportType, comp, previous: dict = None, frames_dir: str = './export/frames', snapshot: tuple = None, metrics: pipeline_metrics = None,
+                    subreports: list = None, force: bool = False, coa_codes: dict = None, contents: bytes = None):
+    """
+    Bring the processed sub-reports of a single fundamentals file up to date.
+    Only the sub-reports in subreports (default: all) are looked at. A sub-report is processed if it is new, if the
+    contents of the file changed since it was processed, or if force is set; the file is only parsed if any is.
+    The other sub-reports are taken over from the previous manifest entry as they are.
+    The sub-report frames are written to the frames directory; the returned manifest entry tells where to find them.
+    If snapshot is given, the XML is read from the store instead: it is the (blob path, SHA-256) of the snapshot,
+    or (None, None) if the store doesn't have one. If contents is given, that is the XML, e.g. a response that was
+    just retrieved.
+    The parsing and every sub-report are recorded in metrics.
+    coa_codes are the known COA codes per statement type, handed to the processor.
+    Returns None if there is nothing to process.
+    This is the unit of work for the worker processes, so it should only depend on its arguments.
+    """
+    if contents is not None:
+        file_to_process, sha256 = None, hashlib.sha256(contents).hexdigest()
+    elif snapshot is not None:
+        file_to_process, sha256 = snapshot
+        if file_to_process is None:
+            return None
+    else:
         # if file 'ReportsFinStatements.xml' does not exist, skip
         file_to_process = f'./fundamentals/{comp}/{reportType}.xml'
-        if os.path.exists(file_to_process):
-            # Check first 2 characters of the file to see if it is valid XML and not an empty JSON list
-            with open(file_to_process, 'r') as f:
-                contents = f.read(2)
-                if contents.startswith('[]'):
-                    print(f'File {reportType}.xml for {comp} is empty. Skipping...')
-                    continue
-            
-            proc_object = function(f'./fundamentals/{comp}/{reportType}.xml')
-            for subreport_type, f in proc_object.processing_methods.items():
+        if not os.path.exists(file_to_process):
+            return None
+        sha256 = None
+
+    # Entries produced by an older version are processed again, and sub-reports whose frames were removed from the
+    # export directory are dropped
+    if previous is not None and previous.get('version') != frames_version:
+        previous = None
+    if previous is not None:
+        previous = dict(previous, subreports={s: info for s, info in previous['subreports'].items() if os.path.exists(info['frames'])})
+
+    if contents is not None:
+        proc_object = functionmapping[reportType].from_string(contents, coa_codes)
+    else:
+        opener = open_blob if snapshot is not None else lambda path: open(path, 'rb')
+        proc_object = functionmapping[reportType](file_to_process, opener, coa_codes)
+    selected = [s for s in proc_object.processing_methods if subreports is None or s in subreports]
+
+    def up_to_date(sha256):
+        # Files that were empty have no sub-reports at all
+        if force or previous is None or previous['sha256'] != sha256:
+            return False
+        return previous.get('empty', False) or all(s in previous['subreports'] and previous['subreports'][s]['sha256'] == sha256 for s in selected)
+
+    if contents is not None:
+        # There is no file (yet), so the next run will compare the content hash
+        mtime_ns, size = None, len(contents)
+    else:
+        stat = os.stat(file_to_process)
+        mtime_ns, size = stat.st_mtime_ns, stat.st_size
+    if sha256 is None and previous is not None and (previous['mtime_ns'], previous['size']) == (mtime_ns, size) and up_to_date(previous['sha256']):
+        return previous
+
+    if sha256 is None:
+        sha256 = file_hash(file_to_process)
+    if up_to_date(sha256):
+        return dict(previous, file=file_to_process, mtime_ns=mtime_ns, size=size)
+
+    entry = {'file': file_to_process, 'mtime_ns': mtime_ns, 'size': size, 'sha256': sha256, 'version': frames_version, 'subreports': {}, 'outputs': []}
+
+    # Check first 2 characters of the file to see if it is valid XML and not an empty JSON list
+    if contents is not None:
+        head = contents[:2]
+    else:
+        with opener(file_to_process) as f:
+            head = f.read(2)
+    if head.startswith(b'[]'):
+        print(f'File {reportType}.xml for {comp} is empty. Skipping...')
+        entry['empty'] = True
+        return entry
+
+    todo = [s for s in selected if force or previous is None or previous['subreports'].get(s, {}).get('sha256') != sha256]
+    kept = {} if previous is None else {s: info for s, info in previous['subreports'].items() if s not in todo}
+
+    # The frames file is named after the content hash (and the sub-reports in it, if not all of them), so the previous
+    # one stays valid until the new manifest is saved
+    frames = f'{frames_dir}/{reportType}/{comp}-{sha256[:16]}'
+    if todo != list(proc_object.processing_methods):
+        frames += '-' + hashlib.sha256(' '.join(todo).encode()).hexdigest()[:8]
+    frames += '.arrows'
+    os.makedirs(os.path.dirname(frames), exist_ok=True)
+
+    metrics = pipeline_metrics() if metrics is None else metrics
+    processed = {}
+    with metrics.profile(comp, f'{comp}-{reportType}'):
+        if todo:
+            with metrics.stage('parse', symbol=comp, report=reportType) as m:
+                proc_object.tree
+                m['bytes_read'] = size
+
+        with open(frames, 'wb') if todo else contextlib.nullcontext() as frames_file:
+            for subreport_type in todo:
+                schema = proc_object.processing_methods[subreport_type][1]
                 print(f"Processing {comp} {reportType} {subreport_type}")
-                df = f()
-                df['symbol'] = comp
-                df['reportType'] = reportType
-                if subreport_type not in results:
-                    results[subreport_type] = df
-                else:
-                    results[subreport_type] = pd.concat([results[subreport_type], df])
-
-    # Write report type to the export directory
-    for subreport_type, df in results.items():
+                with metrics.stage('process', symbol=comp, report=reportType, subreport=subreport_type) as m:
+                    table = proc_object.process_table(subreport_type)
+                    table = with_column(table, 'symbol', pa.array([comp] * table.num_rows, type=text))
+                    table = with_column(table, 'reportType', pa.array([reportType] * table.num_rows, type=text).dictionary_encode())
+
+                    # Every frame is an Arrow IPC stream of its own, one after the other in the frames file
+                    offset = frames_file.tell()
+                    processed[subreport_type] = {'frames': frames, 'sha256': sha256, 'offset': offset, 'rows': table.num_rows, 'columns': column_statistics(table, schema)}
+                    with pa.ipc.new_stream(frames_file, table.schema) as writer:
+                        writer.write_table(table)
+                    m['rows'] = table.num_rows
+                    m['bytes_written'] = frames_file.tell() - offset
+
+    # Keep the sub-reports in the order of the processing methods
+    entry['subreports'] = {s: processed.get(s, kept.get(s)) for s in proc_object.processing_methods if s in processed or s in kept}
+    entry['outputs'] = [f'{r}_{subreport_type}' for r in export_report_types(reportType) for subreport_type in entry['subreports']]
+    return entry
+
+class processing_manifest():
+    """
+    Keeps track of the processed fundamentals files: content hash and modification time of every file, where its
+    sub-report frames are stored, and which export files contain its rows. It also keeps the columns the datasets
+    were partitioned by (partition_by), or None if no datasets were written yet.
+    A manifest of another frames_version is dropped with its frames, so everything is processed again.
+    """
+    def __init__(self, export_dir: str = './export'):
+        self.path = f'{export_dir}/manifest.json'
+        self.frames_dir = f'{export_dir}/frames'
+        self.entries = {}
+        self.partition_by = None
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == frames_version:
+                self.entries, self.partition_by = manifest['entries'], manifest['partition_by']
+            else:
+                shutil.rmtree(self.frames_dir, ignore_errors=True)
+
+    def save(self, entries: dict, partition_by: list = None):
+        """Save the entries, and partition_by if datasets were written."""
+        partition_by = self.partition_by if partition_by is None else list(partition_by)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version': frames_version, 'partition_by': partition_by, 'entries': entries}, f)
+        os.replace(self.path + '.tmp', self.path)
+        self.partition_by = partition_by
+
+        # Remove frames files that are no longer referenced
+        referenced = {os.path.normpath(path) for entry in entries.values() for path in frames_files(entry)}
+        for entry in self.entries.values():
+            for path in frames_files(entry):
+                if os.path.normpath(path) not in referenced and os.path.exists(path):
+                    os.remove(path)
+        self.entries = entries
+
+class coa_registry():
+    """
+    The COA codes of the financial statements of all companies, per statement type (BAL, INC, CAS), in the order in
+    which they were first seen. The statements of every company get the known codes as their first columns, in this
+    order, so all companies share the same columns and the export files keep their column order from run to run.
+    The registry is kept in the export directory, and extended with the codes of the processed statements after
+    every run.
+    """
+    # The statement type of the statement sub-reports
+    statement_types = {
+        'balance_sheet_annual': 'BAL', 'balance_sheet_interim': 'BAL',
+        'income_statement_annual': 'INC', 'income_statement_interim': 'INC',
+        'cash_flow_annual': 'CAS', 'cash_flow_interim': 'CAS',
+    }
+
+    def __init__(self, export_dir: str = './export'):
+        self.path = f'{export_dir}/coa_registry.json'
+        self.codes = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.codes = json.load(f)
+
+    def update(self, entry: dict):
+        # All columns of the statements that are not declared in the schema are COA codes
+        for subreport_type, info in entry['subreports'].items():
+            if subreport_type in self.statement_types:
+                codes = self.codes.setdefault(self.statement_types[subreport_type], [])
+                known = set(codes)
+                codes += [col for col in info['columns'] if col not in statement_schema.types and col not in known]
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.codes, f)
+        os.replace(self.path + '.tmp', self.path)
+
+class change_capture():
+    """
+    Writes the rows of the export files that changed in a run, as delta files next to the export:
+    changes/{export file}/{run_id}.parquet. Every row has a change column (insert, update or delete) and the run_id.
+    Deleted rows have the values they had before, inserted and updated rows their new values.
+
+    Rows are compared on the natural keys of export_tables, and only for the symbols whose rows may have changed
+    (changed_symbols: export file -> symbols). Where a key has several rows, all new rows of a changed key are
+    updates; a consumer applies a delta by removing the rows with the keys in it and adding the rows that aren't
+    deletes. Export files that are written for the first time have nothing to compare with, and get no delta.
+
+    Every delta file records the export_version of the file it was computed against (base_version) and of the file
+    it results in (version), so a consumer can tell whether it follows on what it loaded before. A file that is
+    written again with other contents always gets a delta, without rows if none of its rows changed.
+    """
+    def __init__(self, export_dir: str = './export', changed_symbols: dict = None, run_id: str = None, metrics: pipeline_metrics = None):
+        self.export_dir = export_dir
+        self.changed_symbols = {} if changed_symbols is None else changed_symbols
+        # Run ids sort in the order of the runs
+        self.run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ') if run_id is None else run_id
+        self.metrics = pipeline_metrics() if metrics is None else metrics
+        self.captured = {}
+
+    def capture(self, name: str, old_path: str, new_path: str = None):
+        """Write the delta of an export file from old_path to new_path (None if it is removed); returns its number of rows."""
+        if name in self.captured or not os.path.exists(old_path):
+            return 0
+
+        with self.metrics.stage('changes', output=name) as m:
+            base_version, version = export_version(old_path), (export_version(new_path) if new_path is not None else '')
+            if base_version == version:
+                self.captured[name] = 0
+                return 0
+
+            symbols = sorted(self.changed_symbols.get(name, []))
+            if symbols:
+                filters = [('symbol', 'in', symbols)]
+                old = self._read(old_path, filters)
+                new = self._read(new_path, filters) if new_path is not None else old.schema.empty_table()
+                delta = self._diff(old, new, table_keys(name, set(old.column_names) | set(new.column_names)))
+            else:
+                # Rewritten, but none of its symbols changed
+                delta = pa.table({'change': pa.array([], type=category)})
+            self.captured[name] = delta.num_rows
+            m['rows'] = delta.num_rows
+
+            delta = delta.append_column('run_id', pa.array([self.run_id] * delta.num_rows, type=text))
+            delta = delta.replace_schema_metadata(dict(delta.schema.metadata or {}, base_version=base_version, version=version))
+            path = f'{self.export_dir}/changes/{name}/{self.run_id}.parquet'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(delta, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            m['bytes_written'] = os.path.getsize(path)
+        print(f'Captured {delta.num_rows} changed rows of {name}')
+        return delta.num_rows
+
+    def _read(self, path, filters):
+        # The row numbers of the export files are left out; they shift when rows of a company are added or removed
+        table = pq.read_table(path, filters=filters)
+        if pa.types.is_dictionary(table.schema.field('symbol').type):
+            # The datasets are partitioned by symbol, which is read back as a dictionary
+            table = with_column(table, 'symbol', table.column('symbol').cast(text))
+        return table.drop_columns([col for col in table.column_names if col == '__index_level_0__'])
+
+    def _fingerprints(self, table, columns):
+        # A hash of the values of every row as text, so a column that is missing compares equal to one without values
+        text_columns = {col: (pc.cast(table.column(col), pa.string()) if col in table.column_names else pa.nulls(table.num_rows, pa.string())).to_pandas()
+                        for col in columns}
+        return pd.util.hash_pandas_object(pd.DataFrame(text_columns, index=range(table.num_rows)), index=False).to_numpy()
+
+    def _diff(self, old, new, keys):
+        columns = list(dict.fromkeys(new.column_names + old.column_names))
+        old_keys, new_keys = self._fingerprints(old, keys), self._fingerprints(new, keys)
+        old_rows, new_rows = self._fingerprints(old, columns), self._fingerprints(new, columns)
+
+        # Keys are compared by the set of their rows: the sum of the row hashes and the number of rows
+        def signatures(key_hashes, row_hashes):
+            return pd.DataFrame({'key': key_hashes, 'row': row_hashes}).groupby('key')['row'].agg(['sum', 'count'])
+        before, after = signatures(old_keys, old_rows), signatures(new_keys, new_rows)
+        both = before.index.intersection(after.index)
+        updated = both[(before.loc[both] != after.loc[both]).any(axis=1).to_numpy()]
+        inserted = after.index.difference(before.index)
+        deleted = before.index.difference(after.index)
+
+        parts = []
+        for table, key_hashes, changed, change in [(new, new_keys, inserted, 'insert'), (new, new_keys, updated, 'update'), (old, old_keys, deleted, 'delete')]:
+            rows = np.flatnonzero(np.isin(key_hashes, changed.to_numpy()))
+            if len(rows):
+                part = table.take(pa.array(rows))
+                parts += [part.add_column(0, 'change', pa.array([change] * len(rows), type=text).dictionary_encode())]
+        if not parts:
+            return pa.table({'change': pa.array([], type=category)})
+        return pa.concat_tables(parts, promote_options='permissive')
+
+class parquet_exporter():
+    """
+    Streams the processed sub-reports to the export directory, one company at a time.
+
+    A Parquet writer needs its schema up front, while the columns of a sub-report and their types depend on all
+    companies. The schema is therefore collected from the column statistics in the manifest entries first. After
+    that every export file is written row group by row group from the stored frames, so memory stays bounded by a
+    single company.
+    If changes is given, the rows that changed are captured before an export file or dataset is replaced.
+    """
+    def __init__(self, export_dir: str = './export', row_group_size: int = 65536, compression: str = 'snappy', metrics: pipeline_metrics = None,
+                 changes: change_capture = None):
+        self.export_dir = export_dir
+        self.changes = changes
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.metrics = pipeline_metrics() if metrics is None else metrics
+        self.sources = []
+
+    def add(self, reportType, entry: dict):
+        self.sources += [(reportType, entry)]
+
+    def write(self, reportType, outputs: set = None):
+        """
+        Write all sub-reports added so far as {reportType}_{subreport_type}.parquet.
+        If outputs is given, only the export files in it are (re)written.
+        """
+        for subreport_type in dict.fromkeys(s for _, entry in self.sources for s in entry['subreports']):
+            if outputs is not None and f'{reportType}_{subreport_type}' not in outputs:
+                continue
+
+            sources = [entry for _, entry in self.sources if subreport_type in entry['subreports']]
+            path = f'{self.export_dir}/{reportType}_{subreport_type}.parquet'
+            with self.metrics.stage('export', output=f'{reportType}_{subreport_type}') as m:
+                self._write_file(path, sources, subreport_type)
+                m['rows'] = sum(entry['subreports'][subreport_type]['rows'] for entry in sources)
+                m['bytes_written'] = os.path.getsize(path)
+            print(f'Processed {reportType}_{subreport_type}')
+
+    def write_dataset(self, reportType, outputs: set = None, partition_by: list = ['symbol']):
+        """
+        Write the sub-reports of reportType as hive-partitioned datasets: dataset/{reportType}_{subreport_type}/<column>=<value>/.
+        Unlike the flat files, a dataset only contains the rows of its own report type.
+        Sub-reports without (some of) the partition_by columns are partitioned by the columns they do have.
+        If outputs is given, only the datasets in it are (re)written.
+        """
+        for subreport_type in dict.fromkeys(s for r, entry in self.sources if r == reportType for s in entry['subreports']):
+            name = f'{reportType}_{subreport_type}'
+            if outputs is not None and name not in outputs and os.path.exists(f'{self.export_dir}/dataset/{name}'):
+                continue
+
+            sources = [entry for r, entry in self.sources if r == reportType and subreport_type in entry['subreports']]
+            with self.metrics.stage('export_dataset', output=name) as m:
+                self._write_dataset(f'{self.export_dir}/dataset/{name}', sources, subreport_type, partition_by)
+                m['rows'] = sum(entry['subreports'][subreport_type]['rows'] for entry in sources)
+            print(f'Processed dataset {name}')
+
+    def _types(self, sources, subreport_type):
+        # The declared types of the columns, in order of appearance
+        types = {}
+        non_null = {}
+        for entry in sources:
+            for col, stats in entry['subreports'][subreport_type]['columns'].items():
+                types.setdefault(col, column_types[stats['type']])
+                non_null[col] = non_null.get(col, 0) + stats['non_null']
+
         # Remove empty columns
-        df = df.dropna(axis=1, how='all')
-
-        # Detect data types
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                try:
-                    df[col] = pd.to_numeric(df[col])
-                except:
-                    pass
-
-        df.to_parquet(f'./export/{reportType}_{subreport_type}.parquet')
-        print(f'Processed {reportType}_{subreport_type}')
+        return {col: t for col, t in types.items() if non_null[col] > 0}
+
+    def _tables(self, sources, subreport_type, schema):
+        # The frames of the sources, one company at a time, brought to the schema of the export
+        for entry in sources:
+            info = entry['subreports'][subreport_type]
+            with open(info['frames'], 'rb') as f:
+                f.seek(info['offset'])
+                table = pa.ipc.open_stream(f).read_all()
+
+            yield self._conform(table, schema)
+
+    def _write_file(self, path, sources, subreport_type):
+        types = self._types(sources, subreport_type)
+        schema = self._pandas_schema(types)
+
+        # Write to a temporary file first, so an interrupted run doesn't leave a truncated export file behind
+        writer = pq.ParquetWriter(path + '.tmp', schema, compression=self.compression)
+        buffer = []
+        buffered_rows = 0
+        for table in self._tables(sources, subreport_type, schema):
+            buffer += [table]
+            buffered_rows += table.num_rows
+            if buffered_rows >= self.row_group_size:
+                writer.write_table(pa.concat_tables(buffer), row_group_size=self.row_group_size)
+                buffer, buffered_rows = [], 0
+
+        if buffered_rows > 0:
+            writer.write_table(pa.concat_tables(buffer), row_group_size=self.row_group_size)
+        writer.close()
+        if self.changes is not None:
+            self.changes.capture(os.path.basename(path)[:-len('.parquet')], path, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def _write_dataset(self, path, sources, subreport_type, partition_by):
+        types = self._types(sources, subreport_type)
+        schema = pa.schema([pa.field(col, t) for col, t in types.items()])
+        partitioning = ds.partitioning(pa.schema([schema.field(col) for col in partition_by if col in types]), flavor='hive')
+
+        def batches():
+            for table in self._tables(sources, subreport_type, schema):
+                yield from table.to_batches()
+
+        # Write next to the current dataset, and swap when done
+        shutil.rmtree(path + '.tmp', ignore_errors=True)
+        ds.write_dataset(
+            batches(), path + '.tmp', schema=schema, format='parquet', partitioning=partitioning,
+            basename_template='part-{i}.parquet',
+            file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression, write_statistics=True),
+            max_rows_per_group=self.row_group_size, min_rows_per_group=min(self.row_group_size, 1024),
+        )
+        if self.changes is not None:
+            self.changes.capture(os.path.basename(path), path, path + '.tmp')
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(path + '.tmp', path)
+
+    def _pandas_schema(self, types):
+        # The export files have the pandas metadata and the row numbers of a DataFrame, so pandas reads them back as
+        # before, and the Power BI model finds the __index_level_0__ column it removes
+        schema = pa.schema([pa.field(col, t) for col, t in types.items()])
+        return pa.Table.from_pandas(to_dataframe(schema.empty_table()), schema=schema.append(pa.field('__index_level_0__', pa.int64())), preserve_index=True).schema
+
+    def _conform(self, table, schema):
+        # Bring a single company's frame to the columns of the export file; the values already have their declared types
+        columns = []
+        for field in schema:
+            if field.name == '__index_level_0__':
+                columns += [pa.array(range(table.num_rows), type=field.type)]
+            elif field.name in table.column_names:
+                columns += [table.column(field.name)]
+            else:
+                columns += [pa.nulls(table.num_rows, field.type)]
+        return pa.Table.from_arrays(columns, schema=schema)
+
+def main(workers: int = 1, full: bool = False, export_dir: str = './export', store_dir: str = None, as_of: datetime = None,
+         layout: str = 'files', partition_by: list = ['symbol'], compression: str = 'snappy', row_group_size: int = 65536, metrics: pipeline_metrics = None,
+         reports: list = None, subreports: list = None, symbols: list = None, changes: bool = False):
+    """
+    reports, subreports and symbols select what is processed (default: everything). Whatever is not selected keeps
+    its entry in the manifest and its rows in the export files, as it was; with full, only the selection is processed
+    again and its export files rewritten.
+    With changes, the rows that changed since the previous run are written to delta files in <export_dir>/changes.
+    """
+    metrics = pipeline_metrics() if metrics is None else metrics
+    with metrics.stage('run', workers=workers, full=full, reports=reports, subreports=subreports, symbols=symbols) as m:
+        m['files'] = _main(workers, full, export_dir, store_dir, as_of, layout, partition_by, compression, row_group_size, metrics, reports, subreports, symbols, changes)
+
+def _main(workers, full, export_dir, store_dir, as_of, layout, partition_by, compression, row_group_size, metrics, reports, subreports, symbols, changes):
+    if store_dir is not None:
+        # Process the latest snapshots in the XML store, or the latest ones at as_of
+        store = xml_store(store_dir)
+        snapshots = {key: (store.blob_path(sha256), sha256) for key, (fetched_at, sha256) in store.snapshots(as_of).items()}
+        store.close()
+        companies = sorted({symbol for symbol, report in snapshots})
+    else:
+        # list all subdirectories in the "fundamentals" directory
+        companies = [ name for name in os.listdir('fundamentals') if os.path.isdir(os.path.join('fundamentals', name)) ]
+
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+
+    manifest = processing_manifest(export_dir)
+    previous = manifest.entries
+    registry = coa_registry(export_dir)
+
+    # The selected report types are the ones with any selected sub-report, and the selected outputs are the export
+    # files the selected sub-reports end up in
+    selection = {r: [s for s in subreport_types(r) if subreports is None or s in subreports] for r in functionmapping if reports is None or r in reports}
+    selection = {r: subs for r, subs in selection.items() if subs}
+    selected_outputs = {f'{e}_{s}' for r, subs in selection.items() for e in export_report_types(r) for s in subs}
+
+    def selected(key):
+        reportType, comp = key.split('/')
+        return reportType in selection and (symbols is None or comp in symbols)
+
+    # All files are handed out at once, so workers don't sit idle at the boundaries between report types.
+    # map() returns the results in order, which keeps the export identical to a sequential run.
+    tasks = [(reportType, comp) for reportType in functionmapping for comp in companies if selected(f'{reportType}/{comp}')]
+    arguments = (
+        [t[0] for t in tasks],
+        [t[1] for t in tasks],
+        [previous.get(f'{t[0]}/{t[1]}') for t in tasks],
+        [manifest.frames_dir] * len(tasks),
+        [snapshots.get((t[1], t[0]), (None, None)) if store_dir is not None else None for t in tasks],
+        [metrics] * len(tasks),
+        [selection[t[0]] for t in tasks],
+        [full] * len(tasks),
+        # The registry as it was at the start of the run, so the columns don't depend on the order of the work
+        [{t: list(codes) for t, codes in registry.codes.items()}] * len(tasks),
+    )
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    if executor is not None:
+        processed = executor.map(process_company, *arguments, chunksize=max(1, len(tasks) // (workers * 8)))
+    else:
+        processed = map(process_company, *arguments)
+
+    # Files that weren't selected keep their previous entry, also if they are no longer there
+    keys = {}
+    for reportType in functionmapping:
+        keys[reportType] = [f'{reportType}/{comp}' for comp in companies]
+        keys[reportType] += [key for key in previous if key.split('/')[0] == reportType and key not in keys[reportType] and not selected(key)]
+
+    try:
+        entries = _export(export_dir, manifest, registry, keys, lambda key: next(processed) if selected(key) else previous.get(key),
+                          full, selected_outputs, layout, partition_by, compression, row_group_size, metrics, changes)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return len(entries)
+
+def _export(export_dir, manifest, registry, keys, entry_for, full, selected_outputs, layout, partition_by, compression, row_group_size, metrics, changes=False):
+    """
+    Write the export files, and save the COA registry and the manifest. Returns the new manifest entries.
+    keys are the manifest keys per report type, in the order in which their rows are exported, and entry_for(key)
+    returns the new entry of a key (None if the file is gone). Only the export files with changed rows are written,
+    and the selected outputs that don't exist yet, or all of them with full.
+    With changes, the changed rows of every export file are also written as a delta file (see change_capture).
+    """
+    previous = manifest.entries
+    entries = {}
+    changed_outputs = set()
+    # The symbols whose rows may have changed, per export file
+    changed_symbols = {}
+    capture = change_capture(export_dir, changed_symbols, metrics=metrics) if changes else None
+    exporter = parquet_exporter(export_dir, row_group_size=row_group_size, compression=compression, metrics=metrics, changes=capture)
+    datasets = layout in ('dataset', 'both')
+    # Datasets that were partitioned by other columns, or by columns that weren't recorded, are all written again
+    repartition = datasets and manifest.partition_by != list(partition_by)
+    if repartition and os.path.isdir(f'{export_dir}/dataset'):
+        print(f'The datasets were partitioned by {manifest.partition_by}, they are all written again partitioned by {list(partition_by)}')
+
+    def changed(outputs, key):
+        changed_outputs.update(outputs)
+        for name in outputs:
+            changed_symbols.setdefault(name, set()).add(key.split('/')[1])
+
+    for reportType in functionmapping:
+        for key in keys[reportType]:
+            entry = entry_for(key)
+            if entry is None:
+                continue
+
+            entries[key] = entry
+            exporter.add(reportType, entry)
+            registry.update(entry)
+            if key not in previous or previous[key].get('version') != entry.get('version'):
+                changed(entry['outputs'], key)
+                if key in previous:
+                    changed(previous[key]['outputs'], key)
+            else:
+                # Only the sub-reports that were processed again, added or removed change their export files
+                before, after = previous[key]['subreports'], entry['subreports']
+                for subreport_type in before.keys() | after.keys():
+                    if before.get(subreport_type) != after.get(subreport_type):
+                        changed([f'{r}_{subreport_type}' for r in export_report_types(reportType)], key)
+
+        # Files that are no longer there remove their rows from the export files
+        for key, entry in previous.items():
+            if key.split('/')[0] == reportType and key not in entries:
+                changed(entry['outputs'], key)
+
+        # Only write the export files of this report type that contain changed rows, or selected ones that don't
+        # exist yet or are rewritten by a full run
+        rewrite = changed_outputs | selected_outputs if full else changed_outputs
+        if layout in ('files', 'both'):
+            outputs = {f'{reportType}_{subreport_type}' for _, entry in exporter.sources for subreport_type in entry['subreports']}
+            outputs = {name for name in outputs if name in rewrite or (name in selected_outputs and not os.path.exists(f'{export_dir}/{name}.parquet'))}
+            exporter.write(reportType, outputs)
+        if datasets:
+            exporter.write_dataset(reportType, None if repartition else rewrite, partition_by)
+
+    # Remove export files that no longer have any rows
+    produced = {name for entry in entries.values() for name in entry['outputs']}
+    for entry in previous.values():
+        for name in entry['outputs']:
+            if name not in produced and os.path.exists(f'{export_dir}/{name}.parquet'):
+                if capture is not None:
+                    capture.capture(name, f'{export_dir}/{name}.parquet')
+                os.remove(f'{export_dir}/{name}.parquet')
+                print(f'Removed {name}')
+            if name not in produced and os.path.exists(f'{export_dir}/dataset/{name}'):
+                if capture is not None:
+                    capture.capture(name, f'{export_dir}/dataset/{name}')
+                shutil.rmtree(f'{export_dir}/dataset/{name}')
+                print(f'Removed dataset {name}')
+
+    registry.save()
+    manifest.save(entries, partition_by if datasets else None)
+    return entries
+
+class streaming_processor():
+    """
+    Processes reports while they are being retrieved, without reading them back from disk.
+
+    submit() hands the XML of a report to a pool of parser processes right away. At most queue_size reports are
+    waiting or being parsed at any time; beyond that submit() blocks, which holds back the retrieval instead of
+    piling up responses in memory. close() waits for the parsers, exports the changed sub-reports like a run of
+    this script would, and saves the manifest. Reports that weren't submitted keep their previous entry.
+    Storing the raw XML is up to the caller.
+    """
+    def __init__(self, export_dir: str = './export', workers: int = 2, queue_size: int = 16, layout: str = 'files', partition_by: list = ['symbol'],
+                 compression: str = 'snappy', row_group_size: int = 65536, metrics: pipeline_metrics = None, changes: bool = False):
+        os.makedirs(export_dir, exist_ok=True)
+        self.export_dir = export_dir
+        self.export_options = (layout, partition_by, compression, row_group_size)
+        self.changes = changes
+        self.metrics = pipeline_metrics() if metrics is None else metrics
+        self.manifest = processing_manifest(export_dir)
+        self.registry = coa_registry(export_dir)
+        self.coa_codes = {t: list(codes) for t, codes in self.registry.codes.items()}
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.futures = {}
+
+    def submit(self, symbol: str, report: str, xml):
+        if report not in functionmapping:
+            return
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+
+        self.slots.acquire()
+        key = f'{report}/{symbol}'
+        future = self.executor.submit(process_company, report, symbol, self.manifest.entries.get(key), self.manifest.frames_dir, None, self.metrics,
+                                      None, False, self.coa_codes, xml)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures[key] = future
+
+    def close(self):
+        try:
+            processed = {key: future.result() for key, future in self.futures.items()}
+        finally:
+            self.executor.shutdown()
+
+        previous = self.manifest.entries
+        keys = {r: [key for key in previous if key.split('/')[0] == r] + [key for key in processed if key.split('/')[0] == r and key not in previous] for r in functionmapping}
+        outputs = {f'{e}_{s}' for r in functionmapping for e in export_report_types(r) for s in subreport_types(r)}
+        entries = _export(self.export_dir, self.manifest, self.registry, keys, lambda key: processed[key] if key in processed else previous.get(key),
+                          False, outputs, *self.export_options, self.metrics, self.changes)
+        return len(entries)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process the fundamentals XML files into Parquet files in the export directory.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes used to parse the XML files (default: 1, no worker processes)')
+    parser.add_argument('--full', action='store_true', help='Reprocess all (selected) files, instead of only the files that changed since the previous run')
+    parser.add_argument('--export', default='./export', help='Directory to write the Parquet files to (default: ./export)')
+    parser.add_argument('--store', help='Process the snapshots in this XML store instead of the fundamentals directory')
+    parser.add_argument('--as-of', type=datetime.fromisoformat, help='With --store: process the snapshots as they were at this date/time (ISO format) instead of the latest ones')
+    parser.add_argument('--layout', choices=['files', 'dataset', 'both'], default='files', help='Write one Parquet file per sub-report (files), a hive-partitioned dataset per sub-report in <export>/dataset (dataset), or both (default: files)')
+    parser.add_argument('--partition-by', nargs='+', default=['symbol'], help='Columns to partition the datasets by, e.g. symbol FiscalPeriodYear (default: symbol)')
+    parser.add_argument('--compression', default='snappy', choices=['snappy', 'zstd', 'gzip', 'lz4', 'brotli', 'none'], help='Parquet compression codec (default: snappy)')
+    parser.add_argument('--row-group-size', type=int, default=65536, help='Maximum number of rows per Parquet row group (default: 65536)')
+    parser.add_argument('--reports', nargs='+', choices=list(functionmapping), help='Only process these report types (default: all)')
+    parser.add_argument('--subreports', nargs='+', choices=list(dict.fromkeys(s for r in functionmapping for s in subreport_types(r))), metavar='SUBREPORT',
+                        help='Only process these sub-reports, e.g. ratios forecast_data (default: all)')
+    parser.add_argument('--symbols', nargs='+', help='Only process these symbols (default: all)')
+    parser.add_argument('--changes', action='store_true', help='Also write the rows that changed since the previous run, as insert/update/delete delta files in <export>/changes')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    main(workers=args.workers, full=args.full, export_dir=args.export, store_dir=args.store, as_of=args.as_of,
+         layout=args.layout, partition_by=args.partition_by, compression=args.compression, row_group_size=args.row_group_size,
+         metrics=instrumentation.from_arguments(args, 'process-xml'), reports=args.reports, subreports=args.subreports, symbols=args.symbols,
+         changes=args.changes)
@@ -0,0 +1,85 @@
+import calendar
+import heapq
+import os
+from datetime import date, datetime, timedelta
+import pandas as pd
+
+# How long a report stays fresh. Estimates move daily, statements change once a quarter.
+report_ttls = {
+    'RESC': timedelta(days=1),
+    'ReportSnapshot': timedelta(days=7),
+    'ReportsFinStatements': timedelta(days=90),
+}
+
+def fiscal_period_ends(export_dir: str = 'export'):
+    """
+    The fiscal period end dates per symbol, taken from the parsed RESC periods.
+    Interim periods are used where available, annual periods otherwise. Returns {symbol: sorted list of dates}.
+    """
+    period_ends = {}
+
+    def add(symbol, year, month):
+        if pd.isna(year) or pd.isna(month):
+            return
+        year, month = int(year), int(month)
+        period_ends.setdefault(symbol, set()).add(date(year, month, calendar.monthrange(year, month)[1]))
+
+    if os.path.exists(f'{export_dir}/RESC_periods_interim.parquet'):
+        df = pd.read_parquet(f'{export_dir}/RESC_periods_interim.parquet', columns=['symbol', 'endCalYear', 'endMonth'])
+        for symbol, year, month in df.itertuples(index=False):
+            add(symbol, year, month)
+
+    if os.path.exists(f'{export_dir}/RESC_periods_annual.parquet'):
+        df = pd.read_parquet(f'{export_dir}/RESC_periods_annual.parquet', columns=['symbol', 'fYear', 'endMonth'])
+        for symbol, year, month in df.itertuples(index=False):
+            if symbol not in period_ends:
+                add(symbol, year, month)
+
+    return {symbol: sorted(dates) for symbol, dates in period_ends.items()}
+
+class refresh_scheduler():
+    """
+    Decides which of the already retrieved reports to request again.
+
+    The priority of a report is its age relative to the TTL of its report type, so 1.0 means it just became stale.
+    If fiscal period ends are given, reports in period_reports that were retrieved before the results of the latest
+    ended fiscal period could be published (period end + reporting_lag) get their priority multiplied by period_boost.
+    """
+    def __init__(self, ttls: dict = report_ttls, period_ends: dict = None, reporting_lag: timedelta = timedelta(days=30), period_boost: float = 4.0, period_reports: tuple = ('ReportsFinStatements', 'RESC')):
+        self.ttls = ttls
+        self.period_ends = period_ends if period_ends is not None else {}
+        self.reporting_lag = reporting_lag
+        self.period_boost = period_boost
+        self.period_reports = period_reports
+
+    def priority(self, symbol: str, report: str, fetched_at: datetime, now: datetime = None):
+        now = datetime.now() if now is None else now
+        priority = (now - fetched_at) / self.ttls[report]
+
+        if report in self.period_reports:
+            # The latest fiscal period whose results should be available by now
+            published = [d for d in self.period_ends.get(symbol, []) if datetime.combine(d, datetime.min.time()) + self.reporting_lag <= now]
+            if published and fetched_at < datetime.combine(published[-1], datetime.min.time()) + self.reporting_lag:
+                priority *= self.period_boost
+
+        return priority
+
+    def schedule(self, candidates, budget: int = None, now: datetime = None):
+        """
+        Order the stale reports among candidates, an iterable of (symbol, report, fetched_at), by priority.
+        Returns at most budget (symbol, report) tuples, the most valuable refreshes first.
+        """
+        now = datetime.now() if now is None else now
+        queue = []
+        for symbol, report, fetched_at in candidates:
+            if report not in self.ttls:
+                continue
+            priority = self.priority(symbol, report, fetched_at, now)
+            if priority >= 1:
+                queue += [(priority, symbol, report)]
+
+        if budget is None:
+            selected = sorted(queue, reverse=True)
+        else:
+            selected = heapq.nlargest(max(budget, 0), queue)
+        return [(symbol, report) for _, symbol, report in selected]
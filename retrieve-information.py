@@ -1,18 +1,32 @@
+import argparse
+import asyncio
+import importlib.util
 import os
-from datetime import datetime, timedelta
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
 import nest_asyncio
-import yfinance as yf
 
 nest_asyncio.apply()
 from ib_insync import *
-ib = IB()
+from ib_fetcher import fundamentals_fetcher, sharded_fetcher
+from fake_ib import fake_ib
+import instrumentation
+from fetch_jobs import fetch_job_queue
+from price_history import recorded_prices, update_prices, yahoo_download
+from refresh_scheduler import refresh_scheduler, fiscal_period_ends
+from xml_store import xml_store
 
-ib.connect('127.0.0.1', 7496, clientId = 3)
+# process-xml.py is a script, so it can't be imported by name. It is registered under a name all the same, so the
+# parser processes of --process can find its functions; this also runs when they start.
+_spec = importlib.util.spec_from_file_location('process_xml', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process-xml.py'))
+process_xml = sys.modules['process_xml'] = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(process_xml)
 
-def get_fundamentals_for(stock_ticker, market = 'SMART', currency = 'USD', report = 'ReportsFinStatements'):
-    contract = Stock(stock_ticker, market, currency)
-
-    return ib.reqFundamentalData(contract, report)
+def contract_for(stock_ticker, market = 'SMART', currency = 'USD'):
+    return Stock(stock_ticker, market, currency)
 
 
 
@@ -24,22 +38,192 @@ reports_to_request = ['ReportsFinStatements', 'ReportSnapshot', 'RESC'] # ['Repo
 
 # Niet gevonden: BMM, IIAC.U, MFB, JFB, EIN3, ATNY, PERY, AONE, OMX, RAA, KNL, OMP, HUL
 
-# Create folder "fundamentals" if it doesn't exist
-if not os.path.exists('fundamentals'):
-    os.makedirs('fundamentals')
-
-for company in companies_to_get:
-
-    # Create folder with company name if it doesn't exist
-    # If it already exists, don't get the fundamentals.
-    if not os.path.exists(f'./fundamentals/{company}'):
-        os.makedirs(f'./fundamentals/{company}')
-        
-    for report in reports_to_request:
-        if not os.path.exists(f'./fundamentals/{company}/{report}.xml'):
-            fund = get_fundamentals_for(stock_ticker=company, report=report)
-        
-            with open(f'./fundamentals/{company}/{report}.xml', 'w') as file:
-                file.write(str(fund))
-
-ib.disconnect()
\ No newline at end of file
+def main(args):
+    # One connection per configured gateway and clientId; the requests are spread over the ones that connect
+    metrics = instrumentation.from_arguments(args, 'retrieve-information')
+    connections = {}
+    for i, client in enumerate(args.client):
+        host, port, client_id = client.rsplit(':', 2)
+        if args.fake_ib is not None:
+            ib = fake_ib(args.fake_ib, latency=args.fake_latency, jitter=args.fake_latency / 2,
+                         disconnect_after=args.fake_disconnect_after if i == 0 else None, pacing_every=args.fake_pacing_every, empty_every=args.fake_empty_every)
+        else:
+            ib = IB()
+        # Errors are raised instead of answered with an empty list, so pacing violations are retried instead of being
+        # taken for reports that don't exist
+        ib.RaiseRequestErrors = True
+        try:
+            ib.connect(host, int(port), clientId = int(client_id))
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f'Could not connect client {client}: {e!r}')
+            continue
+        connections[client] = ib
+    if not connections:
+        raise SystemExit('Could not connect to any of the clients')
+
+    # Create folder "fundamentals" if it doesn't exist
+    if args.store is None and not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    store = xml_store(args.store) if args.store is not None else None
+    snapshots = store.snapshots() if store is not None else {}
+
+    def fetched_at(company, report):
+        # When the current version of a report was retrieved, or None if there is none
+        if store is not None:
+            return snapshots[(company, report)][0] if (company, report) in snapshots else None
+
+        file_to_write = os.path.join(args.output, company, f'{report}.xml')
+        if not os.path.exists(file_to_write):
+            return None
+        with open(file_to_write, 'r') as f:
+            if f.read(2).startswith('[]'):
+                return None
+        return datetime.fromtimestamp(os.path.getmtime(file_to_write))
+
+    jobs = fetch_job_queue(args.jobs_db, not_found_ttl=args.not_found_ttl * 24 * 3600)
+
+    for company in companies_to_get:
+
+        # Create folder with company name if it doesn't exist
+        if store is None and not os.path.exists(os.path.join(args.output, company)):
+            os.makedirs(os.path.join(args.output, company))
+
+        for report in reports_to_request:
+            file_to_write = os.path.join(args.output, company, f'{report}.xml')
+            job = jobs.get(company, report)
+            if fetched_at(company, report) is not None:
+                if job is None:
+                    jobs.add(company, report, 'done')
+            elif store is None and os.path.exists(file_to_write):
+                # Files from before the job queue existed: an empty JSON list means IB had no data
+                if job is None:
+                    jobs.add(company, report, 'not_found', os.path.getmtime(file_to_write) + jobs.not_found_ttl)
+            elif job is None or job['status'] == 'done':
+                # New, or the file was removed to have it retrieved again
+                jobs.reset(company, report)
+
+    requests = [(contract_for(stock_ticker=company), report) for company, report in jobs.eligible() if company in companies_to_get and report in reports_to_request]
+    if args.budget is not None:
+        requests = requests[:args.budget]
+
+    # Refresh the reports that have gone stale, most valuable first, with what is left of the budget
+    scheduler = refresh_scheduler(period_ends=fiscal_period_ends(args.export) if args.fiscal_weighting else None)
+    candidates = []
+    for company in companies_to_get:
+        for report in reports_to_request:
+            job = jobs.get(company, report)
+            retrieved = fetched_at(company, report)
+            if job is not None and job['status'] == 'done' and retrieved is not None:
+                candidates += [(company, report, retrieved)]
+
+    refreshes = scheduler.schedule(candidates, None if args.budget is None else args.budget - len(requests))
+    print(f'{len(requests)} new or retried requests, {len(refreshes)} refreshes')
+    requests += [(contract_for(stock_ticker=company), report) for company, report in refreshes]
+
+    def write(store, symbol, report, data):
+        with metrics.stage('save', symbol=symbol, report=report) as m:
+            if store is not None:
+                store.put(symbol, report, data)
+            else:
+                with open(os.path.join(args.output, symbol, f'{report}.xml'), 'w') as file:
+                    file.write(data)
+            m['bytes_written'] = len(data)
+
+    # With --process, the responses go onto a bounded queue. A background thread stores them and hands them to the
+    # parser processes, so parsing overlaps with the retrieval. When the queue is full, the retrieval waits: the put
+    # runs in the default executor, so only the request that has to wait is held up, not the event loop.
+    responses = queue.Queue(maxsize=args.queue_size)
+    processor = process_xml.streaming_processor(args.export, workers=args.process_workers, queue_size=args.queue_size, metrics=metrics) if args.process else None
+
+    def consume():
+        # The thread opens the store itself, as SQLite connections can't be shared between threads
+        consumer_store = xml_store(args.store) if args.store is not None else None
+        while (response := responses.get()) is not None:
+            write(consumer_store, *response)
+            processor.submit(*response)
+        if consumer_store is not None:
+            consumer_store.close()
+
+    async def save(contract, report, fund, error):
+        if error is not None:
+            print(f'Failed to get {report} for {contract.symbol}: {error}')
+            jobs.failed(contract.symbol, report, error)
+            return
+
+        if not fund:
+            print(f'No {report} available for {contract.symbol}')
+            jobs.not_found(contract.symbol, report)
+            return
+
+        if processor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, responses.put, (contract.symbol, report, str(fund)))
+        else:
+            write(store, contract.symbol, report, str(fund))
+        jobs.done(contract.symbol, report)
+
+    fetcher = sharded_fetcher({client: fundamentals_fetcher(ib, max_in_flight=args.max_in_flight, rate=args.rate, burst=args.burst, timeout=args.timeout, metrics=metrics, client=client)
+                               for client, ib in connections.items()})
+    start = time.monotonic()
+    with metrics.stage('run', requests=len(requests)):
+        if processor is not None:
+            consumer = threading.Thread(target=consume)
+            consumer.start()
+            try:
+                util.run(fetcher.fetch_all(requests, save))
+            finally:
+                responses.put(None)
+                consumer.join()
+            print(fetcher.summary(time.monotonic() - start))
+            with metrics.stage('process'):
+                print(f'Processed {processor.close()} files into {args.export}')
+        else:
+            util.run(fetcher.fetch_all(requests, save))
+            print(fetcher.summary(time.monotonic() - start))
+    print(f'Total: {time.monotonic() - start:.1f} s')
+    print(f'Jobs: {jobs.counts()}')
+
+    if args.prices:
+        # Prices to value the fundamentals against, next to the export files of process-xml.py
+        with metrics.stage('prices'):
+            update_prices(companies_to_get, args.prices_cache, args.export, recorded_prices(args.fake_prices) if args.fake_prices is not None else yahoo_download, metrics=metrics)
+
+    jobs.close()
+    if store is not None:
+        store.close()
+    for ib in connections.values():
+        ib.disconnect()
+
+def parse_arguments(argv: list = None):
+    parser = argparse.ArgumentParser(description='Retrieve the fundamentals of all companies from Interactive Brokers.')
+    parser.add_argument('--output', default='fundamentals', help='Directory to store the fundamentals in (default: fundamentals)')
+    parser.add_argument('--client', action='append', metavar='HOST:PORT:CLIENTID',
+                        help='Gateway and clientId to retrieve with; repeat to spread the tickers over several connections (default: 127.0.0.1:7496:3)')
+    parser.add_argument('--max-in-flight', type=int, default=5, help='Maximum number of outstanding requests per client (default: 5)')
+    parser.add_argument('--rate', type=float, default=2.0, help='Maximum number of new requests per second per client, on average (default: 2)')
+    parser.add_argument('--burst', type=int, default=5, help='Maximum number of requests that can be sent at once per client (default: 5)')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for a response before a request is considered failed (default: 60)')
+    parser.add_argument('--store', help='Store the responses, with their history, in this compressed XML store instead of in --output')
+    parser.add_argument('--jobs-db', default='fetch_jobs.sqlite', help='SQLite database that keeps track of the retrieval jobs (default: fetch_jobs.sqlite)')
+    parser.add_argument('--not-found-ttl', type=float, default=30, help='Days before a report that IB had no data for is requested again (default: 30)')
+    parser.add_argument('--budget', type=int, help='Maximum number of requests in this run (default: no maximum)')
+    parser.add_argument('--fiscal-weighting', action='store_true', help='Refresh reports first when a fiscal period ended since they were retrieved, based on the parsed periods in --export')
+    parser.add_argument('--export', default='export', help='Export directory of process-xml.py, used by --fiscal-weighting and --process (default: export)')
+    parser.add_argument('--process', action='store_true', help='Process the responses while they are retrieved, and update the export files of process-xml.py in --export when done')
+    parser.add_argument('--process-workers', type=int, default=2, help='With --process: number of parser processes (default: 2)')
+    parser.add_argument('--queue-size', type=int, default=16, help='With --process: maximum number of responses waiting to be stored or parsed (default: 16)')
+    parser.add_argument('--prices', action='store_true', help='Also bring the daily price history of the companies up to date from Yahoo Finance, and write it to Prices_history.parquet in --export')
+    parser.add_argument('--prices-cache', default='prices', help='With --prices: directory of the per-symbol price cache (default: prices)')
+    parser.add_argument('--fake-ib', metavar='FIXTURE_DIR', help='Don\'t connect to IB, but serve the XML files in FIXTURE_DIR instead (for testing and benchmarking)')
+    parser.add_argument('--fake-latency', type=float, default=0.5, help='Simulated response time of --fake-ib in seconds (default: 0.5)')
+    parser.add_argument('--fake-prices', metavar='FIXTURE_DIR', help='With --prices: don\'t download, but serve the recorded responses in FIXTURE_DIR instead (for testing and benchmarking)')
+    parser.add_argument('--fake-disconnect-after', type=int, help='With --fake-ib: drop the connection of the first client after this many requests')
+    parser.add_argument('--fake-pacing-every', type=int, help='With --fake-ib: refuse every n-th request of a client with a pacing violation')
+    parser.add_argument('--fake-empty-every', type=int, help='With --fake-ib: answer every n-th request of a client with an empty response')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    args.client = ['127.0.0.1:7496:3'] if args.client is None else args.client
+    return args
+
+if __name__ == '__main__':
+    main(parse_arguments())
@@ -0,0 +1,183 @@
+import argparse
+import os
+import random
+from xml.sax.saxutils import escape
+
+
+# Estimate and actual types as they appear in RESC, most common first
+estimate_types = ['EPS', 'REVENUE', 'EBITDA', 'EBIT', 'NET', 'DPS', 'CPS', 'BPS', 'NAV', 'ROE', 'ROA', 'CAPEX', 'FFO', 'PRE', 'GPS']
+statement_types = ['BAL', 'INC', 'CAS']
+
+def fiscal_period_end(year, quarter=None):
+    month = 12 if quarter is None else 3 * quarter
+    return f'{year}-{month:02d}-{[31, 30, 30, 31][(month // 3) - 1]}'
+
+def reports_fin_statements(symbol: str, rnd: random.Random, years: int = 5, coa_items: int = 60):
+    """A ReportsFinStatements report with `years` annual and 4 * `years` interim periods, and `coa_items` COA codes per statement type."""
+    coa = [(f'{statement[0]}{i:03d}X', statement) for statement in statement_types for i in range(coa_items // len(statement_types))]
+    first_year = 2024 - years
+
+    out = ['<?xml version="1.0" encoding="UTF-8"?>', '<ReportFinancialStatements Major="1" Minor="0" Revision="1">']
+    out += [f'<CoIDs><CoID Type="RepNo">{symbol}R1</CoID><CoID Type="CompanyName">{escape(symbol)} Corp &amp; Co</CoID>'
+            f'<CoID Type="IRSNo">{rnd.randint(10, 99)}-{rnd.randint(1000000, 9999999)}</CoID><CoID Type="CIKNo">{rnd.randint(1, 9999999):010d}</CoID>'
+            f'<CoID Type="OrganizationPermID">{rnd.randint(4000000000, 5000000000)}</CoID></CoIDs>']
+    out += ['<Issues>']
+    for i in range(rnd.randint(1, 3)):
+        split = f'<MostRecentSplit Date="{rnd.randint(1990, 2023)}-0{rnd.randint(1, 9)}-1{rnd.randint(0, 9)}">{rnd.choice(["2.0", "1.5", "3.0"])}</MostRecentSplit>' if i == 0 else ''
+        out += [f'<Issue ID="{i + 1}" Type="C" Desc="Common Stock" Order="{i + 1}"><IssueID Type="Name">Ordinary Shares</IssueID>'
+                f'<IssueID Type="Ticker">{symbol}</IssueID><IssueID Type="RIC">{symbol}.N</IssueID><IssueID Type="DisplayRIC">{symbol}.N</IssueID>'
+                f'<IssueID Type="InstrumentPI">{rnd.randint(100000, 999999)}</IssueID><IssueID Type="QuotePI">{rnd.randint(100000, 999999)}</IssueID>'
+                f'<Exchange Code="{rnd.choice(["NYSE", "NASD", "AMEX"])}" Country="USA">New York Stock Exchange</Exchange>{split}</Issue>']
+    out += ['</Issues>']
+    out += ['<StatementInfo><COAType Code="IND">Industry</COAType><BalanceSheetDisplay Code="CLS">Classified</BalanceSheetDisplay><CashFlowMethod Code="IND">Indirect</CashFlowMethod></StatementInfo>']
+
+    out += ['<FinancialStatements><COAMap>']
+    for i, (code, statement) in enumerate(coa):
+        out += [f'<mapItem coaItem="{code}" statementType="{statement}" lineID="{i}" precision="1">Line item {code}</mapItem>']
+    out += ['</COAMap>']
+
+    for period_type, periods in (('Annual', years), ('Interim', years * 4)):
+        out += [f'<{period_type}Periods>']
+        for p in range(periods):
+            year = first_year + (p if period_type == 'Annual' else p // 4)
+            quarter = None if period_type == 'Annual' else p % 4 + 1
+            number = f' FiscalPeriodNumber="{quarter}"' if quarter is not None else ''
+            out += [f'<FiscalPeriod Type="{period_type}" EndDate="{fiscal_period_end(year, quarter)}" FiscalYear="{year}"{number}>']
+            for statement in statement_types:
+                # Some periods were restated: the statement appears again with a later source date
+                for restatement in range(2 if rnd.random() < 0.1 else 1):
+                    update_type = ('UPD', 'Updated Normal') if restatement == 0 else ('RES', 'Restated Normal')
+                    out += [f'<Statement Type="{statement}"><FPHeader><PeriodLength>{12 if quarter is None else 3}</PeriodLength>'
+                            f'<periodType Code="M">Months</periodType><UpdateType Code="{update_type[0]}">{update_type[1]}</UpdateType>'
+                            f'<StatementDate>{fiscal_period_end(year, quarter)}</StatementDate>'
+                            f'<Source Date="{year + 1}-0{2 + restatement}-1{rnd.randint(0, 9)}">{"10-K" if quarter is None else "10-Q"}</Source></FPHeader>']
+                    for code, coa_statement in coa:
+                        if coa_statement == statement and rnd.random() < 0.8:
+                            out += [f'<lineItem coaCode="{code}">{rnd.uniform(-1e4, 1e4):.2f}</lineItem>']
+                    out += ['</Statement>']
+            out += ['</FiscalPeriod>']
+        out += [f'</{period_type}Periods>']
+    out += ['</FinancialStatements></ReportFinancialStatements>']
+    return '\n'.join(out)
+
+def resc(symbol: str, rnd: random.Random, years: int = 4, estimates: int = 6):
+    """A RESC report with `years` of actuals and periods, and estimates for the next two years for `estimates` estimate types."""
+    first_year = 2024 - years
+    out = ['<?xml version="1.0" encoding="UTF-8"?>', '<REarnEstCons Version="1">', '<Company>']
+    out += [f'<CoName><Name>{escape(symbol)} Corp</Name></CoName><CoIds><CoId type="RepNo">{symbol}R1</CoId><CoId type="IssueID">1</CoId><CoId type="IsPrimaryIssue">1</CoId></CoIds>']
+    out += ['<SecurityInfo>']
+    for s in range(rnd.randint(1, 2)):
+        price = rnd.uniform(1, 500)
+        out += [f'<Security code="{s + 1}"><SecIds><SecId type="ISIN">US{rnd.randint(10**9, 10**10 - 1)}</SecId><SecId type="RIC">{symbol}.N</SecId>'
+                f'<SecId type="TICKER">{symbol}</SecId><SecId type="InstrumentPI">{rnd.randint(100000, 999999)}</SecId></SecIds><MarketData>'
+                f'<MarketDataItem type="CLPRICE" unit="U" currCode="USD">{price:.2f}</MarketDataItem>'
+                f'<MarketDataItem type="MARKETCAP" unit="M" currCode="USD">{price * rnd.uniform(10, 1000):.1f}</MarketDataItem>'
+                f'<MarketDataItem type="52WKHIGH" unit="U" currCode="USD">{price * 1.3:.2f}</MarketDataItem>'
+                f'<MarketDataItem type="52WKLOW" unit="U" currCode="USD">{price * 0.7:.2f}</MarketDataItem></MarketData></Security>']
+    out += ['</SecurityInfo>']
+    out += ['<CompanyInfo><Sector code="53" set="TRBC">Consumer Cyclicals</Sector><Primary type="Consensus">EPS</Primary><Primary type="Estimate">EPS</Primary>'
+            f'<Currency>USD</Currency><CurFiscalPeriod fYear="2024" fyem="12" periodType="A"/><CompanyPeriods>']
+    for y in range(years):
+        out += [f'<Annual fYear="{first_year + y}" periodLength="12" periodUnit="M" endMonth="12" fyNum="{y}">']
+        for q in range(4):
+            out += [f'<Interim type="Q" periodNum="{q + 1}" periodLength="3" periodUnit="M" endMonth="{3 * q + 3}" endCalYear="{first_year + y}"/>']
+        out += ['</Annual>']
+    out += ['</CompanyPeriods></CompanyInfo></Company>']
+
+    types = (estimate_types * (estimates // len(estimate_types) + 1))[:estimates]
+    types = [t if i < len(estimate_types) else f'{t}{i // len(estimate_types)}' for i, t in enumerate(types)]
+    out += ['<Actuals><FYActuals>']
+    for t in types:
+        out += [f'<FYActual type="{t}" unit="U">']
+        for y in range(years):
+            year = first_year + y
+            out += [f'<FYPeriod periodType="A" fYear="{year}" endMonth="12" endCalYear="{year}"><ActValue updated="{year + 1}-02-1{rnd.randint(0, 9)}T1{rnd.randint(0, 9)}:00:00">{rnd.uniform(0, 10):.3f}</ActValue></FYPeriod>']
+            for q in range(4):
+                if rnd.random() < 0.9:
+                    out += [f'<FYPeriod periodType="Q" fYear="{year}" endMonth="{3 * q + 3}" endCalYear="{year}"><ActValue updated="{year}-{3 * q + 4 if q < 3 else 12:02d}-20T08:00:00">{rnd.uniform(0, 3):.3f}</ActValue></FYPeriod>']
+        out += ['</FYActual>']
+    out += ['</FYActuals></Actuals><ConsEstimates><FYEstimates>']
+    for t in types:
+        out += [f'<FYEstimate type="{t}" unit="U">']
+        for year in (2024, 2025):
+            for period_type, periods in (('A', 1), ('Q', 4)):
+                for q in range(periods):
+                    out += [f'<FYPeriod periodType="{period_type}" fYear="{year}" endMonth="{12 if period_type == "A" else 3 * q + 3}" endCalYear="{year}">']
+                    for estimate in ['High', 'Low', 'Mean', 'Median', 'StdDev', 'NumOfEst']:
+                        if rnd.random() < 0.9:
+                            date_types = ['CURR', '1MA', '3MA'] if estimate == 'Mean' else ['CURR']
+                            value = lambda: f'{rnd.randint(1, 30)}' if estimate == 'NumOfEst' else f'{rnd.uniform(0, 5):.2f}'
+                            out += [f'<ConsEstimate type="{estimate}">' + ''.join(f'<ConsValue dateType="{d}">{value()}</ConsValue>' for d in date_types) + '</ConsEstimate>']
+                    out += ['</FYPeriod>']
+        out += ['</FYEstimate>']
+    out += ['</FYEstimates><NPEstimates>']
+    for t in ['NPE1', 'NPE2']:
+        out += [f'<NPEstimate type="{t}" unit="U">' + ''.join(f'<ConsEstimate type="{e}"><ConsValue dateType="CURR">{rnd.uniform(0, 5):.2f}</ConsValue></ConsEstimate>' for e in ['High', 'Low', 'Mean', 'Median']) + '</NPEstimate>']
+    out += ['</NPEstimates></ConsEstimates></REarnEstCons>']
+    return '\n'.join(out)
+
+def report_snapshot(symbol: str, rnd: random.Random):
+    out = ['<?xml version="1.0" encoding="UTF-8"?>', '<ReportSnapshot Major="1" Minor="0" Revision="1">']
+    out += [f'<CoIDs><CoID Type="RepNo">{symbol}R1</CoID><CoID Type="CompanyName">{escape(symbol)} Corp</CoID><CoID Type="IRSNo">{rnd.randint(10, 99)}-{rnd.randint(1000000, 9999999)}</CoID>'
+            f'<CoID Type="CIKNo">{rnd.randint(1, 9999999):010d}</CoID><CoID Type="OrganizationPermID">{rnd.randint(4000000000, 5000000000)}</CoID></CoIDs>']
+    out += [f'<Issues><Issue ID="1" Type="C" Desc="Common Stock" Order="1"><IssueID Type="Name">Ordinary Shares</IssueID><IssueID Type="Ticker">{symbol}</IssueID>'
+            f'<IssueID Type="RIC">{symbol}.N</IssueID><IssueID Type="DisplayRIC">{symbol}.N</IssueID><Exchange Code="NASD" Country="USA">NASDAQ</Exchange></Issue></Issues>']
+    out += ['<CoGeneralInfo><LatestAvailableAnnual>2023-12-31</LatestAvailableAnnual><LatestAvailableInterim>2024-03-31</LatestAvailableInterim>'
+            f'<ReportingCurrency Code="USD">U.S. Dollars</ReportingCurrency><SharesOut Date="2024-03-31">{rnd.uniform(1e6, 1e9):.1f}</SharesOut></CoGeneralInfo>']
+    out += ['<TextInfo><Text Type="Business Summary">Designs, manufactures and sells products.</Text><Text Type="Financial Summary">Revenues increased.</Text></TextInfo>']
+    out += ['<peerInfo lastUpdated="2024-04-02T05:09:53"><IndustryInfo><Industry type="TRBC" order="1" code="5320201010">Retail</Industry>'
+            + ''.join(f'<Industry type="NAICS" order="{i}" code="4{i}{rnd.randint(1000, 9999)}">Industry {i}</Industry>' for i in range(1, rnd.randint(2, 6)))
+            + ''.join(f'<Industry type="SIC" order="{i}" code="5{i}{rnd.randint(10, 99)}">Industry {i}</Industry>' for i in range(1, rnd.randint(2, 6)))
+            + '</IndustryInfo></peerInfo>']
+    out += ['<webLinks><webSite mainCategory="Home Page">https://www.example.com/</webSite><webSite mainCategory="Company Contact/E-mail">ir@example.com</webSite></webLinks>']
+    out += ['<Ratios PriceCurrency="USD" ReportingCurrency="USD" ExchangeRate="1.00000" LatestAvailableDate="2024-03-31">']
+    groups = [
+        ('Price and Volume', ['NPRICE', 'NHIG', 'NLOW', 'PDATE', 'VOL10DAVG', 'EV']),
+        ('Income Statement', ['MKTCAP', 'TTMREV', 'TTMEBITD', 'TTMNIAC']),
+        ('Per share data', ['TTMEPSXCLX', 'TTMREVPS', 'QBVPS', 'QCSHPS', 'TTMCFSHR', 'TTMDIVSHR']),
+        ('Other Ratios', ['TTMGROSMGN', 'TTMROEPCT', 'TTMPR2REV', 'PEEXCLXOR', 'PRICE2BK', 'Employees']),
+    ]
+    for group, fields in groups:
+        out += [f'<Group ID="{group}">' + ''.join(
+            f'<Ratio FieldName="PDATE" Type="D">2024-04-0{rnd.randint(1, 5)}T00:00:00</Ratio>' if field == 'PDATE' else f'<Ratio FieldName="{field}" Type="N">{rnd.uniform(0, 100):.5f}</Ratio>'
+            for field in fields) + '</Group>']
+    out += ['</Ratios>']
+    out += ['<ForecastData ConsensusType="Mean" CurFiscalYear="2024" CurFiscalYearEndMonth="12" CurInterimEndCalYear="2024" CurInterimEndMonth="6" EarningsBasis="PRX">']
+    for field in ['ConsRecom', 'TargetPrice', 'ProjLTGrowthRate', 'ProjPE', 'ProjSales', 'ProjSalesQ', 'ProjEPS', 'ProjEPSQ', 'ProjProfit', 'ProjDPS']:
+        out += [f'<Ratio FieldName="{field}" Type="N"><Value PeriodType="CURR">{rnd.uniform(0, 100):.5f}</Value></Ratio>']
+    out += ['</ForecastData></ReportSnapshot>']
+    return '\n'.join(out)
+
+def generate(directory: str = 'fundamentals', companies: int = 10, years: int = 5, coa_items: int = 60, estimates: int = 6, not_found: float = 0.1, seed: int = 0):
+    """
+    Write synthetic fundamentals for `companies` symbols (S0000, S0001, ...) in the layout of the fundamentals directory.
+    A fraction `not_found` of the reports is an empty JSON list, like the reports IB has no data for.
+    The output only depends on the arguments.
+    """
+    generators = {
+        'ReportsFinStatements': lambda symbol, rnd: reports_fin_statements(symbol, rnd, years, coa_items),
+        'RESC': lambda symbol, rnd: resc(symbol, rnd, years, estimates),
+        'ReportSnapshot': report_snapshot,
+    }
+    for i in range(companies):
+        symbol = f'S{i:04d}'
+        os.makedirs(os.path.join(directory, symbol), exist_ok=True)
+        for report, generator in generators.items():
+            rnd = random.Random(f'{seed}/{symbol}/{report}')
+            data = '[]' if rnd.random() < not_found else generator(symbol, rnd)
+            with open(os.path.join(directory, symbol, f'{report}.xml'), 'w') as f:
+                f.write(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic IB fundamentals XML for testing and benchmarking.')
+    parser.add_argument('directory', nargs='?', default='fundamentals', help='Directory to write the fundamentals to (default: fundamentals)')
+    parser.add_argument('--companies', type=int, default=10, help='Number of companies (default: 10)')
+    parser.add_argument('--years', type=int, default=5, help='Number of fiscal years of statements, actuals and periods (default: 5)')
+    parser.add_argument('--coa-items', type=int, default=60, help='Number of COA items, over the three statement types (default: 60)')
+    parser.add_argument('--estimates', type=int, default=6, help='Number of estimate types in RESC (default: 6)')
+    parser.add_argument('--not-found', type=float, default=0.1, help='Fraction of reports that IB has no data for (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    generate(args.directory, args.companies, args.years, args.coa_items, args.estimates, args.not_found, args.seed)
+    print(f'Generated {args.companies} companies in {args.directory}')
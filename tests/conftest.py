@@ -0,0 +1,16 @@
+import importlib.util
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+def load_script(file_name: str, module_name: str = None):
+    """Import one of the scripts by file name (e.g. process-xml.py), which can't be imported by name."""
+    module_name = module_name or file_name[:-len('.py')].replace('-', '_')
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(root, file_name))
+    module = sys.modules[module_name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,60 @@
+import random
+import pytest
+from conftest import load_script
+from synthetic_fundamentals import report_snapshot, reports_fin_statements, resc
+
+process_xml = load_script('process-xml.py')
+
+class per_row_builder(process_xml.column_builder):
+    """The padding of _xml_processor before column_builder: the longest column is looked up again for every column of every row."""
+    def close_element(self, rowno: int, toplevelattributes: dict = {}, fixed_columns: dict = {}):
+        column_data = self.column_data
+        for key, value in toplevelattributes.items():
+            column_data[key] += [ value ] * (max([len(a) for a in column_data.values()] + [rowno]) - len(column_data[key]))
+        for key, value in fixed_columns.items():
+            column_data[key] += [ value ] * (max([len(a) for a in column_data.values()] + [rowno]) - len(column_data[key]))
+        for key in column_data:
+            column_data[key] += [None] * (max([len(a) for a in column_data.values()] + [rowno]) - len(column_data[key]))
+        self.rows = max([len(a) for a in column_data.values()] + [rowno])
+
+generators = {
+    'ReportsFinStatements': lambda symbol, rnd: reports_fin_statements(symbol, rnd, years=3, coa_items=30),
+    'RESC': lambda symbol, rnd: resc(symbol, rnd, years=3, estimates=6),
+    'ReportSnapshot': report_snapshot,
+}
+
+def process_all(xml, report_type, schema):
+    processor = process_xml.functionmapping[report_type].from_string(xml)
+    if schema:
+        return {subreport: processor.process_table(subreport) for subreport in processor.processing_methods}
+    # Without the output schemas, every column is text, as it was extracted
+    return {subreport: method() for subreport, (method, _) in processor.processing_methods.items()}
+
+@pytest.mark.parametrize('schema', [False, True])
+@pytest.mark.parametrize('report_type', list(generators))
+def test_column_builder_matches_per_row_padding(monkeypatch, report_type, schema):
+    for seed in range(3):
+        xml = generators[report_type](f'S{seed:04d}', random.Random(f'{seed}/{report_type}'))
+        tables = process_all(xml, report_type, schema)
+        with monkeypatch.context() as m:
+            m.setattr(process_xml, 'column_builder', per_row_builder)
+            expected = process_all(xml, report_type, schema)
+
+        assert tables.keys() == expected.keys()
+        for subreport, table in tables.items():
+            assert table.equals(expected[subreport]), f'{report_type} {subreport} differs'
+
+def test_column_builder_pads_uneven_elements():
+    # Elements with several values in a column, with none at all, and with values in some columns only
+    elements = [({'a': ['1', '2', '3'], 'b': ['x']}, 'first'), ({}, 'second'), ({'b': ['y', 'z']}, 'third'), ({'a': ['4']}, 'fourth')]
+    builders = [process_xml.column_builder(['a', 'b', 'element', 'fixed']), per_row_builder(['a', 'b', 'element', 'fixed'])]
+    for builder in builders:
+        for rowno, (values, element) in enumerate(elements, 1):
+            for key, column_values in values.items():
+                builder.column_data[key] += column_values
+            builder.close_element(rowno, {'element': element}, {'fixed': 'F'})
+
+    assert builders[0].rows == builders[1].rows == 6
+    assert builders[0].to_table().equals(builders[1].to_table())
+    # An element without values only adds a row when there are fewer rows than elements so far
+    assert builders[0].to_table().column('element').to_pylist() == ['first'] * 3 + ['third', 'third', 'fourth']
@@ -0,0 +1,53 @@
+import datetime
+import numpy as np
+import pandas as pd
+from conftest import load_script
+
+derive_metrics = load_script('derive-metrics.py')
+
+def statement(symbol, statement_type, end_date, year, number, values, months=3, source_date=None, update_type='UPD'):
+    return dict({'symbol': symbol, 'reportType': 'ReportsFinStatements', 'StatementType': statement_type, 'FiscalPeriodEndDate': end_date,
+                 'FiscalPeriodYear': year, 'FiscalPeriodNumber': number, 'PeriodLength': months, 'periodTypeCode': 'M',
+                 'UpdateTypeCode': update_type, 'SourceDate': source_date or end_date + datetime.timedelta(days=30)}, **values)
+
+quarter_ends = [datetime.date(2021, 3, 31), datetime.date(2021, 6, 30), datetime.date(2021, 9, 30), datetime.date(2021, 12, 31)]
+
+def figures(metrics, coa, column):
+    return metrics[metrics['COA'] == coa][column].tolist()
+
+def test_year_to_date_figures_are_decumulated():
+    # Cash flow statements report the year so far: 3, 6, 9 and 12 months
+    df = pd.DataFrame([statement('S0001', 'CAS', end, 2021, n + 1, {'OTLO': value}, months=3 * (n + 1))
+                       for n, (end, value) in enumerate(zip(quarter_ends, [10.0, 25.0, 45.0, 70.0]))])
+    metrics = derive_metrics.derive_metrics(df)
+
+    assert figures(metrics, 'OTLO', 'quarter_value') == [10.0, 15.0, 20.0, 25.0]
+    assert figures(metrics, 'OTLO', 'ttm')[-1] == 70.0
+
+def test_missing_quarter_gives_nan():
+    df = pd.DataFrame([statement('S0001', 'INC', quarter_ends[n], 2021, n + 1, {'RTLR': 100.0 + n}) for n in (0, 1, 3)])
+    metrics = derive_metrics.derive_metrics(df)
+
+    qoq = figures(metrics, 'RTLR', 'qoq_growth')
+    assert qoq[1] == 0.01
+    # The third quarter is missing: the fourth has no growth over the quarter before, and no TTM
+    assert np.isnan(qoq[2]) and np.isnan(figures(metrics, 'RTLR', 'ttm')[2])
+
+def test_restatement_wins_over_the_original():
+    end = quarter_ends[0]
+    df = pd.DataFrame([statement('S0001', 'BAL', end, 2021, 1, {'ATOT': 10.0}, update_type='RES'),
+                       statement('S0001', 'BAL', end, 2021, 1, {'ATOT': 12.0}, update_type='UPD')])
+    assert figures(derive_metrics.derive_metrics(df), 'ATOT', 'value') == [10.0]
+
+    # A later source date wins, and statements without an update type are taken as they are
+    df = pd.DataFrame([statement('S0001', 'BAL', end, 2021, 1, {'ATOT': 10.0}, update_type='RES'),
+                       statement('S0001', 'BAL', end, 2021, 1, {'ATOT': 11.0}, source_date=end + datetime.timedelta(days=90))])
+    assert figures(derive_metrics.derive_metrics(df), 'ATOT', 'value') == [11.0]
+    assert figures(derive_metrics.derive_metrics(df.drop(columns='UpdateTypeCode')), 'ATOT', 'value') == [11.0]
+
+def test_ratios_only_for_reported_periods():
+    df = pd.DataFrame([statement('S0001', 'BAL', quarter_ends[0], 2021, 1, {'ATCA': 50.0, 'LTCL': 25.0}),
+                       statement('S0004', 'BAL', quarter_ends[1], 2021, 2, {'ATCA': 30.0, 'LTCL': 10.0})])
+    ratios = derive_metrics.derive_ratios(derive_metrics.derive_metrics(df))
+
+    assert ratios[['symbol', 'current_ratio']].values.tolist() == [['S0001', 2.0], ['S0004', 3.0]]
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import queue
+import random
+import pytest
+from ib_insync import Stock
+from conftest import load_script
+from fake_ib import fake_ib
+from fetch_jobs import fetch_job_queue
+from ib_fetcher import fundamentals_fetcher, sharded_fetcher
+from synthetic_fundamentals import report_snapshot
+
+retrieve = load_script('retrieve-information.py')
+
+symbols = ['AAA', 'BBB', 'CCC', 'DDD']
+reports = ['ReportsFinStatements', 'ReportSnapshot']
+
+@pytest.fixture
+def fixtures(tmp_path):
+    # Every symbol but DDD has its reports; IB has no data for DDD
+    for symbol in symbols[:-1]:
+        (tmp_path / 'fixtures' / symbol).mkdir(parents=True)
+        for report in reports:
+            (tmp_path / 'fixtures' / symbol / f'{report}.xml').write_text(f'<{report} symbol="{symbol}"/>')
+    return tmp_path / 'fixtures'
+
+def connected(fixtures, **options):
+    # Like retrieve-information.py sets up its connections
+    ib = fake_ib(str(fixtures), latency=0.01, **options).connect()
+    ib.RaiseRequestErrors = True
+    return ib
+
+def fetch(fetcher, requests):
+    results = {}
+    asyncio.run(fetcher.fetch_all(requests, lambda contract, report, data, error: results.__setitem__((contract.symbol, report), (data, error))))
+    return results
+
+def all_requests():
+    return [(Stock(symbol, 'SMART', 'USD'), report) for symbol in symbols for report in reports]
+
+def test_fetcher_reports_pacing_violations_as_errors(fixtures):
+    fetcher = fundamentals_fetcher(connected(fixtures, pacing_every=3), max_in_flight=1, rate=1000, burst=10)
+    results = fetch(fetcher, all_requests())
+
+    errors = [key for key, (data, error) in results.items() if error is not None]
+    assert len(results) == 8 and len(errors) == 2 and fetcher.failures == 2
+    assert all('100' in results[key][1] for key in errors)
+
+def test_fetcher_reports_missing_data_as_empty(fixtures):
+    fetcher = fundamentals_fetcher(connected(fixtures), max_in_flight=1, rate=1000, burst=10)
+    results = fetch(fetcher, all_requests())
+
+    assert all(results[('DDD', report)] == ([], None) for report in reports)
+    assert fetcher.failures == 0
+
+def test_client_without_raised_errors_answers_pacing_violations_empty(fixtures):
+    # The default of ib_insync: a pacing violation can't be told apart from missing data
+    ib = fake_ib(str(fixtures), latency=0.01, pacing_every=3).connect()
+    results = fetch(fundamentals_fetcher(ib, max_in_flight=1, rate=1000, burst=10), all_requests())
+
+    assert sum(1 for data, error in results.values() if data == []) == 2 + 2
+
+def test_fetcher_passes_empty_responses_on(fixtures):
+    fetcher = fundamentals_fetcher(connected(fixtures, empty_every=2), max_in_flight=1, rate=1000, burst=10)
+    results = fetch(fetcher, all_requests())
+
+    assert sum(1 for data, error in results.values() if error is None and not data) == 5
+    assert fetcher.failures == 0
+
+def test_sharded_fetcher_moves_requests_of_a_dropped_connection(fixtures):
+    clients = {name: fundamentals_fetcher(connected(fixtures, disconnect_after=disconnect_after), max_in_flight=2, rate=1000, burst=10)
+               for name, disconnect_after in [('a', 1), ('b', None)]}
+    fetcher = sharded_fetcher(clients)
+    results = fetch(fetcher, all_requests())
+
+    assert fetcher.live == ['b']
+    assert all(error is None for data, error in results.values()) and len(results) == 8
+    assert results[('AAA', 'ReportSnapshot')][0] == '<ReportSnapshot symbol="AAA"/>'
+
+def test_sharded_fetcher_fails_requests_without_connections(fixtures):
+    fetcher = sharded_fetcher({'a': fundamentals_fetcher(connected(fixtures, disconnect_after=2), max_in_flight=1, rate=1000, burst=10)})
+    results = fetch(fetcher, all_requests())
+
+    assert fetcher.live == []
+    assert [error for data, error in results.values()].count(None) == 1
+    # The request that lost the connection is assigned again, and fails like the ones that were waiting
+    assert set(error for data, error in results.values() if error is not None) == {'No connection left'}
+
+def test_fetcher_hands_results_off_without_blocking_the_loop(fixtures):
+    handed_off = queue.Queue(maxsize=1)
+
+    async def on_result(contract, report, data, error):
+        await asyncio.get_running_loop().run_in_executor(None, handed_off.put, (contract.symbol, report))
+
+    async def consume():
+        # The results are taken off the queue by a coroutine, which only gets to run if the puts don't block the loop
+        fetcher = fundamentals_fetcher(connected(fixtures), max_in_flight=2, rate=1000, burst=10)
+        task = asyncio.ensure_future(fetcher.fetch_all(all_requests(), on_result))
+        received = []
+        while len(received) < 8:
+            await asyncio.sleep(0.005)
+            if not handed_off.empty():
+                received += [handed_off.get_nowait()]
+        await task
+        return received
+
+    assert len(set(asyncio.run(asyncio.wait_for(consume(), 10)))) == 8
+
+def run(tmp_path, fixtures, monkeypatch, *options):
+    monkeypatch.setattr(retrieve, 'companies_to_get', symbols)
+    monkeypatch.setattr(retrieve, 'reports_to_request', reports)
+    retrieve.main(retrieve.parse_arguments(['--fake-ib', str(fixtures), '--fake-latency', '0.01', '--rate', '1000', '--burst', '10',
+                                            '--output', str(tmp_path / 'fundamentals'), '--jobs-db', str(tmp_path / 'jobs.sqlite'),
+                                            '--export', str(tmp_path / 'export'), *options]))
+    jobs = fetch_job_queue(str(tmp_path / 'jobs.sqlite'))
+    states = {(symbol, report): jobs.get(symbol, report) for symbol in symbols for report in reports}
+    jobs.close()
+    return states
+
+def test_retrieve_marks_jobs_done_and_not_found(tmp_path, fixtures, monkeypatch):
+    states = run(tmp_path, fixtures, monkeypatch)
+
+    assert {key: job['status'] for key, job in states.items()} == {(symbol, report): 'done' if symbol != 'DDD' else 'not_found' for symbol in symbols for report in reports}
+    assert (tmp_path / 'fundamentals' / 'AAA' / 'ReportSnapshot.xml').read_text() == '<ReportSnapshot symbol="AAA"/>'
+
+def test_retrieve_retries_pacing_violations(tmp_path, fixtures, monkeypatch):
+    states = run(tmp_path, fixtures, monkeypatch, '--fake-pacing-every', '3', '--max-in-flight', '1')
+
+    failed = {key: job for key, job in states.items() if job['status'] == 'failed'}
+    assert len(failed) == 2
+    assert all(job['attempts'] == 1 and '100' in job['last_error'] and job['next_eligible'] > 0 for job in failed.values())
+    assert not any((tmp_path / 'fundamentals' / symbol / f'{report}.xml').exists() for symbol, report in failed)
+
+    # The next run, once the backoff is over, retrieves them
+    jobs = fetch_job_queue(str(tmp_path / 'jobs.sqlite'))
+    for symbol, report in failed:
+        jobs.reset(symbol, report)
+    jobs.close()
+    states = run(tmp_path, fixtures, monkeypatch)
+    assert all(states[key]['status'] == 'done' for key in failed)
+
+def test_retrieve_marks_empty_responses_not_found(tmp_path, fixtures, monkeypatch):
+    states = run(tmp_path, fixtures, monkeypatch, '--fake-empty-every', '2', '--max-in-flight', '1')
+
+    statuses = [job['status'] for job in states.values()]
+    assert statuses.count('done') == 3 and statuses.count('not_found') == 5
+    assert all(job['next_eligible'] > 0 for job in states.values() if job['status'] == 'not_found')
+
+def test_retrieve_after_a_disconnect(tmp_path, fixtures, monkeypatch):
+    states = run(tmp_path, fixtures, monkeypatch, '--fake-disconnect-after', '2', '--max-in-flight', '1')
+
+    statuses = [job['status'] for job in states.values()]
+    assert statuses.count('done') == 1 and statuses.count('failed') == 7
+    assert {job['last_error'] for job in states.values() if job['status'] == 'failed'} == {'No connection left'}
+
+def test_retrieve_moves_jobs_of_a_dropped_client(tmp_path, fixtures, monkeypatch):
+    states = run(tmp_path, fixtures, monkeypatch, '--fake-disconnect-after', '1', '--client', '127.0.0.1:7496:3', '--client', '127.0.0.1:7496:4')
+
+    assert {key: job['status'] for key, job in states.items()} == {(symbol, report): 'done' if symbol != 'DDD' else 'not_found' for symbol in symbols for report in reports}
+
+def test_retrieve_processes_responses_while_retrieving(tmp_path, fixtures, monkeypatch):
+    for symbol in symbols[:-1]:
+        (fixtures / symbol / 'ReportSnapshot.xml').write_text(report_snapshot(symbol, random.Random(symbol)))
+    states = run(tmp_path, fixtures, monkeypatch, '--process', '--process-workers', '1', '--queue-size', '1')
+
+    assert {key: job['status'] for key, job in states.items()} == {(symbol, report): 'done' if symbol != 'DDD' else 'not_found' for symbol in symbols for report in reports}
+    assert os.path.exists(tmp_path / 'export' / 'ReportSnapshot_ratios.parquet')
@@ -0,0 +1,91 @@
+from datetime import date
+import pandas as pd
+import pytest
+from price_history import price_cache, price_columns, recorded_prices
+
+def write_fixture(fixture_dir, symbol, days, dividends={}, splits={}):
+    # A recorded response: a price history with an adjusted close that depends on the dividends paid since, as Yahoo
+    # adjusts it: by 1 - dividend / close of the day before, for every later dividend
+    index = pd.bdate_range('2026-01-01', periods=days, name='Date')
+    prices = pd.DataFrame({col: 10.0 for col in price_columns}, index=index)
+    prices['Volume'] = 1000
+    prices['Dividends'] = [dividends.get(day.date(), 0.0) for day in index]
+    prices['Stock Splits'] = [splits.get(day.date(), 0.0) for day in index]
+    prices['Adj Close'] = 10.0 * (1 - prices['Dividends'] / 10.0)[::-1].cumprod()[::-1].shift(-1, fill_value=1.0)
+    prices.to_csv(fixture_dir / f'{symbol}.csv')
+    return prices
+
+@pytest.fixture
+def fixtures(tmp_path):
+    (tmp_path / 'fixtures').mkdir()
+    return tmp_path / 'fixtures'
+
+def test_update_downloads_the_missing_days(tmp_path, fixtures):
+    write_fixture(fixtures, 'S0001', 20)
+    download = recorded_prices(fixtures)
+    cache = price_cache(tmp_path / 'prices', download=download, start=date(2026, 1, 1))
+
+    assert cache.update(['S0001'], today=date(2026, 1, 8)) == {'S0001': 5}
+    assert cache.update(['S0001'], today=date(2026, 1, 8)) == {'S0001': 0}
+    assert cache.update(['S0001'], today=date(2026, 1, 15)) == {'S0001': 5}
+
+    assert download.requests == [('S0001', date(2026, 1, 1), date(2026, 1, 8)), ('S0001', date(2026, 1, 8), date(2026, 1, 15))]
+    assert len(cache.history('S0001')) == 10
+
+def test_update_downloads_history_again_after_a_split(tmp_path, fixtures):
+    cache_dir = tmp_path / 'prices'
+    for symbol in ('S0001', 'S0002', 'S0003'):
+        write_fixture(fixtures, symbol, 20)
+    price_cache(cache_dir, download=recorded_prices(fixtures), start=date(2026, 1, 1)).update(['S0001', 'S0002', 'S0003'], today=date(2026, 1, 8))
+
+    # The recorded responses of the next run have a split, and the earlier prices are different
+    expected = {symbol: write_fixture(fixtures, symbol, 20, splits={date(2026, 1, 12): 2.0}) for symbol in ('S0001', 'S0002')}
+    download = recorded_prices(fixtures)
+    cache = price_cache(cache_dir, download=download, start=date(2026, 1, 1))
+    assert cache.update(['S0001', 'S0002', 'S0003'], today=date(2026, 1, 15)) == {'S0001': 10, 'S0002': 10, 'S0003': 5}
+
+    # The symbols with a split are downloaded again together
+    assert download.calls == 2
+    assert download.requests[-2:] == [('S0001', date(2026, 1, 1), date(2026, 1, 15)), ('S0002', date(2026, 1, 1), date(2026, 1, 15))]
+    for symbol in ('S0001', 'S0002'):
+        pd.testing.assert_frame_equal(cache.history(symbol), expected[symbol].iloc[:10], check_freq=False, check_dtype=False)
+
+def test_dividends_adjust_the_cached_history(tmp_path, fixtures):
+    cache_dir = tmp_path / 'prices'
+    write_fixture(fixtures, 'S0001', 20, dividends={date(2026, 1, 5): 1.0})
+    price_cache(cache_dir, download=recorded_prices(fixtures), start=date(2026, 1, 1)).update(['S0001'], today=date(2026, 1, 8))
+
+    # The next runs each have a dividend: the earlier adjusted closes are different, but only the new days are downloaded
+    download = recorded_prices(fixtures)
+    cache = price_cache(cache_dir, download=download, start=date(2026, 1, 1))
+    write_fixture(fixtures, 'S0001', 20, dividends={date(2026, 1, 5): 1.0, date(2026, 1, 12): 0.5})
+    assert cache.update(['S0001'], today=date(2026, 1, 15)) == {'S0001': 5}
+    expected = write_fixture(fixtures, 'S0001', 20, dividends={date(2026, 1, 5): 1.0, date(2026, 1, 12): 0.5, date(2026, 1, 19): 0.5})
+    assert cache.update(['S0001'], today=date(2026, 1, 22)) == {'S0001': 5}
+
+    assert download.requests == [('S0001', date(2026, 1, 8), date(2026, 1, 15)), ('S0001', date(2026, 1, 15), date(2026, 1, 22))]
+    pd.testing.assert_frame_equal(cache.history('S0001'), expected.iloc[:15], check_freq=False, check_dtype=False)
+
+def test_symbols_without_prices_are_retried_after_retry_days(tmp_path, fixtures):
+    write_fixture(fixtures, 'S0001', 20)
+    download = recorded_prices(fixtures)
+    price_cache(tmp_path / 'prices', download=download, start=date(2026, 1, 1), retry_days=7).update(['S0001', 'S0002'], today=date(2026, 1, 8))
+
+    # The negative cache is kept in the cache directory, for the next run
+    cache = price_cache(tmp_path / 'prices', download=download, start=date(2026, 1, 1), retry_days=7)
+    cache.update(['S0001', 'S0002'], today=date(2026, 1, 9))
+    assert [request for request in download.requests if request[0] == 'S0002'] == [('S0002', date(2026, 1, 1), date(2026, 1, 8))]
+
+    # Once it has prices, it is cached like the others
+    write_fixture(fixtures, 'S0002', 20)
+    assert cache.update(['S0001', 'S0002'], today=date(2026, 1, 15)) == {'S0001': 4, 'S0002': 10}
+    assert [request for request in download.requests if request[0] == 'S0002'][-1] == ('S0002', date(2026, 1, 1), date(2026, 1, 15))
+    assert cache.no_prices == {}
+
+def test_export_skips_the_negative_cache(tmp_path, fixtures):
+    write_fixture(fixtures, 'S0001', 5)
+    cache = price_cache(tmp_path / 'prices', download=recorded_prices(fixtures), start=date(2026, 1, 1))
+    cache.update(['S0001', 'S0002'], today=date(2026, 1, 8))
+
+    assert cache.export(str(tmp_path / 'Prices_history.parquet')) == 5
+    assert pd.read_parquet(tmp_path / 'Prices_history.parquet')['symbol'].unique().tolist() == ['S0001']
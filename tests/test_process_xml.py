@@ -0,0 +1,104 @@
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from conftest import load_script
+from export_tables import export_version
+from synthetic_fundamentals import generate
+
+process_xml = load_script('process-xml.py')
+
+@pytest.fixture
+def fundamentals(tmp_path, monkeypatch):
+    # process-xml.py reads the fundamentals directory in the working directory
+    monkeypatch.chdir(tmp_path)
+    generate(str(tmp_path / 'fundamentals'), companies=3, years=2, coa_items=12, estimates=3, not_found=0)
+    return tmp_path / 'fundamentals'
+
+def partitions(path):
+    return sorted(entry.split('=')[0] for entry in os.listdir(path) if '=' in entry)
+
+def test_datasets_are_written_again_when_partition_by_changes(tmp_path, fundamentals):
+    export_dir = str(tmp_path / 'export')
+    process_xml.main(export_dir=export_dir, layout='dataset', partition_by=['symbol'])
+    assert set(partitions(f'{export_dir}/dataset/ReportSnapshot_ratios')) == {'symbol'}
+    assert process_xml.processing_manifest(export_dir).partition_by == ['symbol']
+
+    # Nothing changed in the fundamentals, but the datasets are partitioned differently
+    process_xml.main(export_dir=export_dir, layout='dataset', partition_by=['reportType'])
+    assert set(partitions(f'{export_dir}/dataset/ReportSnapshot_ratios')) == {'reportType'}
+    assert set(partitions(f'{export_dir}/dataset/ReportsFinStatements_balance_sheet_annual')) == {'reportType'}
+    assert process_xml.processing_manifest(export_dir).partition_by == ['reportType']
+
+    # A run that only writes the files keeps the partitioning of the datasets
+    process_xml.main(export_dir=export_dir, layout='files')
+    assert process_xml.processing_manifest(export_dir).partition_by == ['reportType']
+
+def test_manifest_of_another_version_is_rebuilt(tmp_path, fundamentals):
+    export_dir = str(tmp_path / 'export')
+    process_xml.main(export_dir=export_dir)
+    with open(f'{export_dir}/manifest.json') as f:
+        manifest = json.load(f)
+    stale = tmp_path / 'export' / 'frames' / 'RESC' / 'S0000-0000000000000000.pickle'
+    stale.write_bytes(b'')
+    with open(f'{export_dir}/manifest.json', 'w') as f:
+        json.dump(dict(manifest, version=process_xml.frames_version - 1), f)
+
+    assert process_xml.processing_manifest(export_dir).entries == {}
+    assert not stale.exists()
+    process_xml.main(export_dir=export_dir)
+    assert process_xml.processing_manifest(export_dir).entries.keys() == manifest['entries'].keys()
+
+def test_frames_are_arrow_streams(tmp_path, fundamentals):
+    export_dir = str(tmp_path / 'export')
+    process_xml.main(export_dir=export_dir)
+
+    manifest = process_xml.processing_manifest(export_dir)
+    for entry in manifest.entries.values():
+        for subreport_type, info in entry['subreports'].items():
+            assert info['frames'].endswith('.arrows')
+            with open(info['frames'], 'rb') as f:
+                f.seek(info['offset'])
+                table = pa.ipc.open_stream(f).read_all()
+            assert table.num_rows == info['rows'] and table.column_names[-2:] == ['symbol', 'reportType']
+
+def test_deltas_record_the_export_versions(tmp_path):
+    name = 'ReportSnapshot_forecast_data'
+    old, new = tmp_path / 'old.parquet', tmp_path / 'new.parquet'
+    pd.DataFrame({'ConsRecom': [1.5, 2.5], 'symbol': ['S0001', 'S0004']}).to_parquet(old)
+    pd.DataFrame({'ConsRecom': [1.7, 2.5], 'symbol': ['S0001', 'S0004']}).to_parquet(new)
+
+    capture = process_xml.change_capture(str(tmp_path), {name: {'S0001'}}, run_id='20260101T000000000000Z')
+    assert capture.capture(name, str(old), str(new)) == 1
+    metadata = pq.read_schema(tmp_path / 'changes' / name / '20260101T000000000000Z.parquet').metadata
+    assert metadata[b'base_version'].decode() == export_version(old) and metadata[b'version'].decode() == export_version(new)
+
+    # Rewritten without changed symbols: a delta without rows keeps the versions connected
+    capture = process_xml.change_capture(str(tmp_path), {}, run_id='20260102T000000000000Z')
+    assert capture.capture(name, str(new), str(old)) == 0
+    delta = pq.read_table(tmp_path / 'changes' / name / '20260102T000000000000Z.parquet')
+    assert delta.num_rows == 0 and delta.schema.metadata[b'version'].decode() == export_version(old)
+
+    # Written again with the same contents: no delta
+    capture = process_xml.change_capture(str(tmp_path), {name: {'S0001'}}, run_id='20260103T000000000000Z')
+    assert capture.capture(name, str(old), str(old)) == 0
+    assert not (tmp_path / 'changes' / name / '20260103T000000000000Z.parquet').exists()
+
+def test_estimates_without_fiscal_year_estimates():
+    # A RESC report without consensus estimates has no FYEstimates
+    processor = process_xml.RESC_Processor.from_string('<REarnEstCons><ConsEstimates><NPEstimates/></ConsEstimates></REarnEstCons>')
+    table = processor.process_table('fiscal_year_estimates_annual')
+    assert table.num_rows == 0
+    assert table.column_names == ['high_curr', 'low_curr', 'mean_curr', 'mean_1ma', 'mean_3ma', 'median_curr', 'stdev_curr', 'numberOfEst_curr',
+                                  'fYear', 'endMonth', 'endCalYear', 'type', 'unit']
+
+    processor = process_xml.RESC_Processor.from_string(
+        '<REarnEstCons><ConsEstimates><FYEstimates>'
+        '<FYEstimate type="EPS" unit="U"><FYPeriod periodType="A" fYear="2021" endMonth="12" endCalYear="2021">'
+        '<ConsEstimate type="Mean"><ConsValue dateType="CURR">1.5</ConsValue></ConsEstimate></FYPeriod></FYEstimate>'
+        '<FYEstimate type="REVENUE" unit="M"><FYPeriod periodType="Q" fYear="2021" endMonth="3" endCalYear="2021"/></FYEstimate>'
+        '</FYEstimates></ConsEstimates></REarnEstCons>')
+    df = processor.process('fiscal_year_estimates_annual')
+    assert df[['type', 'fYear', 'mean_curr']].astype(str).values.tolist() == [['EPS', '2021', '1.5']]
@@ -0,0 +1,171 @@
+import datetime
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from sqlalchemy import Date, String, create_engine, inspect, text
+from conftest import load_script
+from export_tables import export_version
+
+sqldb = load_script('process-parquet-save-to-sqldb.py')
+
+def write_export(export_dir, table, rows):
+    df = pd.DataFrame(rows)
+    df.to_parquet(export_dir / f'{table}.parquet')
+
+def read_table(engine, table):
+    df = pd.read_sql_table(table, engine)
+    return df.drop(columns=['__index_level_0__'], errors='ignore').sort_values(list(df.columns.drop('__index_level_0__', errors='ignore'))).reset_index(drop=True)
+
+def statement(symbol, year, value):
+    return {'B001X': value, 'FiscalPeriodEndDate': datetime.date(year, 12, 31), 'SourceDate': datetime.date(year + 1, 2, 1), 'FiscalPeriodYear': year,
+            'StatementType': 'BAL', 'symbol': symbol, 'reportType': 'ReportsFinStatements'}
+
+def forecast(symbol, value):
+    return {'ConsRecom': value, 'symbol': symbol, 'reportType': 'ReportSnapshot'}
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/test.db')
+    yield engine
+    engine.dispose()
+
+@pytest.mark.parametrize('load', [sqldb.load_merge, sqldb.load_replace])
+def test_load_keeps_date_types(tmp_path, engine, load):
+    table = 'ReportsFinStatements_balance_sheet_annual'
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0)])
+    load(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    columns = {column['name']: column['type'] for column in inspect(engine).get_columns(table)}
+    assert isinstance(columns['FiscalPeriodEndDate'], Date)
+    assert isinstance(columns['SourceDate'], Date)
+    # Key columns are bounded, so they can be indexed
+    assert isinstance(columns['symbol'], String) and columns['symbol'].length == sqldb.key_length
+    with engine.connect() as connection:
+        assert connection.execute(text(f'SELECT "FiscalPeriodEndDate" FROM "{table}"')).scalar() == '2020-12-31'
+
+@pytest.mark.parametrize('load', [sqldb.load_merge, sqldb.load_replace])
+def test_load_removes_stale_rows(tmp_path, engine, load):
+    table = 'ReportsFinStatements_balance_sheet_annual'
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0), statement('S0001', 2021, 2.0)])
+    load(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    # A period drops out of the export, and a value changes
+    write_export(tmp_path, table, [statement('S0001', 2021, 5.0)])
+    load(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    df = read_table(engine, table)
+    assert df[['symbol', 'FiscalPeriodYear', 'B001X']].values.tolist() == [['S0001', 2021, 5.0]]
+
+@pytest.mark.parametrize('load, expected', [(sqldb.load_merge, [['S0001', 1.7], ['S0004', 2.5]]), (sqldb.load_replace, [['S0001', 1.7]])])
+def test_symbols_missing_from_the_export(tmp_path, engine, load, expected):
+    # A merge keeps the rows of symbols that aren't in the export, e.g. of a run for some of the symbols only
+    table = 'ReportSnapshot_forecast_data'
+    write_export(tmp_path, table, [forecast('S0001', 1.5), forecast('S0004', 2.5)])
+    load(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    write_export(tmp_path, table, [forecast('S0001', 1.7)])
+    load(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    assert read_table(engine, table)[['symbol', 'ConsRecom']].values.tolist() == expected
+
+def test_merge_only_touches_changed_rows(tmp_path, engine):
+    table = 'ReportsFinStatements_balance_sheet_annual'
+    rows = [statement('S0001', 2020, 1.0), statement('S0001', 2021, 2.0), statement('S0004', 2021, 3.0)]
+    write_export(tmp_path, table, rows)
+    assert sqldb.load_merge(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 3
+    with engine.connect() as connection:
+        before = dict(connection.execute(text(f'SELECT "symbol" || "FiscalPeriodYear", rowid FROM "{table}"')).fetchall())
+
+    # Nothing changed: nothing is written, also when the row numbers shift
+    pd.DataFrame(rows, index=[5, 6, 7]).to_parquet(tmp_path / f'{table}.parquet')
+    assert sqldb.load_merge(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 0
+
+    # One row changed: it is deleted and inserted again, the others stay where they are
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0), statement('S0001', 2021, 2.5), statement('S0004', 2021, 3.0)])
+    assert sqldb.load_merge(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 2
+    with engine.connect() as connection:
+        after = dict(connection.execute(text(f'SELECT "symbol" || "FiscalPeriodYear", rowid FROM "{table}"')).fetchall())
+    assert after['S00012020'] == before['S00012020'] and after['S00042021'] == before['S00042021']
+    assert after['S00012021'] != before['S00012021']
+    assert read_table(engine, table)['B001X'].tolist() == [1.0, 2.5, 3.0]
+
+def test_merge_adds_new_columns(tmp_path, engine):
+    table = 'ReportSnapshot_forecast_data'
+    write_export(tmp_path, table, [forecast('S0001', 1.5)])
+    sqldb.load_merge(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    write_export(tmp_path, table, [dict(forecast('S0001', 1.5), TargetPrice=10.0)])
+    sqldb.load_merge(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    assert read_table(engine, table)[['symbol', 'TargetPrice']].values.tolist() == [['S0001', 10.0]]
+
+def write_delta(export_dir, table, run_id, rows, base_version):
+    # As process-xml.py --changes writes it, just before the export file is replaced
+    os.makedirs(export_dir / 'changes' / table, exist_ok=True)
+    delta = pa.Table.from_pandas(pd.DataFrame([dict(row, change=change, run_id=run_id) for change, row in rows]), preserve_index=False)
+    delta = delta.replace_schema_metadata(dict(delta.schema.metadata, base_version=base_version, version=export_version(export_dir / f'{table}.parquet')))
+    pq.write_table(delta, export_dir / 'changes' / table / f'{run_id}.parquet')
+
+def applied_run(engine, table):
+    with engine.connect() as connection:
+        return connection.execute(text('SELECT run_id FROM change_runs WHERE "table" = :table'), {'table': table}).scalar()
+
+def test_delta_applies_new_runs(tmp_path, engine):
+    table = 'ReportsFinStatements_balance_sheet_annual'
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0), statement('S0004', 2020, 3.0)])
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 2
+    assert applied_run(engine, table) is None
+
+    # The next run updates a statement and removes a company
+    base_version = export_version(tmp_path / f'{table}.parquet')
+    write_export(tmp_path, table, [statement('S0001', 2020, 2.0)])
+    write_delta(tmp_path, table, '20260102T000000000000Z', [('update', statement('S0001', 2020, 2.0)), ('delete', statement('S0004', 2020, 3.0))], base_version)
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 2
+
+    assert read_table(engine, table)[['symbol', 'B001X']].values.tolist() == [['S0001', 2.0]]
+    assert applied_run(engine, table) == '20260102T000000000000Z'
+    # Nothing new to apply
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 0
+
+def test_delta_skips_unchanged_tables(tmp_path, engine):
+    # The derived tables and exports without --changes have no delta files
+    table = 'ReportsFinStatements_derived_metrics'
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0), statement('S0004', 2020, 3.0)])
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 2
+
+    # Written again with the same rows, e.g. by a full run
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0), statement('S0004', 2020, 3.0)])
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 0
+
+def test_delta_without_changes_merges_export(tmp_path, engine):
+    table = 'ReportsFinStatements_derived_metrics'
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0), statement('S0004', 2020, 3.0)])
+    sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+
+    write_export(tmp_path, table, [statement('S0001', 2020, 2.0), statement('S0004', 2020, 3.0)])
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 2
+
+    assert read_table(engine, table)[['symbol', 'B001X']].values.tolist() == [['S0001', 2.0], ['S0004', 3.0]]
+    assert applied_run(engine, table) is None
+
+def test_delta_merges_export_written_without_changes(tmp_path, engine):
+    table = 'ReportsFinStatements_balance_sheet_annual'
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0)])
+    sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000)
+    base_version = export_version(tmp_path / f'{table}.parquet')
+    write_export(tmp_path, table, [statement('S0001', 2020, 1.0), statement('S0004', 2020, 3.0)])
+    write_delta(tmp_path, table, '20260101T000000000000Z', [('insert', statement('S0004', 2020, 3.0))], base_version)
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 1
+
+    # A run without --changes rewrites the export: the delta that follows doesn't apply to what was loaded
+    write_export(tmp_path, table, [statement('S0001', 2020, 2.0), statement('S0004', 2020, 3.0)])
+    base_version = export_version(tmp_path / f'{table}.parquet')
+    write_export(tmp_path, table, [statement('S0001', 2020, 2.0), statement('S0004', 2020, 4.0)])
+    write_delta(tmp_path, table, '20260102T000000000000Z', [('update', statement('S0004', 2020, 4.0))], base_version)
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 4
+
+    assert read_table(engine, table)[['symbol', 'B001X']].values.tolist() == [['S0001', 2.0], ['S0004', 4.0]]
+    assert applied_run(engine, table) == '20260102T000000000000Z'
+    assert sqldb.load_delta(engine, f'{tmp_path}/{table}.parquet', table, 1000) == 0
@@ -0,0 +1,121 @@
+import argparse
+import gzip
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+
+
+def open_blob(path: str):
+    """Open a stored XML blob for reading, e.g. to hand it to ElementTree.parse."""
+    return gzip.open(path, 'rb')
+
+class xml_store():
+    """
+    Content-addressed, compressed store for the raw fundamentals XML, with the full retrieval history.
+
+    Every response is stored gzip-compressed under its SHA-256 (blobs/<first 2 hex digits>/<sha256>.xml.gz), so an
+    identical refetch doesn't take any extra space. An index maps (symbol, report, fetched_at) to the blob, from which
+    the latest snapshot, or the snapshot at any earlier moment, can be looked up.
+    """
+    def __init__(self, path: str = 'store'):
+        self.path = path
+        os.makedirs(os.path.join(path, 'blobs'), exist_ok=True)
+
+        self.connection = sqlite3.connect(os.path.join(path, 'index.sqlite'))
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS snapshots (
+                symbol TEXT NOT NULL,
+                report TEXT NOT NULL,
+                fetched_at TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (symbol, report, fetched_at)
+            )''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def blob_path(self, sha256: str):
+        return os.path.join(self.path, 'blobs', sha256[:2], f'{sha256}.xml.gz')
+
+    def put(self, symbol: str, report: str, data: str, fetched_at: datetime = None):
+        """Store a response. Returns the SHA-256 of its contents."""
+        fetched_at = datetime.now() if fetched_at is None else fetched_at
+        contents = data.encode('utf-8')
+        sha256 = hashlib.sha256(contents).hexdigest()
+
+        path = self.blob_path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(path + '.tmp', 'wb') as f:
+                f.write(contents)
+            os.replace(path + '.tmp', path)
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO snapshots (symbol, report, fetched_at, sha256) VALUES (?, ?, ?, ?)',
+            (symbol, report, fetched_at.isoformat(), sha256))
+        self.connection.commit()
+        return sha256
+
+    def latest(self, symbol: str, report: str, as_of: datetime = None):
+        """The (fetched_at, sha256) of the latest snapshot, or of the latest one at as_of. None if there is none."""
+        row = self.connection.execute(
+            'SELECT fetched_at, sha256 FROM snapshots WHERE symbol = ? AND report = ? AND fetched_at <= ? ORDER BY fetched_at DESC LIMIT 1',
+            (symbol, report, (as_of or datetime.max).isoformat())).fetchone()
+        return None if row is None else (datetime.fromisoformat(row[0]), row[1])
+
+    def snapshots(self, as_of: datetime = None):
+        """The latest snapshot of every (symbol, report), as {(symbol, report): (fetched_at, sha256)}."""
+        rows = self.connection.execute('''
+            SELECT symbol, report, fetched_at, sha256 FROM snapshots
+            JOIN (SELECT symbol, report, MAX(fetched_at) AS fetched_at FROM snapshots WHERE fetched_at <= ? GROUP BY symbol, report)
+            USING (symbol, report, fetched_at)''',
+            ((as_of or datetime.max).isoformat(),)).fetchall()
+        return {(symbol, report): (datetime.fromisoformat(fetched_at), sha256) for symbol, report, fetched_at, sha256 in rows}
+
+    def history(self, symbol: str, report: str):
+        """All snapshots of a report, oldest first, as a list of (fetched_at, sha256)."""
+        rows = self.connection.execute(
+            'SELECT fetched_at, sha256 FROM snapshots WHERE symbol = ? AND report = ? ORDER BY fetched_at',
+            (symbol, report)).fetchall()
+        return [(datetime.fromisoformat(fetched_at), sha256) for fetched_at, sha256 in rows]
+
+    def open(self, symbol: str, report: str, as_of: datetime = None):
+        snapshot = self.latest(symbol, report, as_of)
+        if snapshot is None:
+            raise FileNotFoundError(f'No {report} for {symbol} in {self.path}')
+        return open_blob(self.blob_path(snapshot[1]))
+
+    def read(self, sha256: str):
+        with open_blob(self.blob_path(sha256)) as f:
+            return f.read().decode('utf-8')
+
+    def import_directory(self, directory: str = 'fundamentals'):
+        """Import a fundamentals directory (<symbol>/<report>.xml), using the modification times as fetched_at."""
+        imported = 0
+        for symbol in os.listdir(directory):
+            if not os.path.isdir(os.path.join(directory, symbol)):
+                continue
+            for name in os.listdir(os.path.join(directory, symbol)):
+                path = os.path.join(directory, symbol, name)
+                if not name.endswith('.xml'):
+                    continue
+                with open(path, 'r') as f:
+                    data = f.read()
+                # Empty JSON lists are failed requests, not reports
+                if data.startswith('[]'):
+                    continue
+                self.put(symbol, name[:-len('.xml')], data, datetime.fromtimestamp(os.path.getmtime(path)))
+                imported += 1
+        return imported
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import a fundamentals directory into the compressed XML store.')
+    parser.add_argument('directory', nargs='?', default='fundamentals', help='Fundamentals directory to import (default: fundamentals)')
+    parser.add_argument('--store', default='store', help='Store directory (default: store)')
+    args = parser.parse_args()
+
+    store = xml_store(args.store)
+    print(f'Imported {store.import_directory(args.directory)} files into {args.store}')
+    store.close()